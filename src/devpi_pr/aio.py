@@ -0,0 +1,206 @@
+""" Asynchronous Python API for pull requests on a devpi server.
+
+It sends the same requests as the ``devpi`` commands of devpi-pr and is
+meant for scripts which handle many pull requests at once::
+
+    async with PRClient("https://devpi.example.com") as client:
+        await client.login("user", "password")
+        prs = await client.list_prs("user/index", state="pending")
+        await asyncio.gather(*(
+            client.reject_pr("%s/%s" % (user, pr["name"]), "Outdated")
+            for user, user_prs in prs.get("pending", {}).items()
+            for pr in user_prs))
+
+The requests are made with a pooled ``requests`` session in a thread pool,
+at most ``max_concurrency`` of them at the same time.
+"""
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+from devpi_pr.client import get_approval_headers
+from devpi_pr.client import get_new_pr_ixconfig
+from devpi_pr.client import get_source_release
+from devpi_pr.client import get_state_change
+from functools import partial
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlencode
+import asyncio
+import json
+import requests
+
+
+class PRClientError(Exception):
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+def merge_pr_list_pages(result, page):
+    for state, users in page.items():
+        state_data = result.setdefault(state, {})
+        for user, prs in users.items():
+            state_data.setdefault(user, []).extend(prs)
+    return result
+
+
+class PRClient:
+    def __init__(self, url, auth=None, max_concurrency=10, session=None):
+        """ Creates a client for the devpi server at ``url``.
+
+            The ``auth`` is a tuple of user name and the password returned
+            by ``login``. """
+        self.url = url.rstrip('/')
+        self.auth = auth
+        self.max_concurrency = max_concurrency
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=1, pool_maxsize=max_concurrency)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        self.session = session
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown()
+        self.session.close()
+
+    def get_url(self, name, *parts):
+        return "/".join((self.url, name.strip('/')) + parts)
+
+    def _request(self, method, url, data=None, headers=None):
+        headers = dict(headers or {})
+        headers["Accept"] = "application/json"
+        headers["content-type"] = "application/json"
+        if self.auth is not None:
+            headers["X-Devpi-Auth"] = b64encode(
+                ("%s:%s" % self.auth).encode("ascii")).decode("ascii")
+        if data is not None:
+            data = json.dumps(data)
+        r = self.session.request(method, url, data=data, headers=headers)
+        try:
+            reply = r.json()
+        except ValueError:
+            reply = {}
+        if r.status_code >= 400:
+            raise PRClientError(
+                reply.get("message", r.reason), status_code=r.status_code)
+        return (reply, r.headers)
+
+    async def request(self, method, url, data=None, headers=None):
+        """ Sends a JSON request and returns the decoded reply and the
+            response headers. Raises ``PRClientError`` on error responses. """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor,
+            partial(self._request, method, url, data=data, headers=headers))
+
+    async def login(self, user, password):
+        (reply, headers) = await self.request(
+            "post", self.get_url("+login"),
+            dict(user=user, password=password))
+        self.auth = (user, reply["result"]["password"])
+        return self.auth
+
+    async def list_prs(self, name, **query):
+        """ Returns the ``+pr-list`` of the target index or user ``name``.
+
+            The ``query`` supports the parameters of ``+pr-list``, lists
+            are joined with commas. With ``limit`` all pages are fetched
+            with that size and merged. """
+        query = {
+            k: ",".join(v) if isinstance(v, (list, tuple)) else v
+            for k, v in query.items() if v is not None}
+        url = self.get_url(name, "+pr-list")
+        result = {}
+        while True:
+            (reply, headers) = await self.request(
+                "get", "%s?%s" % (url, urlencode(sorted(query.items()))))
+            merge_pr_list_pages(result, reply["result"])
+            if reply.get("next_cursor") is None:
+                return result
+            query["cursor"] = reply["next_cursor"]
+
+    async def pr_status(self, name):
+        (reply, headers) = await self.request(
+            "get", self.get_url(name, "+pr-status"))
+        return reply["result"]
+
+    async def new_pr(self, name, target, releases=(), source=None,
+                     reference=False):
+        """ Creates the pr index ``name`` for the ``target`` index and
+            pushes the ``releases``, tuples of project name and version,
+            from the ``source`` index into it.
+
+            With ``reference`` the releases are only referenced and their
+            files copied from the ``source`` index on approval. """
+        releases = list(releases)
+        if releases and source is None:
+            raise ValueError("A source index is required to add releases")
+        if reference:
+            await self.request(
+                "put", self.get_url(name), get_new_pr_ixconfig(target, [
+                    get_source_release(source, project, version)
+                    for (project, version) in releases]))
+            return
+        await self.request(
+            "put", self.get_url(name), get_new_pr_ixconfig(target))
+        for (project, version) in releases:
+            await self.request(
+                "push", self.get_url(source),
+                dict(name=project, version=version, targetindex=name))
+
+    async def submit_pr(self, name, message):
+        await self.request(
+            "patch", self.get_url(name), get_state_change("pending", message))
+
+    async def cancel_pr(self, name, message):
+        await self.request(
+            "patch", self.get_url(name), get_state_change("new", message))
+
+    async def review_pr(self, name):
+        """ Returns the serial to approve the pending pull request at. """
+        status = await self.pr_status(name)
+        if status["state"] != "pending":
+            raise PRClientError(
+                "The pull request '%s' is %s, not pending." % (
+                    name, status["state"]))
+        return status["last_serial"]
+
+    async def approve_pr(self, name, serial, message, keep_index=False,
+                         incremental=False):
+        """ Approves the pull request at ``serial`` and returns the names of
+            the files skipped with ``incremental``. """
+        (reply, headers) = await self.request(
+            "patch", self.get_url(name),
+            get_state_change("approved", message),
+            headers=get_approval_headers(serial, incremental))
+        skipped = headers.get('X-Devpi-PR-Skipped')
+        if not keep_index:
+            await self.delete_pr(name)
+        return skipped.split(",") if skipped else []
+
+    async def reject_pr(self, name, message):
+        await self.request(
+            "patch", self.get_url(name), get_state_change("rejected", message))
+
+    async def delete_pr(self, name):
+        await self.request("delete", self.get_url(name))
+
+    async def pr_batch(self, indexname, action, prs, message,
+                       keep_index=False, incremental=False):
+        """ Applies ``action`` to the pull requests of the target index in
+            one request like ``devpi approve-pr`` and ``devpi reject-pr``
+            with multiple names. Returns the result for each of them. """
+        (reply, headers) = await self.request(
+            "post", self.get_url(indexname, "+pr-batch"),
+            dict(
+                action=action, message=message, keep_index=keep_index,
+                incremental=incremental, prs=prs))
+        return reply["result"]
@@ -1,19 +1,31 @@
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from devpi_common.metadata import parse_requirement
 from operator import itemgetter
 from pluggy import HookimplMarker
 from tempfile import NamedTemporaryFile
 from subprocess import call
+from urllib.parse import urlencode
 import appdirs
 import attr
 import json
 import os
+import sqlite3
+import sys
 import textwrap
+import time
 import traceback
 
 
 client_hookimpl = HookimplMarker("devpiclient")
 devpi_pr_data_dir = appdirs.user_data_dir("devpi-pr", "devpi")
+devpi_pr_review_timeout = 30
+approval_poll_interval = 1
+# the server waits at most 30 seconds
+pr_watch_timeout = 30
+pr_watch_interval = 5
+pr_states = ("new", "pending", "approved", "rejected")
 
 
 def get_message_from_file(f):
@@ -51,44 +63,113 @@ def get_message(hub, msg):
     hub.fatal("A message is required.")
 
 
+class ReviewData(MutableMapping):
+    """ The serials of active reviews by pr index name.
+
+        Every review is a row in the database, so changes only touch the
+        affected pull requests. """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __getitem__(self, name):
+        row = self.conn.execute(
+            "SELECT serial FROM reviews WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            raise KeyError(name)
+        return row[0]
+
+    def __setitem__(self, name, serial):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO reviews (name, serial) VALUES (?, ?)",
+            (name, serial))
+
+    def __delitem__(self, name):
+        c = self.conn.execute("DELETE FROM reviews WHERE name = ?", (name,))
+        if c.rowcount == 0:
+            raise KeyError(name)
+
+    def __iter__(self):
+        c = self.conn.execute("SELECT name FROM reviews ORDER BY name")
+        return iter([row[0] for row in c])
+
+    def __len__(self):
+        (count,) = self.conn.execute("SELECT COUNT(*) FROM reviews").fetchone()
+        return count
+
+
 @contextmanager
-def devpi_pr_review_lock(hub):
-    if not os.path.exists(devpi_pr_data_dir):
-        os.mkdir(devpi_pr_data_dir)
-    lock_fn = os.path.join(devpi_pr_data_dir, "reviews.lock")
+def devpi_pr_review_transaction(hub, conn):
+    """ Runs an exclusive write transaction on the review database.
+
+        Waits up to ``devpi_pr_review_timeout`` seconds for other devpi-pr
+        commands to finish their transactions. """
     try:
-        with open(lock_fn, "x"):
-            yield
-    except FileExistsError:
+        conn.execute("BEGIN IMMEDIATE")
+    except sqlite3.OperationalError as e:
         hub.fatal(
-            "There is an existing lock at %s\n"
-            "This can happen if a previous devpi-pr command crashed. "
-            "If you are sure there is no other devpi-pr command still running, "
-            "you can remove the file." % lock_fn)
+            "Couldn't lock the review data in %s: %s" % (
+                devpi_pr_data_dir, e))
+    try:
+        yield
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
     else:
-        if os.path.exists(lock_fn):
-            os.remove(lock_fn)
+        conn.execute("COMMIT")
+
+
+def migrate_review_json(hub, conn):
+    """ Moves the data from the reviews.json file of older versions into
+        the database. """
+    fn = os.path.join(devpi_pr_data_dir, "reviews.json")
+    if not os.path.exists(fn):
+        return
+    with devpi_pr_review_transaction(hub, conn):
+        if not os.path.exists(fn):
+            # migrated concurrently
+            return
+        with open(fn, "rb") as f:
+            data = f.read().decode("utf-8")
+        if data:
+            conn.executemany(
+                "INSERT OR IGNORE INTO reviews (name, serial) VALUES (?, ?)",
+                json.loads(data).items())
+        os.rename(fn, fn + ".migrated")
+
+
+@contextmanager
+def devpi_pr_review_db(hub):
+    if not os.path.exists(devpi_pr_data_dir):
+        os.makedirs(devpi_pr_data_dir)
+    fn = os.path.join(devpi_pr_data_dir, "reviews.sqlite")
+    conn = sqlite3.connect(
+        fn, timeout=devpi_pr_review_timeout, isolation_level=None)
+    try:
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS reviews "
+                "(name TEXT PRIMARY KEY, serial)")
+        except sqlite3.OperationalError as e:
+            hub.fatal("Couldn't open the review data in %s: %s" % (fn, e))
+        migrate_review_json(hub, conn)
+        yield conn
+    finally:
+        conn.close()
 
 
 @contextmanager
 def devpi_pr_review_data(hub):
-    with devpi_pr_review_lock(hub):
-        fn = os.path.join(devpi_pr_data_dir, "reviews.json")
-        if os.path.exists(fn):
-            with open(fn, "rb") as f:
-                data = f.read().decode("utf-8")
-        else:
-            data = ""
-        if not data:
-            original = None
-            info = {}
-        else:
-            original = json.loads(data)
-            info = dict(original)
-        yield info
-        if info != original:
-            with open(fn, "wb") as f:
-                f.write(json.dumps(info).encode("utf-8"))
+    with devpi_pr_review_db(hub) as conn:
+        with devpi_pr_review_transaction(hub, conn):
+            yield ReviewData(conn)
+
+
+def get_devpi_pr_review_data(hub):
+    """ Returns the review data for read only use without blocking writers. """
+    with devpi_pr_review_db(hub) as conn:
+        return dict(ReviewData(conn))
 
 
 def full_indexname(hub, prname):
@@ -111,6 +192,7 @@ class PRIndexInfos:
     indexname = attr.ib(type=str)
     url = attr.ib(type=str)
     ixconfig = attr.ib(type=dict)
+    status = attr.ib(type=dict, default=None)
 
 
 def require_pr_index(hub, name):
@@ -129,6 +211,76 @@ def require_pr_index(hub, name):
     return PRIndexInfos(user, index, indexname, url, ixconfig)
 
 
+def get_pr_status_from_list(hub, indexinfos):
+    """ Returns the state and for pending pull requests the last serial
+        from the index config and the ``+pr-list`` of the target index, for
+        servers without ``+pr-status``. """
+    status = dict(state=indexinfos.ixconfig["states"][-1])
+    if status["state"] != "pending":
+        return status
+    (targetindex,) = indexinfos.ixconfig['bases']
+    targeturl = hub.current.get_index_url(targetindex)
+    list_url = targeturl.asdir().joinpath("+pr-list").replace(query=urlencode(
+        [("state", "pending"), ("user", indexinfos.user),
+         ("fields", "name,last_serial")]))
+    r = hub.http_api("get", list_url, type="pr-list")
+    users_prs = r.result.get("pending", {}).get(indexinfos.user, [])
+    for prs in users_prs:
+        if prs["name"] == indexinfos.index:
+            status["last_serial"] = prs["last_serial"]
+            return status
+    hub.fatal("Could not find PR '%s'." % indexinfos.indexname)
+
+
+def require_pr_status(hub, name):
+    """ Like require_pr_index, but only fetches the ``+pr-status`` of the pr
+        index instead of the full index config. Falls back to the index
+        config and the ``+pr-list`` of the target index for servers without
+        ``+pr-status``. """
+    hub.requires_login()
+    current = hub.require_valid_current_with_index()
+    indexname = full_indexname(hub, name)
+    (user, index) = indexname.split('/')
+    url = current.get_index_url(indexname, slash=False)
+    r = hub.http_api(
+        "get", url.asdir().joinpath("+pr-status"),
+        fatal=False, quiet=True, type="pr-status")
+    if r.status_code == 404:
+        # either the pr index or the endpoint doesn't exist
+        indexinfos = require_pr_index(hub, name)
+        indexinfos.status = get_pr_status_from_list(hub, indexinfos)
+        return indexinfos
+    if r.status_code != 200:
+        hub.fatal(r.json_get("message", r.reason))
+    return PRIndexInfos(user, index, indexname, url, None, status=r.result)
+
+
+def get_new_pr_ixconfig(target, source_releases=()):
+    ixconfig = dict(
+        type="pr", bases=target,
+        states=["new"], messages=["New pull request"])
+    if source_releases:
+        ixconfig["source_releases"] = list(source_releases)
+    return ixconfig
+
+
+def get_source_release(indexname, project, version):
+    return "%s/%s/%s" % (indexname.strip("/"), project, version)
+
+
+def get_state_change(state, message):
+    return [
+        "states+=%s" % state,
+        "messages+=%s" % message]
+
+
+def get_approval_headers(serial, incremental=False):
+    headers = {'X-Devpi-PR-Serial': "%s" % serial}
+    if incremental:
+        headers['X-Devpi-PR-Incremental'] = 'yes'
+    return headers
+
+
 def new_pr_arguments(parser):
     """ Create a new pull request.
     """
@@ -144,13 +296,57 @@ def new_pr_arguments(parser):
         default=None, action="store",
         help="releases in format 'name==version' which are added to "
              "this pull request.")
+    parser.add_argument(
+        "-f", "--manifest", metavar="FILE", type=str, action="store",
+        help="file with more releases to add, one 'name==version' per "
+             "line. Empty lines and lines starting with '#' are ignored. "
+             "Use '-' to read them from stdin.")
+    parser.add_argument(
+        "--push-threads", type=int, default=4, action="store",
+        help="number of releases pushed to the pull request at the "
+             "same time (default 4).")
+    parser.add_argument(
+        "--reference", action="store_true",
+        help="add the releases as references to the current index instead "
+             "of pushing them. Their files are only copied once, into the "
+             "target index on approval.")
+
+
+def read_manifest(hub, path):
+    if path == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        try:
+            with open(path) as f:
+                lines = f.read().splitlines()
+        except OSError as e:
+            hub.fatal("Couldn't read manifest '%s': %s" % (path, e))
+    return [
+        line.strip() for line in lines
+        if line.strip() and not line.strip().startswith("#")]
+
+
+def push_release(hub, timings, indexname, req):
+    version = "%s" % req.specs[0][1]
+    with timing(timings, "%s==%s" % (req.project_name, version)):
+        return hub.http_api(
+            "push",
+            hub.current.index,
+            kvdict=dict(
+                name=req.project_name,
+                version=version,
+                targetindex=indexname),
+            fatal=False)
 
 
 def new_pr(hub, args):
     (name,) = args.name
     (target,) = args.target
+    pkgspecs = list(args.pkgspec)
+    if args.manifest:
+        pkgspecs.extend(read_manifest(hub, args.manifest))
     reqs = []
-    for pkgspec in args.pkgspec:
+    for pkgspec in pkgspecs:
         req = parse_requirement(pkgspec)
         if len(req.specs) != 1 or req.specs[0][0] != '==':
             hub.fatal(
@@ -158,18 +354,37 @@ def new_pr(hub, args):
         reqs.append(req)
     indexname = full_indexname(hub, name)
     url = hub.current.get_index_url(indexname, slash=False)
-    hub.http_api("put", url, dict(
-        type="pr", bases=target,
-        states=["new"], messages=["New pull request"]))
-    for req in reqs:
+    if args.reference:
+        source_releases = [
+            get_source_release(
+                hub.current.indexname, req.project_name,
+                "%s" % req.specs[0][1])
+            for req in reqs]
         hub.http_api(
-            "push",
-            hub.current.index,
-            kvdict=dict(
-                name=req.project_name,
-                version="%s" % req.specs[0][1],
-                targetindex=indexname),
-            fatal=True)
+            "put", url, get_new_pr_ixconfig(target, source_releases))
+        if source_releases:
+            hub.info("added %s releases of %s as references" % (
+                len(source_releases), hub.current.indexname))
+        return
+    hub.http_api("put", url, get_new_pr_ixconfig(target))
+    if not reqs:
+        return
+    timings = []
+    with timing(timings, "total"):
+        with ThreadPoolExecutor(max_workers=max(args.push_threads, 1)) as executor:
+            replies = list(executor.map(
+                lambda req: push_release(hub, timings, indexname, req),
+                reqs))
+    failed = [
+        "%s (%s)" % (pkgspec, r.status_code)
+        for pkgspec, r in zip(pkgspecs, replies)
+        if r.status_code not in (200, 201)]
+    hub.info("pushed %s of %s releases in %.3fs:" % (
+        len(reqs) - len(failed), len(reqs), timings[-1][1]))
+    for name, duration in sorted(timings[:-1], key=itemgetter(1), reverse=True):
+        hub.info("    %.3fs %s" % (duration, name))
+    if failed:
+        hub.fatal("Failed to push %s" % ", ".join(failed))
 
 
 def abort_pr_review_arguments(parser):
@@ -191,12 +406,90 @@ def abort_pr_review(hub, args):
             hub.error("No review of '%s' active" % indexinfos.indexname)
 
 
+def output_skipped(hub, skipped):
+    if skipped:
+        hub.info("skipped %s files already in the target index: %s" % (
+            len(skipped), ", ".join(skipped)))
+
+
+def pr_batch(hub, action, prs, message, keep_index=False, incremental=False):
+    """ Applies ``action`` to the pull requests of the current index in one
+        request and outputs the result for each of them.
+
+        Returns the names of the successfully changed pull requests. """
+    current = hub.require_valid_current_with_index()
+    url = current.index_url.asdir().joinpath("+pr-batch")
+    r = hub.http_api(
+        "post", url,
+        dict(
+            action=action, message=message, keep_index=keep_index,
+            incremental=incremental, prs=prs),
+        fatal=False, type="pr-batch")
+    results = r.json_get("result", None)
+    if results is None:
+        hub.fatal("%s %s" % (r.status_code, r.reason))
+    done = []
+    for result in results:
+        if result["status"] == 200:
+            hub.info("%s: %s" % (result["name"], result["message"]))
+            output_skipped(hub, result.get("skipped"))
+            done.append(result["name"])
+        else:
+            hub.error("%s: %s" % (result["name"], result["message"]))
+    return done
+
+
+def format_approval_progress(status):
+    return "copied %s of %s files (%s of %s bytes)" % (
+        status["files_done"], status["files_total"],
+        status["bytes_done"], status["bytes_total"])
+
+
+def wait_for_approval(hub, indexinfos, serial, message, keep_index=False):
+    """ Starts the approval job of the pr index on the server and polls its
+        progress until it is finished. A job interrupted earlier is resumed
+        by the server and skips the files already in the target index. """
+    url = indexinfos.url.asdir().joinpath("+pr-approval")
+    r = hub.http_api(
+        "post", url,
+        dict(serial=int(serial), message=message, keep_index=keep_index),
+        fatal=False, quiet=True, type="pr-approval")
+    if r.status_code not in (200, 202):
+        hub.fatal(r.json_get("message", r.reason))
+    status = r.result
+    last_progress = None
+    while True:
+        progress = format_approval_progress(status)
+        if progress != last_progress:
+            hub.info(progress)
+            last_progress = progress
+        if status["state"] != "running":
+            break
+        time.sleep(approval_poll_interval)
+        r = hub.http_api(
+            "get", url, fatal=False, quiet=True, type="pr-approval")
+        if r.status_code != 200:
+            hub.fatal(r.json_get("message", r.reason))
+        status = r.result
+    if status["state"] != "approved":
+        hub.fatal("Approval of '%s' failed: %s" % (
+            indexinfos.indexname, status.get("error")))
+    if status["files_skipped"]:
+        hub.info("skipped %s files already in the target index" % (
+            status["files_skipped"]))
+
+
 def approve_pr_arguments(parser):
     """ Approve reviewed pull request.
     """
     parser.add_argument(
-        "name", type=str, action="store", nargs=1,
-        help="pull request name")
+        "name", type=str, action="store", nargs="*",
+        help="pull request name. If more than one name is given, all of "
+             "them are approved in one request to the current index")
+    parser.add_argument(
+        "--all-reviewed", action="store_true",
+        help="approve all pull requests of the current index "
+             "you are reviewing")
     parser.add_argument(
         "-s", "--serial", type=str, action="store",
         help="pull request serial, only required if not using 'review-pr' first")
@@ -206,9 +499,106 @@ def approve_pr_arguments(parser):
     parser.add_argument(
         "-k", "--keep-index", action="store_true",
         help="Keep the pr index instead of deleting it after approval.")
+    parser.add_argument(
+        "--incremental", action="store_true",
+        help="Skip files which are already in the target index with the "
+             "same name and hash, for example from an earlier approval of "
+             "the pull request with --keep-index.")
+    parser.add_argument(
+        "--wait", action="store_true",
+        help="Run the approval as a job on the server and wait for it "
+             "while showing the progress. Use this for large pull requests. "
+             "Only possible for volatile target indexes.")
+    parser.add_argument(
+        "--dry-run", action="store_true",
+        help="Only check whether the pull requests can be approved and "
+             "which files would be copied, without changing anything.")
+
+
+def check_prs(hub, prs, incremental=False):
+    """ Outputs for each pull request in ``prs``, tuples of index name and
+        serial, whether it can be approved according to ``+pr-check``. """
+    current = hub.require_valid_current_with_index()
+    failed = 0
+    for (name, serial) in prs:
+        url = current.get_index_url(name, slash=False).asdir().joinpath(
+            "+pr-check").replace(query=urlencode(
+                [("serial", serial), ("incremental", incremental)]))
+        r = hub.http_api(
+            "get", url, fatal=False, quiet=True, type="pr-check")
+        if r.status_code != 200:
+            hub.error("%s: %s" % (name, r.json_get("message", r.reason)))
+            failed += 1
+            continue
+        result = r.result
+        if result["errors"]:
+            for error in result["errors"]:
+                hub.error("%s: %s" % (name, error))
+            failed += 1
+            continue
+        hub.info("%s: would copy %s files (%s bytes) to %s" % (
+            name, result["files"], result["bytes"], result["target"]))
+        output_skipped(hub, result["skipped"])
+    if failed:
+        hub.fatal("%s of %s pull requests can't be approved." % (
+            failed, len(prs)))
+
+
+def approve_prs(hub, args):
+    hub.requires_login()
+    if args.serial is not None:
+        hub.fatal(
+            "The --serial option can only be used "
+            "with a single pull request.")
+    if args.wait:
+        hub.fatal(
+            "The --wait option can only be used "
+            "with a single pull request.")
+    current = hub.require_valid_current_with_index()
+    review_data = get_devpi_pr_review_data(hub)
+    if args.all_reviewed:
+        list_url = current.index_url.asdir().joinpath("+pr-list").replace(
+            query=urlencode([("state", "pending"), ("fields", "name")]))
+        r = hub.http_api("get", list_url, type="pr-list")
+        names = [
+            "%s/%s" % (user, pr["name"])
+            for user, prs in r.result.get("pending", {}).items()
+            for pr in prs]
+        names = sorted(x for x in names if x in review_data)
+        if not names:
+            hub.fatal(
+                "You are not reviewing any pull requests "
+                "of '%s'." % current.indexname)
+    else:
+        names = [full_indexname(hub, x) for x in args.name]
+    missing = [x for x in names if x not in review_data]
+    if missing:
+        hub.fatal(
+            "No review data found for %s, "
+            "it looks like you did not use review-pr." % ", ".join(
+                "'%s'" % x for x in missing))
+    if args.dry_run:
+        return check_prs(
+            hub, [(x, review_data[x]) for x in names],
+            incremental=args.incremental)
+    message = get_message(hub, args.message)
+    approved = pr_batch(
+        hub, "approve",
+        [dict(name=x, serial=review_data[x]) for x in names],
+        message, keep_index=args.keep_index, incremental=args.incremental)
+    with devpi_pr_review_data(hub) as review_data:
+        for name in approved:
+            review_data.pop(name, None)
+    if len(approved) != len(names):
+        hub.fatal("Approved %s of %s pull requests." % (
+            len(approved), len(names)))
 
 
 def approve_pr(hub, args):
+    if args.all_reviewed or len(args.name) > 1:
+        return approve_prs(hub, args)
+    if not args.name:
+        hub.fatal("No pull request name given.")
     (name,) = args.name
     indexinfos = require_pr_index(hub, name)
     serial = args.serial
@@ -220,14 +610,25 @@ def approve_pr(hub, args):
                     "it looks like you did not use review-pr or "
                     "you forgot the --serial option." % indexinfos.indexname)
             serial = "%s" % review_data[indexinfos.indexname]
+    if args.dry_run:
+        # approval jobs always skip files already in the target index
+        return check_prs(
+            hub, [(indexinfos.indexname, serial)],
+            incremental=args.incremental or args.wait)
     message = get_message(hub, args.message)
-    hub.http_api(
-        "patch", indexinfos.url, [
-            "states+=approved",
-            "messages+=%s" % message],
-        headers={'X-Devpi-PR-Serial': serial})
-    if not args.keep_index:
-        hub.http_api("delete", indexinfos.url)
+    if args.wait:
+        wait_for_approval(
+            hub, indexinfos, serial, message, keep_index=args.keep_index)
+    else:
+        r = hub.http_api(
+            "patch", indexinfos.url,
+            get_state_change("approved", message),
+            headers=get_approval_headers(serial, args.incremental))
+        skipped = r.headers.get('X-Devpi-PR-Skipped')
+        if skipped:
+            output_skipped(hub, skipped.split(","))
+        if not args.keep_index:
+            hub.http_api("delete", indexinfos.url)
     with devpi_pr_review_data(hub) as review_data:
         review_data.pop(indexinfos.indexname, None)
 
@@ -245,6 +646,15 @@ def list_prs_arguments(parser):
     parser.add_argument(
         "-m", "--messages", action="store_true",
         help="Include state change messages in output.")
+    parser.add_argument(
+        "--timings", action="store_true",
+        help="Output the time taken by the requests to the server.")
+    parser.add_argument(
+        "--watch", action="store_true",
+        help="Keep running and output the pull requests again whenever "
+             "they change. Waits for changes on the server instead of "
+             "polling if the server supports it. The index config is "
+             "only fetched once.")
 
 
 def merge_pr_data(data1, data2):
@@ -303,72 +713,238 @@ def create_pr_list_output(users_prs, review_data, include_messages):
     return "\n".join(out)
 
 
-def list_prs(hub, args):
+def get_pr_list_query(hidden_states, include_messages):
+    """ Returns the query string for +pr-list to only fetch what is shown.
+
+        Servers without support for the parameters ignore them, so the
+        result is still filtered locally. """
+    fields = ["name", "base", "last_serial"]
+    if include_messages:
+        fields.extend(["states", "by", "messages"])
+    query = [("fields", ",".join(fields))]
+    shown_states = [x for x in pr_states if x not in hidden_states]
+    if len(shown_states) < len(pr_states):
+        query.append(("state", ",".join(shown_states)))
+    return urlencode(query)
+
+
+@contextmanager
+def timing(timings, name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.append((name, time.perf_counter() - start))
+
+
+def get_json(hub, timings, url, cache=None, **kwargs):
+    """ With a ``cache`` dict the replies are kept in it. Kept replies are
+        revalidated with their ETag, or reused as is if they have none. """
+    cached = None if cache is None else cache.get(url)
+    if cached is not None:
+        etag = cached.headers.get("ETag")
+        if etag is None:
+            return cached
+        kwargs["headers"] = {"If-None-Match": etag}
+        kwargs["quiet"] = True
+    with timing(timings, "GET %s" % url):
+        r = hub.http_api("get", url, **kwargs)
+    if cache is not None:
+        if r.status_code == 304:
+            return cached
+        if r.status_code == 200:
+            cache[url] = r
+    return r
+
+
+def get_reply_result(hub, r, type):
+    """ Returns the result of a reply fetched with ``quiet`` and without
+        ``fatal`` in a worker thread. Errors are reported from the calling
+        thread, so they don't end a worker or mix with other output. """
+    if r.status_code != 200:
+        hub.fatal("GET %s\n%s %s: %s" % (
+            r.url, r.status_code, r.reason, r.json_get("message", r.reason)))
+    if r.type != type:
+        hub.fatal("%s: got result type %r, expected %r" % (
+            r.url, r.type, type))
+    return r.result
+
+
+def get_pr_list_data(hub, args, timings, cache=None):
+    """ Returns the merged pr list data and the states to hide.
+
+        The index config and the pr lists of the index and the current user
+        are fetched concurrently. The server returns an empty pr list for
+        indexes which don't allow pull requests, so the index pr list doesn't
+        have to wait for the index config. See ``get_json`` for ``cache``. """
     indexname = args.indexname
     current = hub.require_valid_current_with_index()
     index_url = current.get_index_url(indexname, slash=False)
-    r = hub.http_api("get", index_url, fatal=False, type="indexconfig")
-    ixconfig = r.result or {}
     hidden_states = set()
     if not args.all_states:
         hidden_states.add("approved")
+    list_query = get_pr_list_query(hidden_states, args.messages)
+    index_list_url = index_url.asdir().joinpath("+pr-list").replace(
+        query=list_query)
+    user = current.get_auth_user()
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        ixconfig_future = executor.submit(
+            get_json, hub, timings, index_url, cache=cache,
+            fatal=False, quiet=True)
+        index_list_future = executor.submit(
+            get_json, hub, timings, index_list_url, cache=cache,
+            fatal=False, quiet=True)
+        if user:
+            user_list_url = current.get_user_url(user).asdir().joinpath(
+                "+pr-list").replace(query=list_query)
+            user_list_future = executor.submit(
+                get_json, hub, timings, user_list_url, cache=cache,
+                fatal=False, quiet=True)
+    # all requests are done, the errors are reported from here
+    ixconfig = get_reply_result(hub, ixconfig_future.result(), "indexconfig")
     pull_requests_allowed = ixconfig.get("pull_requests_allowed", False)
     is_pr_index = ixconfig["type"] == "pr"
     if pull_requests_allowed or is_pr_index:
-        list_url = index_url.asdir().joinpath("+pr-list")
-        r = hub.http_api("get", list_url, type="pr-list")
-        index_data = r.result
+        index_data = get_reply_result(
+            hub, index_list_future.result(), "pr-list")
     else:
         index_data = {}
     if not is_pr_index and not args.all_states:
         hidden_states.add("new")
+    if user:
+        user_data = get_reply_result(
+            hub, user_list_future.result(), "pr-list")
+        if is_pr_index and not args.all_states:
+            user_data.pop("new", None)
+    else:
+        user_data = {}
+    return (merge_pr_data(index_data, user_data), hidden_states)
+
+
+def output_current_index(hub):
+    current = hub.require_valid_current_with_index()
     user = current.get_auth_user()
     if user:
         login_status = "logged in as %s" % user
     else:
         login_status = "not logged in"
     hub.info("current devpi index: %s (%s)" % (current.index, login_status))
-    if user:
-        user_url = current.get_user_url(user)
-        list_url = user_url.asdir().joinpath("+pr-list")
-        r = hub.http_api("get", list_url, type="pr-list")
-        user_data = r.result
-        if is_pr_index and not args.all_states:
-            user_data.pop("new", None)
-    else:
-        user_data = {}
-    pr_data = merge_pr_data(index_data, user_data)
+
+
+def get_pr_list_lines(hub, args, timings, cache=None):
+    (pr_data, hidden_states) = get_pr_list_data(
+        hub, args, timings, cache=cache)
+    lines = []
     if not pr_data:
-        hub.line("no pull requests")
-        return
+        lines.append("no pull requests")
+    review_data = get_devpi_pr_review_data(hub)
     for state in sorted(pr_data):
         if state in hidden_states:
             continue
-        with devpi_pr_review_data(hub) as review_data:
-            out = create_pr_list_output(
-                pr_data[state], review_data, args.messages)
-        hub.line("%s pull requests" % state)
-        hub.line(textwrap.indent(out, "    "))
+        out = create_pr_list_output(
+            pr_data[state], review_data, args.messages)
+        lines.append("%s pull requests" % state)
+        lines.append(textwrap.indent(out, "    "))
+    return lines
+
+
+def output_timings(hub, timings):
+    hub.info("timings:")
+    for name, duration in timings:
+        hub.info("    %.3fs %s" % (duration, name))
+
+
+def wait_for_pr_events(hub, args, serial, timeout):
+    """ Waits up to ``timeout`` seconds for pull request changes of the index
+        after ``serial`` with ``+pr-events``. Returns the serial to wait after
+        next time, or ``None`` if the server doesn't support it. """
+    current = hub.require_valid_current_with_index()
+    url = current.get_index_url(args.indexname, slash=False).asdir().joinpath(
+        "+pr-events")
+    query = [("timeout", timeout)]
+    if serial is not None:
+        query.append(("serial", serial))
+    r = hub.http_api(
+        "get", url.replace(query=urlencode(query)),
+        fatal=False, quiet=True, type="pr-events")
+    if r.status_code != 200:
+        return None
+    return r.result["serial"]
+
+
+def watch_prs(hub, args):
+    """ Outputs the pull requests again whenever they change.
+
+        The pr lists are only fetched again after changes or a timeout
+        and the server doesn't send them if they are unchanged. """
+    cache = {}
+    lines = None
+    try:
+        # changes after this serial are picked up by the first wait
+        serial = wait_for_pr_events(hub, args, None, 0)
+        while True:
+            timings = []
+            with timing(timings, "total"):
+                new_lines = get_pr_list_lines(hub, args, timings, cache=cache)
+            if new_lines != lines:
+                lines = new_lines
+                output_current_index(hub)
+                for line in lines:
+                    hub.line(line)
+                if args.timings:
+                    output_timings(hub, timings)
+            if serial is None:
+                time.sleep(pr_watch_interval)
+            else:
+                serial = wait_for_pr_events(
+                    hub, args, serial, pr_watch_timeout)
+    except KeyboardInterrupt:
+        pass
+
+
+def list_prs(hub, args):
+    if args.watch:
+        return watch_prs(hub, args)
+    timings = []
+    with timing(timings, "total"):
+        lines = get_pr_list_lines(hub, args, timings)
+        output_current_index(hub)
+        for line in lines:
+            hub.line(line)
+    if args.timings:
+        output_timings(hub, timings)
 
 
 def reject_pr_arguments(parser):
     """ Reject pull request.
     """
     parser.add_argument(
-        "name", type=str, action="store", nargs=1,
-        help="pull request name")
+        "name", type=str, action="store", nargs="+",
+        help="pull request name. If more than one name is given, all of "
+             "them are rejected in one request to the current index")
     parser.add_argument(
         "-m", "--message", action="store",
         help="Message to add on reject.")
 
 
+def reject_prs(hub, args):
+    hub.requires_login()
+    names = [full_indexname(hub, x) for x in args.name]
+    message = get_message(hub, args.message)
+    rejected = pr_batch(hub, "reject", names, message)
+    if len(rejected) != len(names):
+        hub.fatal("Rejected %s of %s pull requests." % (
+            len(rejected), len(names)))
+
+
 def reject_pr(hub, args):
+    if len(args.name) > 1:
+        return reject_prs(hub, args)
     (name,) = args.name
     indexinfos = require_pr_index(hub, name)
     message = get_message(hub, args.message)
-    hub.http_api("patch", indexinfos.url, [
-        "states+=rejected",
-        "messages+=%s" % message])
+    hub.http_api(
+        "patch", indexinfos.url, get_state_change("rejected", message))
 
 
 def review_pr_arguments(parser):
@@ -384,20 +960,11 @@ def review_pr_arguments(parser):
 
 def review_pr(hub, args):
     (name,) = args.name
-    indexinfos = require_pr_index(hub, name)
-    (targetindex,) = indexinfos.ixconfig['bases']
-    targeturl = hub.current.get_index_url(targetindex)
-    r = hub.http_api("get", targeturl.asdir().joinpath("+pr-list"), type="pr-list")
-    pending_prs = r.result.get("pending")
-    if not pending_prs:
-        hub.fatal("There are no pending PRs.")
-    users_prs = pending_prs.get(indexinfos.user)
-    for prs in users_prs:
-        if prs["name"] == indexinfos.index:
-            last_serial = prs["last_serial"]
-            break
-    else:
-        hub.fatal("Could not find PR '%s'." % indexinfos.indexname)
+    indexinfos = require_pr_status(hub, name)
+    if indexinfos.status["state"] != "pending":
+        hub.fatal("The pull request '%s' is %s, not pending." % (
+            indexinfos.indexname, indexinfos.status["state"]))
+    last_serial = indexinfos.status["last_serial"]
     with devpi_pr_review_data(hub) as review_data:
         if indexinfos.indexname in review_data:
             if args.update:
@@ -429,9 +996,8 @@ def submit_pr(hub, args):
     (name,) = args.name
     indexinfos = require_pr_index(hub, name)
     message = get_message(hub, args.message)
-    hub.http_api("patch", indexinfos.url, [
-        "states+=pending",
-        "messages+=%s" % message])
+    hub.http_api(
+        "patch", indexinfos.url, get_state_change("pending", message))
 
 
 def cancel_pr_arguments(parser):
@@ -449,9 +1015,8 @@ def cancel_pr(hub, args):
     (name,) = args.name
     indexinfos = require_pr_index(hub, name)
     message = get_message(hub, args.message)
-    hub.http_api("patch", indexinfos.url, [
-        "states+=new",
-        "messages+=%s" % message])
+    hub.http_api(
+        "patch", indexinfos.url, get_state_change("new", message))
 
 
 def delete_pr_arguments(parser):
@@ -1,5 +1,17 @@
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from devpi_common.metadata import parse_version
+from devpi_common.validation import normalize_name
+from devpi_server.log import threadlog
 from devpi_server.model import ensure_list
+from io import BytesIO
 from pluggy import HookimplMarker
+import inspect
+import itertools
+import threading
+import time
 
 
 server_hookimpl = HookimplMarker("devpiserver")
@@ -15,11 +27,1043 @@ states = {
 
 def is_stage_empty(stage):
     for project in stage.list_projects_perstage():
-        if stage.get_releaselinks_perstage(project):
+        if stage.get_simplelinks_perstage(project):
             return False
     return True
 
 
+def get_file_count(stage):
+    """ Returns the number of release files in the stage.
+
+        Only the simple links of each project are used, which doesn't
+        require fetching the file entries. """
+    return sum(
+        len(stage.get_simplelinks_perstage(project))
+        for project in stage.list_projects_perstage())
+
+
+def scan_pr_indexes(model, targetindex_name):
+    """ Returns the names of all pr indexes with the given target by
+        looking at the configuration of every index of every user. """
+    result = []
+    for user in model.get_userlist():
+        for name, ixconfig in user.get()["indexes"].items():
+            if ixconfig["type"] != "pr":
+                continue
+            if targetindex_name not in ixconfig["bases"]:
+                continue
+            result.append("%s/%s" % (user.name, name))
+    return result
+
+
+def iter_pr_stages(target):
+    """ Yields the pr stages which have the given target stage as base. """
+    model = target.model
+    for name in scan_pr_indexes(model, target.name):
+        stage = model.getstage(name)
+        if stage is not None:
+            yield stage
+
+
+class PRSummary(object):
+    """ Keeps the last change serial and the number of files of pr indexes,
+        so listing pull requests doesn't need to look at all keys of every
+        pr index for each request.
+
+        Entries are computed on first use at the serial of the transaction
+        and dropped when the files or versions of the pr index or of the
+        index of one of its source releases change, which the event hooks
+        report from the notifier thread. Changes to the index config are
+        detected by comparing it with the one the entry was computed for.
+        Until the notifier caught up with the serial of a transaction, only
+        entries computed at that serial are used. """
+
+    def __init__(self, xom):
+        self.xom = xom
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.changes = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def invalidate(self, name, serial):
+        """ Drops the entry of the pr index with the given name if it was
+            computed before the given serial. For other indexes the serial
+            is remembered to drop the entries of pr indexes with source
+            releases in them. """
+        with self.lock:
+            self.changes[name] = max(serial, self.changes.get(name, -1))
+            entry = self.entries.get(name)
+            if entry is not None and entry["serial"] < serial:
+                del self.entries[name]
+
+    def get_change_serial(self, name, sources):
+        return max(
+            self.changes.get(x, -1) for x in itertools.chain([name], sources))
+
+    def is_valid(self, entry, stage, at_serial):
+        if entry["ixconfig"] != stage.ixconfig:
+            return False
+        # the events of a deleted index have no stage to report
+        for name in entry["sources"]:
+            if stage.model.getstage(name) is None:
+                return False
+        if entry["serial"] == at_serial:
+            return True
+        if entry["serial"] > at_serial:
+            return False
+        return self.xom.keyfs.notifier.read_event_serial() >= at_serial
+
+    def get(self, stage):
+        at_serial = self.xom.keyfs.tx.at_serial
+        with self.lock:
+            entry = self.entries.get(stage.name)
+            if entry is not None:
+                change_serial = self.get_change_serial(
+                    stage.name, entry["sources"])
+                if entry["serial"] < change_serial:
+                    entry = None
+        if entry is not None and self.is_valid(entry, stage, at_serial):
+            return entry
+        entry = dict(
+            get_summary(stage),
+            serial=at_serial,
+            ixconfig=dict(stage.ixconfig),
+            sources=get_source_names(stage.ixconfig))
+        with self.lock:
+            current = self.entries.get(stage.name)
+            if current is not None and current["serial"] > at_serial:
+                return entry
+            change_serial = self.get_change_serial(
+                stage.name, entry["sources"])
+            if at_serial >= change_serial:
+                self.entries[stage.name] = entry
+        return entry
+
+
+def get_summary(stage):
+    """ Returns the last change serial and the number of release files of
+        the pr stage including the referenced source releases. """
+    last_serial = stage.get_last_change_serial_perstage()
+    files = get_file_count(stage)
+    if stage.ixconfig.get("source_releases"):
+        (source_releases, errors) = get_source_releases(stage)
+        last_serial = max(last_serial, get_source_serial(source_releases))
+        files += sum(
+            len(source.get_linkstore_perstage(project, version).get_links(
+                rel='releasefile'))
+            for (source, project, version) in source_releases)
+    return dict(last_serial=last_serial, files=files)
+
+
+def get_pr_summary(stage):
+    """ Returns the summary entry of the pr stage with ``last_serial`` and
+        ``files``. """
+    summary = getattr(stage.xom, "devpi_pr_summary", None)
+    if summary is None:
+        return get_summary(stage)
+    return summary.get(stage)
+
+
+def invalidate_pr_summary(stage, serial):
+    summary = getattr(stage.xom, "devpi_pr_summary", None)
+    if summary is not None:
+        summary.invalidate(stage.name, serial)
+
+
+pr_state_events = {
+    'pending': 'submit',
+    'approved': 'approve',
+    'rejected': 'reject',
+    'new': 'cancel',
+}
+
+
+class PREvents(object):
+    """ Keeps the most recent state changes of pull requests in memory for
+        the ``+pr-events`` long-poll endpoint.
+
+        The events are only known to the server which made the change and
+        are lost on restart. If events after the serial a consumer asks for
+        might be missing, the result says so with ``complete`` set to false
+        and the consumer has to start again from ``+pr-list``.
+
+        Each waiting consumer occupies a worker thread of the server, so at
+        most ``max_waiters`` of them wait at the same time. Others get an
+        empty result right away and have to ask again. """
+
+    def __init__(self, maxlen, serial, max_waiters=None):
+        self.cond = threading.Condition()
+        self.events = deque(maxlen=maxlen)
+        # events after this serial are all known
+        self.first_serial = serial
+        self.serial = serial
+        self.max_waiters = max_waiters
+        self.waiters = 0
+
+    def add(self, event):
+        with self.cond:
+            if len(self.events) == self.events.maxlen:
+                self.first_serial = self.events[0]["serial"]
+            self.events.append(event)
+            self.serial = max(self.serial, event["serial"])
+            self.cond.notify_all()
+
+    def get(self, name, since=None, timeout=0):
+        """ Returns the events of the pr index or target index with the
+            given name after serial ``since``, waiting up to ``timeout``
+            seconds for new ones if there are none yet. Without ``since``
+            only new events are returned. """
+        with self.cond:
+            if since is None:
+                since = self.serial
+            if self.max_waiters is not None and self.waiters >= self.max_waiters:
+                timeout = 0
+            deadline = time.monotonic() + timeout
+            self.waiters += 1
+            try:
+                while True:
+                    events = [
+                        x for x in self.events
+                        if x["serial"] > since
+                        and name in (x["name"], x["target"])]
+                    remaining = deadline - time.monotonic()
+                    if events or remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+            finally:
+                self.waiters -= 1
+            return dict(
+                events=events,
+                serial=max(since, self.serial),
+                complete=since >= self.first_serial)
+
+
+# like the changelog of devpi-server, don't block a thread for too long
+max_pr_events_timeout = 30.0
+
+
+def get_pr_events_params(request):
+    """ Returns the ``serial`` and ``timeout`` query parameters of a
+        ``+pr-events`` request, the timeout limited to
+        ``max_pr_events_timeout``. Raises ``ValueError`` for invalid ones. """
+    params = {}
+    for name in ("serial", "timeout"):
+        value = request.GET.get(name)
+        if value is None:
+            continue
+        try:
+            params[name] = float(value) if name == "timeout" else int(value)
+        except ValueError:
+            raise ValueError("The %s must be a number" % name)
+    params["timeout"] = min(
+        max(params.get("timeout", 0), 0), max_pr_events_timeout)
+    return params
+
+
+def tween_pr_events(handler, registry):
+    """ Gets the events of ``+pr-events`` requests before devpi-server
+        starts the keyfs transaction of the request, so a consumer waiting
+        for events doesn't keep a read transaction open. The view only
+        checks the index and returns them. """
+
+    def pr_events_handler(request):
+        parts = request.path_info.strip("/").split("/")
+        if request.method == "GET" and len(parts) == 3 and parts[2] == "+pr-events":
+            try:
+                params = get_pr_events_params(request)
+            except ValueError:
+                # reported by the view
+                params = None
+            if params is not None:
+                xom = registry["xom"]
+                name = "/".join(parts[:2])
+                # don't wait for an index which doesn't exist,
+                # the view reports it
+                with read_transaction(xom.keyfs):
+                    stage = xom.model.getstage(name)
+                if stage is not None:
+                    request.environ["devpi_pr.events"] = xom.devpi_pr_events.get(
+                        name, since=params.get("serial"),
+                        timeout=params["timeout"])
+        return handler(request)
+
+    return pr_events_handler
+
+
+def add_pr_event(stage, event, by):
+    """ Adds an event for the pr index ``stage`` with its current state
+        once the current transaction is committed. """
+    xom = stage.xom
+    events = getattr(xom, "devpi_pr_events", None)
+    if events is None:
+        return
+    tx = xom.keyfs.tx
+    ixconfig = stage.ixconfig
+    data = dict(
+        serial=tx.at_serial + 1,
+        event=event,
+        name=stage.name,
+        target=ixconfig["bases"][0] if ixconfig["bases"] else None,
+        state=ixconfig["states"][-1],
+        message=ixconfig["messages"][-1],
+        by=by)
+    tx.on_commit_success(lambda: events.add(data))
+
+
+class PRMetrics(object):
+    """ Counters and latency histograms of the operations of the plugin.
+
+        The histograms are cumulative like the ones of Prometheus, each
+        bucket counts the durations less than or equal to its bound. """
+
+    buckets = (0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.timings = {}
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add(self, name, duration):
+        with self.lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                timing = self.timings[name] = dict(
+                    count=0, total=0.0, max=0.0,
+                    buckets=[0] * (len(self.buckets) + 1))
+            timing["count"] += 1
+            timing["total"] += duration
+            timing["max"] = max(timing["max"], duration)
+            timing["buckets"][bisect_left(self.buckets, duration)] += 1
+
+    def as_dict(self):
+        labels = ["%g" % x for x in self.buckets] + ["+Inf"]
+        timings = {}
+        with self.lock:
+            for name, timing in self.timings.items():
+                histogram = {}
+                count = 0
+                for label, bucket_count in zip(labels, timing["buckets"]):
+                    count += bucket_count
+                    histogram[label] = count
+                timings[name] = dict(
+                    count=timing["count"], total=timing["total"],
+                    max=timing["max"], histogram=histogram)
+            return dict(counters=dict(self.counters), timings=timings)
+
+
+class Spans(object):
+    """ Measures the time spent in the named phases of one operation. """
+
+    def __init__(self):
+        self.durations = {}
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[name] = (
+                self.durations.get(name, 0.0) + time.perf_counter() - start)
+
+
+@contextmanager
+def timed_operation(xom, operation, name, log=threadlog.info):
+    """ Times the operation and the phases measured with the yielded
+        ``Spans``, adds the durations to the metrics of the server and
+        logs them. """
+    spans = Spans()
+    start = time.perf_counter()
+    try:
+        yield spans
+    finally:
+        total = time.perf_counter() - start
+        metrics = getattr(xom, "devpi_pr_metrics", None)
+        if metrics is not None:
+            metrics.add(operation, total)
+            for phase, duration in spans.durations.items():
+                metrics.add("%s.%s" % (operation, phase), duration)
+        log("%s of %s took %.3fs (%s)", operation, name, total, ", ".join(
+            "%s %.3fs" % x for x in spans.durations.items()))
+
+
+def count_metric(xom, name, value=1):
+    metrics = getattr(xom, "devpi_pr_metrics", None)
+    if metrics is not None:
+        metrics.count(name, value)
+
+
+def is_true(value):
+    return value.lower() in ("1", "true", "yes")
+
+
+def get_os_path(link):
+    try:
+        return link.entry.file_os_path()
+    except RuntimeError:
+        # the file was modified in the current transaction
+        return None
+
+
+def read_file(path):
+    with open(path, "rb") as src:
+        return BytesIO(src.read())
+
+
+class FilePrefetcher(object):
+    """ Reads the content of files in a thread pool ahead of time.
+
+        Storing files in another stage is bound to the transaction of the
+        current thread, so it has to happen one file after another. Reading
+        the source files from the filesystem isn't, so the next files are
+        read into memory concurrently while the current one is stored. The
+        links have to be opened in the order they were passed in.
+
+        At most ``max_bytes`` are read ahead. Files which are larger than
+        that on their own are not read ahead, but opened when they are used.
+
+        With ``hard_links`` nothing is read ahead. The opened files get the
+        ``devpi_srcpath`` attribute instead, so storage backends which
+        support it create a hard link instead of copying the content. """
+
+    def __init__(self, links, max_workers, hard_links=False,
+                 max_bytes=64 * 1024 * 1024):
+        self.links = list(links)
+        self.indexes = {link.relpath: i for i, link in enumerate(self.links)}
+        self.hard_links = hard_links
+        if hard_links:
+            max_workers = 0
+        self.max_workers = max_workers
+        self.max_bytes = max_bytes
+        self.futures = {}
+        # the sizes of the files read ahead which weren't opened yet
+        self.sizes = {}
+        self.position = 0
+        self.executor = None
+        if max_workers > 0:
+            self.executor = ThreadPoolExecutor(
+                max_workers=max_workers,
+                thread_name_prefix="devpi-pr-prefetch")
+            self._submit()
+
+    def _submit(self):
+        pending = sum(self.sizes.values())
+        for index in range(self.position, len(self.links)):
+            if index in self.futures:
+                continue
+            link = self.links[index]
+            path = get_os_path(link)
+            size = get_link_size(link) if path is not None else 0
+            if path is None or size > self.max_bytes:
+                self.futures[index] = None
+                continue
+            if pending + size > self.max_bytes:
+                break
+            pending += size
+            self.sizes[index] = size
+            self.futures[index] = self.executor.submit(read_file, path)
+
+    @contextmanager
+    def open(self, link):
+        if self.hard_links:
+            path = get_os_path(link)
+            if path is not None:
+                with open(path, "rb") as f:
+                    # additional attribute for hard links
+                    f.devpi_srcpath = path
+                    yield f
+                return
+        index = self.indexes.get(link.relpath)
+        future = None
+        if index is not None:
+            future = self.futures.pop(index, None)
+            self.sizes.pop(index, None)
+            self.position = max(self.position, index + 1)
+            if self.executor is not None:
+                self._submit()
+        f = None
+        if future is not None:
+            try:
+                f = future.result()
+            except OSError:
+                f = None
+        if f is None:
+            with link.entry.file_open_read() as f:
+                yield f
+        else:
+            with f:
+                yield f
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+        for future in self.futures.values():
+            if future is not None and future.exception() is None:
+                future.result().close()
+        self.futures.clear()
+        self.sizes.clear()
+
+
+def parse_source_release(value):
+    """ Returns the index name, project and version of an entry of the
+        ``source_releases`` setting of a pr index. """
+    parts = value.split("/")
+    if len(parts) != 4 or not all(parts):
+        raise ValueError(
+            "Invalid source release '%s', it needs to be of this form: "
+            "USER/INDEX/NAME/VERSION" % value)
+    return ("/".join(parts[:2]), parts[2], parts[3])
+
+
+def get_source_names(ixconfig):
+    """ Returns the names of the indexes referenced by the
+        ``source_releases`` setting of a pr index. """
+    names = set()
+    for value in ixconfig.get("source_releases", []):
+        try:
+            names.add(parse_source_release(value)[0])
+        except ValueError:
+            continue
+    return sorted(names)
+
+
+def get_source_releases(stage, ixconfig=None):
+    """ Returns the releases referenced by the ``source_releases`` setting
+        of the pr index as tuples of source stage, project and version and
+        the errors for entries which are invalid or don't exist.
+
+        Releases which the pr index contains itself are left out, its own
+        files are used instead. """
+    if ixconfig is None:
+        ixconfig = stage.ixconfig
+    releases = []
+    errors = []
+    for value in ixconfig.get("source_releases", []):
+        try:
+            (indexname, project, version) = parse_source_release(value)
+        except ValueError as e:
+            errors.append(str(e))
+            continue
+        source = stage.model.getstage(indexname)
+        if source is None or source.ixconfig["type"] == "pr":
+            errors.append(
+                "The source index '%s' doesn't exist or is a pr index" % (
+                    indexname))
+            continue
+        if version not in source.list_versions_perstage(project):
+            errors.append("The source release '%s' doesn't exist" % value)
+            continue
+        if version in stage.list_versions_perstage(project):
+            continue
+        releases.append((source, normalize_name(project), version))
+    return (releases, errors)
+
+
+def get_source_serial(source_releases):
+    """ Returns the last serial at which one of the projects of the source
+        releases changed in its index. """
+    return max(
+        (
+            source.get_last_project_change_serial_perstage(project)
+            for (source, project, version) in source_releases),
+        default=-1)
+
+
+def get_pr_serial(stage):
+    """ Returns the serial a pull request is reviewed and approved at.
+
+        Besides changes of the pr index itself, this includes changes to the
+        projects of the referenced source releases, so they can't change
+        unnoticed after the review. """
+    last_serial = stage.get_last_change_serial_perstage()
+    if not stage.ixconfig.get("source_releases"):
+        return last_serial
+    (source_releases, errors) = get_source_releases(stage)
+    return max(last_serial, get_source_serial(source_releases))
+
+
+def get_release(stage, project, version):
+    linkstore = stage.get_linkstore_perstage(project, version)
+    toxresults = {}
+    links = []
+    for link in linkstore.get_links():
+        if link.rel == 'toxresult':
+            toxresults.setdefault(link.for_entrypath, []).append(link)
+        elif link.rel in ('doczip', 'releasefile'):
+            links.append(link)
+    return (project, version, linkstore, links, toxresults)
+
+
+def get_pr_releases(stage):
+    """ Returns the releases of the pr index which are copied on approval,
+        all versions of each project ordered from oldest to newest, followed
+        by the referenced source releases.
+
+        Each release is a tuple of project, version, linkstore, the release
+        file and doczip links and the toxresult links by release file. The
+        linkstores of source releases belong to their source index. """
+    releases = []
+    for project in stage.list_projects_perstage():
+        versions = sorted(
+            stage.list_versions_perstage(project), key=parse_version)
+        for version in versions:
+            releases.append(get_release(stage, project, version))
+    if stage.ixconfig.get("source_releases"):
+        (source_releases, errors) = get_source_releases(stage)
+        for (source, project, version) in source_releases:
+            releases.append(get_release(source, project, version))
+    return releases
+
+
+def get_copy_links(releases, existing=()):
+    """ Returns all links of the releases in the order they are copied,
+        except the ones in ``existing``. """
+    copy_links = []
+    for (project, version, linkstore, links, toxresults) in releases:
+        for link in links:
+            copy_links.append(link)
+            if link.rel == 'releasefile':
+                copy_links.extend(toxresults.get(link.relpath, []))
+    return [x for x in copy_links if x.relpath not in existing]
+
+
+def get_store_kwargs(link):
+    kw = {}
+    if hasattr(link.entry, "hashes"):
+        kw["hashes"] = link.entry.hashes
+    if hasattr(link.entry, "size"):
+        kw["size"] = link.entry.size
+    return kw
+
+
+def get_target_links(target, project, version):
+    """ Returns the links of the release in the target index by hash spec,
+        an empty dict if the target doesn't have the release. """
+    try:
+        linkstore = target.get_linkstore_perstage(project, version)
+    except target.MissesRegistration:
+        return {}
+    target_links = {}
+    for link in linkstore.get_links():
+        target_links.setdefault(get_link_hash_spec(link), []).append(link)
+    return target_links
+
+
+def find_target_link(target_links, link, for_entrypath=None):
+    """ Returns the link from ``target_links`` with the same hash and name
+        as ``link``. For tox results the release file they belong to has to
+        match instead of the name, as their names are generated on upload. """
+    for target_link in target_links.get(get_link_hash_spec(link), []):
+        if target_link.rel != link.rel:
+            continue
+        if link.rel == 'toxresult':
+            if target_link.for_entrypath == for_entrypath:
+                return target_link
+        elif target_link.basename == link.basename:
+            return target_link
+    return None
+
+
+def get_existing_links(target, releases):
+    """ Returns the links of the releases which are already in the target
+        index by their relpath, mapped to the link in the target index. """
+    existing = {}
+    for (project, version, linkstore, links, toxresults) in releases:
+        target_links = get_target_links(target, project, version)
+        if not target_links:
+            continue
+        for link in links:
+            target_link = find_target_link(target_links, link)
+            if target_link is None:
+                continue
+            existing[link.relpath] = target_link
+            if link.rel != 'releasefile':
+                continue
+            for tox_link in toxresults.get(link.relpath, []):
+                target_tox_link = find_target_link(
+                    target_links, tox_link,
+                    for_entrypath=target_link.relpath)
+                if target_tox_link is not None:
+                    existing[tox_link.relpath] = target_tox_link
+    return existing
+
+
+def get_conflicts(target, releases, existing=()):
+    """ Returns the basenames of the files of the releases which conflict
+        with files in the non-volatile ``target`` index on approval.
+
+        Only the links are compared, no file is opened. Links in
+        ``existing``, as returned by ``get_existing_links``, are skipped on
+        approval and can't conflict. """
+    if target.ixconfig.get("volatile"):
+        return []
+    conflicts = []
+    for (project, version, linkstore, links, toxresults) in releases:
+        target_links = get_target_links(target, project, version)
+        if not target_links:
+            continue
+        target_names = set(
+            (x.rel, x.basename)
+            for hash_links in target_links.values()
+            for x in hash_links)
+        conflicts.extend(
+            link.basename
+            for link in links
+            if link.relpath not in existing
+            and (link.rel, link.basename) in target_names)
+    return conflicts
+
+
+def format_conflicts(conflicts):
+    if len(conflicts) == 1:
+        return "%s already exists in non-volatile index" % conflicts[0]
+    return "%s already exist in non-volatile index" % ", ".join(conflicts)
+
+
+def copy_link(target, project, version, link, prefetcher, spans):
+    kw = get_store_kwargs(link)
+    if link.rel == 'doczip':
+        with spans.span("doczip"), prefetcher.open(link) as f:
+            return target.store_doczip(
+                project,
+                version,
+                f,
+                **kw,
+            )
+    with spans.span("releasefile"), prefetcher.open(link) as f:
+        return target.store_releasefile(
+            project,
+            version,
+            link.basename,
+            f,
+            last_modified=link.entry.last_modified,
+            **kw,
+        )
+
+
+def copy_logs(link, new_link, approver, stage, target, message):
+    """ Copy the log history of ``link`` to ``new_link`` and add the push
+        entry.
+
+        The logs are part of the link data which was already stored in the
+        transaction when the file was added, so changing them doesn't cause
+        additional writes to the database.
+    """
+    new_link.add_logs(
+        x for x in link.get_logs()
+        if x.get('what') != 'overwrite')
+    new_link.add_log(
+        'push', approver,
+        src=stage.name, dst=target.name, message=message)
+
+
+def has_store_toxresult_filename(target):
+    """ Returns whether ``store_toxresult`` of the target accepts the name
+        of the file, which older devpi-server releases don't. """
+    try:
+        parameters = inspect.signature(target.store_toxresult).parameters
+    except (TypeError, ValueError):
+        return False
+    return "filename" in parameters
+
+
+def store_toxresults(target, new_link, tox_links, prefetcher, spans,
+                     is_new=True):
+    """ Stores the ``tox_links`` for the release file ``new_link`` in the
+        target index and returns the new links.
+
+        The file names are generated here like devpi-server does on upload,
+        so it doesn't have to look up all other tox results of the release
+        file again for each one. For a ``new_link`` which was just copied
+        there are none yet. With older devpi-server releases the names are
+        left to it. """
+    new_tox_links = []
+    if not has_store_toxresult_filename(target):
+        for tox_link in tox_links:
+            with spans.span("toxresult"), prefetcher.open(tox_link) as f:
+                new_tox_links.append(target.store_toxresult(
+                    new_link, f, **get_store_kwargs(tox_link)))
+        return new_tox_links
+    count = 0
+    if not is_new:
+        linkstore = target.get_linkstore_perstage(
+            new_link.project, new_link.version)
+        count = len(linkstore.get_links(
+            rel='toxresult', for_entrypath=new_link))
+    timestamp = time.strftime("%Y%m%d%H%M%S", time.gmtime())
+    for (index, tox_link) in enumerate(tox_links, count):
+        filename = "%s.toxresult-%s-%d" % (
+            new_link.basename, timestamp, index)
+        with spans.span("toxresult"), prefetcher.open(tox_link) as f:
+            new_tox_links.append(target.store_toxresult(
+                new_link, f, filename=filename, **get_store_kwargs(tox_link)))
+    return new_tox_links
+
+
+def copy_releases(stage, target, releases, prefetcher, approver, message,
+                  spans=None, existing=None):
+    """ Copies the releases of the pr index into the target index.
+
+        The time spent in each phase is measured with ``spans`` if given.
+
+        Links in ``existing``, as returned by ``get_existing_links``, are
+        not copied again. Returns the basenames of these skipped files.
+
+        Raises ``target.NonVolatile`` on conflicts. """
+    if spans is None:
+        spans = Spans()
+    if existing is None:
+        existing = {}
+    copied = 0
+    skipped = []
+    for (project, version, linkstore, links, toxresults) in releases:
+        with spans.span("versiondata"):
+            target.set_versiondata(linkstore.metadata)
+        for link in links:
+            new_link = existing.get(link.relpath)
+            if new_link is not None:
+                # the tox results might still be new
+                skipped.append(link.basename)
+            else:
+                new_link = copy_link(
+                    target, project, version, link, prefetcher, spans)
+                copied += 1
+                with spans.span("logs"):
+                    copy_logs(
+                        link, new_link, approver, linkstore.stage, target,
+                        message)
+            if link.rel != 'releasefile':
+                continue
+            tox_links = []
+            for tox_link in toxresults.get(link.relpath, []):
+                if tox_link.relpath in existing:
+                    skipped.append(tox_link.basename)
+                else:
+                    tox_links.append(tox_link)
+            if not tox_links:
+                continue
+            new_tox_links = store_toxresults(
+                target, new_link, tox_links, prefetcher, spans,
+                is_new=link.relpath not in existing)
+            copied += len(new_tox_links)
+            with spans.span("logs"):
+                for (tox_link, new_tox_link) in zip(tox_links, new_tox_links):
+                    copy_logs(
+                        tox_link, new_tox_link, approver, linkstore.stage,
+                        target, message)
+    count_metric(target.xom, "approval.files", copied)
+    if skipped:
+        count_metric(target.xom, "approval.files_skipped", len(skipped))
+    return skipped
+
+
+def read_transaction(keyfs):
+    if hasattr(keyfs, "read_transaction"):
+        return keyfs.read_transaction()
+    return keyfs.transaction(write=False)
+
+
+def write_transaction(keyfs):
+    if hasattr(keyfs, "write_transaction"):
+        return keyfs.write_transaction()
+    return keyfs.transaction(write=True)
+
+
+def get_link_hash_spec(link):
+    hash_spec = getattr(link, "best_available_hash_spec", None)
+    if hash_spec is None:
+        hash_spec = getattr(link, "hash_spec", None)
+    return hash_spec
+
+
+def get_link_size(link):
+    size = getattr(link.entry, "size", None)
+    if size is None:
+        size = link.entry.file_size()
+    return size or 0
+
+
+class ApprovalError(Exception):
+    pass
+
+
+class ApprovalJob(object):
+    """ Approves a pull request in a background thread.
+
+        The files are copied in chunks, each in its own transaction, so the
+        files of huge pull requests don't have to be copied within the
+        timeout of one request. Files which are already in the target index
+        with the same name and hash are skipped. If a job is interrupted,
+        a new job for the same pr serial resumes where it stopped. The state
+        of the pull request is only changed in the last transaction.
+
+        Between the chunks the files of the pull request are already
+        visible in the target index, and they stay there if the job fails.
+        Therefore jobs are only possible for volatile target indexes. """
+
+    def __init__(self, xom, name, serial, message, approver,
+                 keep_index=False, chunk_size=100, target=None):
+        self.xom = xom
+        self.name = name
+        # the name of the target index, used for permission checks once
+        # the pr index might already be deleted
+        self.target = target
+        self.serial = serial
+        self.message = message
+        self.approver = approver
+        self.keep_index = keep_index
+        self.chunk_size = max(chunk_size, 1)
+        self.state = "running"
+        self.error = None
+        self.finished = None
+        self.progress = dict(
+            files_total=0, files_done=0, files_skipped=None,
+            bytes_total=0, bytes_done=0)
+        self.thread = None
+
+    def as_dict(self):
+        result = dict(
+            self.progress,
+            name=self.name, serial=self.serial, state=self.state)
+        if self.error is not None:
+            result["error"] = self.error
+        return result
+
+    @property
+    def running(self):
+        return self.state == "running"
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.run, name="pr-approval-%s" % self.name, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            while self.run_chunk():
+                pass
+        except ApprovalError as e:
+            self.error = str(e)
+            self.state = "failed"
+        except Exception as e:
+            threadlog.exception("approval of %s failed", self.name)
+            self.error = "%s: %s" % (e.__class__.__name__, e)
+            self.state = "failed"
+        else:
+            self.state = "approved"
+        finally:
+            self.finished = time.monotonic()
+
+    def check_target(self, target):
+        if not target.ixconfig.get("volatile"):
+            raise ApprovalError(
+                "Approval jobs aren't possible for the non-volatile index "
+                "%s, as the files of a failed job would stay in it" % (
+                    target.name))
+
+    def check_stage(self, stage):
+        if stage is None or stage.ixconfig["type"] != "pr":
+            raise ApprovalError("The pr index %s doesn't exist" % self.name)
+        state = stage.ixconfig["states"][-1]
+        if state != "pending":
+            raise ApprovalError(
+                "State transition from '%s' to 'approved' not allowed" % state)
+        last_serial = get_pr_serial(stage)
+        if self.serial != last_serial:
+            raise ApprovalError("got X-Devpi-PR-Serial %s, expected %s" % (
+                self.serial, last_serial))
+        (source_releases, errors) = get_source_releases(stage)
+        if errors:
+            raise ApprovalError("\n".join(errors))
+
+    def run_chunk(self):
+        """ Copies the next chunk of files or finishes the approval if all
+            files are copied. Returns whether there is more to do. """
+        with write_transaction(self.xom.keyfs):
+            stage = self.xom.model.getstage(self.name)
+            self.check_stage(stage)
+            target = stage.customizer._get_target_stage()
+            self.check_target(target)
+            releases = get_pr_releases(stage)
+            existing = get_existing_links(target, releases)
+            progress = dict(files_total=0, files_done=0, bytes_total=0, bytes_done=0)
+            chunk = []
+            chunk_files = 0
+            for release in releases:
+                (project, version, linkstore, links, toxresults) = release
+                for link in links:
+                    files = [link]
+                    if link.rel == 'releasefile':
+                        files.extend(toxresults.get(link.relpath, []))
+                    new_files = 0
+                    for f in files:
+                        size = get_link_size(f)
+                        progress["files_total"] += 1
+                        progress["bytes_total"] += size
+                        if f.relpath in existing:
+                            progress["files_done"] += 1
+                            progress["bytes_done"] += size
+                        else:
+                            new_files += 1
+                    if new_files and chunk_files < self.chunk_size:
+                        chunk.append((release, link))
+                        chunk_files += new_files
+            if self.progress["files_skipped"] is None:
+                progress["files_skipped"] = progress["files_done"]
+            else:
+                progress["files_skipped"] = self.progress["files_skipped"]
+            self.progress = progress
+            if not chunk:
+                self.finish(stage, target, releases)
+                return False
+            chunk_releases = []
+            for (release, link) in chunk:
+                (project, version, linkstore, links, toxresults) = release
+                if not chunk_releases or chunk_releases[-1][2] is not linkstore:
+                    chunk_releases.append(
+                        (project, version, linkstore, [], toxresults))
+                chunk_releases[-1][3].append(link)
+            args = self.xom.config.args
+            prefetcher = FilePrefetcher(
+                get_copy_links(chunk_releases, existing),
+                args.pr_approval_threads,
+                hard_links=args.pr_hard_links,
+                max_bytes=args.pr_approval_read_ahead)
+            try:
+                with timed_operation(
+                        self.xom, "approval_chunk", self.name) as spans:
+                    copy_releases(
+                        stage, target, chunk_releases, prefetcher,
+                        self.approver, self.message, spans=spans,
+                        existing=existing)
+            except target.NonVolatile as e:
+                raise ApprovalError(format_conflicts([e.link.basename]))
+            finally:
+                prefetcher.close()
+        return True
+
+    def finish(self, stage, target, releases):
+        for (project, version, linkstore, links, toxresults) in releases:
+            if not links:
+                target.set_versiondata(linkstore.metadata)
+        ixconfig = dict(stage.ixconfig)
+        stage._modify(**dict(
+            ixconfig,
+            states=ixconfig["states"] + ["approved"],
+            messages=ixconfig["messages"] + [self.message],
+            changers=ixconfig["changers"] + [self.approver]))
+        add_pr_event(stage, "approve", self.approver)
+        if not self.keep_index and stage.ixconfig["volatile"]:
+            add_pr_event(stage, "delete", self.approver)
+            stage.delete()
+
+
 class PRStage(object):
     def get_indexconfig_fields(self):
         from devpi_server.model.config import ConfigField
@@ -33,19 +1077,21 @@ class PRStage(object):
             ),
             ConfigField(name="pull_requests_allowed", default=False, type=bool),
             ConfigField(name="messages", normalize=ensure_list, type=list),
+            ConfigField(
+                name="source_releases", normalize=ensure_list, type=list),
             ConfigField(name="states", normalize=ensure_list, type=list),
         ]
 
     @classmethod
     def get_possible_indexconfig_keys(cls):
         """ Returns all possible custom index config keys. """
-        return ('states', 'messages', 'changers')
+        return ('states', 'messages', 'changers', 'source_releases')
 
     def get_default_config_items(self):
         return [("changers", [self.stage.username])]
 
     def normalize_indexconfig_value(self, key, value):
-        if key in ("messages", "states", "changers"):
+        if key in ("messages", "states", "changers", "source_releases"):
             return ensure_list(value)
 
     def validate_config(self, oldconfig, newconfig):
@@ -57,9 +1103,18 @@ class PRStage(object):
                 errors.append(
                     "The target index '%s' doesn't allow "
                     "pull requests" % target.name)
-            if is_stage_empty(self.stage):
+            if is_stage_empty(self.stage) and not newconfig.get("source_releases"):
                 errors.append(
                     "The pr index has no packages")
+        source_releases = list(newconfig.get("source_releases", []))
+        if source_releases != list(oldconfig.get("source_releases", [])):
+            if oldconfig.get("states", ["new"])[-1] != "new" or newstate != "new":
+                errors.append(
+                    "The source releases can only be changed while the "
+                    "pull request is new")
+            errors.extend(get_source_releases(self.stage, newconfig)[1])
+        elif newstate == "pending":
+            errors.extend(get_source_releases(self.stage, newconfig)[1])
         new_states_count = len(newconfig["states"])
         new_message_count = len(newconfig["messages"])
         if new_states_count != new_message_count:
@@ -107,6 +1162,8 @@ class PRStage(object):
 
     def _get_target_stage(self):
         ixconfig = self.stage.ixconfig
+        if not ixconfig["bases"]:
+            return None
         targetindex = ixconfig["bases"][0]
         return self.stage.model.getstage(*targetindex.split("/"))
 
@@ -117,7 +1174,8 @@ class PRStage(object):
             # when approved, the principals in the target acl_upload are
             # allowed to delete this index
             target = self._get_target_stage()
-            principals.update(target.ixconfig.get('acl_upload', []))
+            if target is not None:
+                principals.update(target.ixconfig.get('acl_upload', []))
         return principals
 
     def get_principals_for_index_modify(self, **kwargs):
@@ -127,25 +1185,48 @@ class PRStage(object):
             # when pending, the principals in the target acl_upload are
             # allowed to modify this index to change it's state etc
             target = self._get_target_stage()
-            principals.update(target.ixconfig.get('acl_upload', []))
+            if target is not None:
+                principals.update(target.ixconfig.get('acl_upload', []))
         return principals
 
     def on_modified(self, request, oldconfig):
         ixconfig = getattr(self.stage, "ixconfig_mutable", self.stage.ixconfig)
         if not oldconfig:
-            # just created
+            # just created, drop what is known about a deleted index with
+            # the same name, the change is committed at the next serial
+            invalidate_pr_summary(
+                self.stage, self.stage.xom.keyfs.tx.at_serial + 1)
             ixconfig["changers"] = [request.authenticated_userid]
+            add_pr_event(self.stage, "create", request.authenticated_userid)
             return
+        skipped = self.on_state_modified(
+            request, oldconfig, request.headers.get('X-Devpi-PR-Serial'),
+            incremental=is_true(
+                request.headers.get('X-Devpi-PR-Incremental', '')))
+        if skipped is not None:
+            request.add_response_callback(
+                lambda request, response: response.headers.update({
+                    'X-Devpi-PR-Skipped': ",".join(skipped)}))
+
+    def on_state_modified(self, request, oldconfig, pr_serial,
+                          incremental=False):
+        """ Applies the state change from ``oldconfig`` to the current
+            config, approving with the given pr serial.
+
+            With ``incremental`` files which are already in the target index
+            with the same name and hash are skipped on approval. Their
+            basenames are returned in that case. """
+        skipped = None
+        ixconfig = getattr(self.stage, "ixconfig_mutable", self.stage.ixconfig)
         target = self._get_target_stage()
         state = ixconfig["states"][-1]
         if state == "approved":
-            pr_serial = request.headers.get('X-Devpi-PR-Serial')
             try:
                 pr_serial = int(pr_serial)
             except TypeError:
                 request.apifatal(
                     400, message="missing X-Devpi-PR-Serial request header")
-            last_serial = self.stage.get_last_change_serial_perstage()
+            last_serial = get_pr_serial(self.stage)
             if pr_serial != last_serial:
                 request.apifatal(
                     400, message="got X-Devpi-PR-Serial %s, expected %s" % (
@@ -153,76 +1234,34 @@ class PRStage(object):
             if not request.has_permission("pypi_submit", context=target):
                 request.apifatal(401, message="user %r cannot upload to %r" % (
                     request.authenticated_userid, target.name))
-            for project in self.stage.list_projects_perstage():
-                version = self.stage.get_latest_version_perstage(project)
-                linkstore = self.stage.get_linkstore_perstage(project, version)
-                target.set_versiondata(linkstore.metadata)
-                toxresults = {}
-                for link in linkstore.get_links(rel='toxresult'):
-                    toxresults.setdefault(link.for_entrypath, []).append(link)
-                for link in linkstore.get_links():
-                    try:
-                        kw = {}
-                        if hasattr(link.entry, "hashes"):
-                            kw["hashes"] = link.entry.hashes
-                        if hasattr(link.entry, "size"):
-                            kw["size"] = link.entry.size
-                        if link.rel == 'doczip':
-                            with link.entry.file_open_read() as f:
-                                new_link = target.store_doczip(
-                                    project,
-                                    version,
-                                    f,
-                                    **kw,
-                                )
-                            new_link.add_logs(
-                                x for x in link.get_logs()
-                                if x.get('what') != 'overwrite')
-                            new_link.add_log(
-                                'push',
-                                request.authenticated_userid,
-                                src=self.stage.name,
-                                dst=target.name,
-                                message=ixconfig['messages'][-1])
-                        elif link.rel == 'releasefile':
-                            with link.entry.file_open_read() as f:
-                                new_link = target.store_releasefile(
-                                    project,
-                                    version,
-                                    link.basename,
-                                    f,
-                                    last_modified=link.entry.last_modified,
-                                    **kw,
-                                )
-                            new_link.add_logs(
-                                x for x in link.get_logs()
-                                if x.get('what') != 'overwrite')
-                            new_link.add_log(
-                                'push',
-                                request.authenticated_userid,
-                                src=self.stage.name,
-                                dst=target.name,
-                                message=ixconfig['messages'][-1])
-                            for tox_link in toxresults.get(link.relpath, []):
-                                with tox_link.entry.file_open_read() as f:
-                                    new_tox_link = target.store_toxresult(
-                                        new_link, f, **kw
-                                    )
-                                new_tox_link.add_logs(
-                                    x for x in tox_link.get_logs()
-                                    if x.get('what') != 'overwrite')
-                                new_tox_link.add_log(
-                                    'push',
-                                    request.authenticated_userid,
-                                    src=self.stage.name,
-                                    dst=target.name,
-                                    message=ixconfig['messages'][-1])
-                        else:
-                            continue
-                    except target.NonVolatile as e:
-                        request.apifatal(
-                            409, "%s already exists in non-volatile index" % (
-                                e.link.basename,))
+            (source_releases, errors) = get_source_releases(self.stage)
+            if errors:
+                request.apifatal(409, "\n".join(errors))
+            releases = get_pr_releases(self.stage)
+            existing = {}
+            if incremental:
+                existing = get_existing_links(target, releases)
+            # fail before anything is written or read
+            conflicts = get_conflicts(target, releases, existing)
+            if conflicts:
+                request.apifatal(409, format_conflicts(conflicts))
+            args = self.stage.xom.config.args
+            prefetcher = FilePrefetcher(
+                get_copy_links(releases, existing),
+                args.pr_approval_threads,
+                hard_links=args.pr_hard_links,
+                max_bytes=args.pr_approval_read_ahead)
+            try:
+                with timed_operation(
+                        self.stage.xom, "approval", self.stage.name) as spans:
+                    skipped = copy_releases(
+                        self.stage, target, releases, prefetcher,
+                        request.authenticated_userid, ixconfig['messages'][-1],
+                        spans=spans, existing=existing)
+            except target.NonVolatile as e:
+                request.apifatal(409, format_conflicts([e.link.basename]))
+            finally:
+                prefetcher.close()
         elif state == "rejected":
             if not request.has_permission("pypi_submit", context=target):
                 raise self.InvalidIndexconfig([
@@ -232,6 +1271,106 @@ class PRStage(object):
             self.stage._modify(
                 changers=ixconfig["changers"] + [request.authenticated_userid]
             )
+            add_pr_event(
+                self.stage, pr_state_events[state],
+                request.authenticated_userid)
+        if incremental:
+            return skipped
+
+
+@server_hookimpl
+def devpiserver_add_parser_options(parser):
+    pr = parser.addgroup("pull request options")
+    pr.addoption(
+        "--pr-approval-threads", type=int, default=0,
+        help="number of threads used to read files ahead of time "
+             "when approving a pull request, 0 disables reading ahead "
+             "(the default)")
+    pr.addoption(
+        "--pr-approval-read-ahead", type=int, default=64 * 1024 * 1024,
+        metavar="BYTES",
+        help="maximum number of bytes read ahead into memory when "
+             "approving a pull request with --pr-approval-threads")
+    pr.addoption(
+        "--pr-hard-links", action="store_true",
+        help="use hard links to the files of a pull request instead of "
+             "copying them into the target index on approval. "
+             "Only works with storage backends which keep files on the "
+             "filesystem and support hard links during import. "
+             "All limitations for hard links on your OS apply.")
+    pr.addoption(
+        "--pr-approval-chunk-size", type=int, default=100,
+        help="number of files copied per transaction by approval jobs")
+    pr.addoption(
+        "--pr-list-cache-size", type=int, default=100,
+        help="number of pr list responses to cache in memory, "
+             "0 disables the cache")
+    pr.addoption(
+        "--pr-events-size", type=int, default=1000,
+        help="number of pull request state changes kept in memory "
+             "for the +pr-events endpoint")
+    pr.addoption(
+        "--pr-events-waiters", type=int, default=10,
+        help="number of +pr-events requests which wait for changes at the "
+             "same time, each of them occupies one of the --threads of "
+             "the server. Further requests return right away.")
+
+
+def on_context_found(event):
+    """ Adds the delete event for pr indexes deleted with a ``DELETE``
+        request to the index, which devpi-server handles itself. """
+    request = event.request
+    if request.method != "DELETE":
+        return
+    route = getattr(request, "matched_route", None)
+    if route is None or route.name not in ("/{user}/{index}", "/{user}/{index}/"):
+        return
+    xom = request.registry['xom']
+    stage = xom.model.getstage(
+        request.matchdict["user"], request.matchdict["index"])
+    if stage is None or stage.ixconfig["type"] != "pr":
+        return
+    # only added if the deletion is committed
+    add_pr_event(stage, "delete", request.authenticated_userid)
+
+
+def on_stage_event(stage):
+    # the event hooks are called in a transaction at the serial of the
+    # change, other indexes can be referenced by source releases
+    if stage is not None:
+        invalidate_pr_summary(stage, stage.xom.keyfs.tx.at_serial)
+
+
+@server_hookimpl
+def devpiserver_on_upload(stage, project, version, link):
+    on_stage_event(stage)
+
+
+@server_hookimpl
+def devpiserver_on_changed_versiondata(stage, project, version, metadata):
+    on_stage_event(stage)
+
+
+@server_hookimpl
+def devpiserver_on_remove_file(stage, relpath):
+    on_stage_event(stage)
+
+
+@server_hookimpl
+def devpiserver_metrics(request):
+    metrics = getattr(request.registry["xom"], "devpi_pr_metrics", None)
+    if metrics is None:
+        return []
+    data = metrics.as_dict()
+    result = []
+    for name, value in sorted(data["counters"].items()):
+        result.append((
+            "devpi_pr_%s" % name.replace(".", "_"), "counter", value))
+    for name, timing in sorted(data["timings"].items()):
+        name = "devpi_pr_%s" % name.replace(".", "_")
+        result.append(("%s_count" % name, "counter", timing["count"]))
+        result.append(("%s_seconds" % name, "counter", timing["total"]))
+    return result
 
 
 @server_hookimpl
@@ -248,8 +1387,31 @@ def devpiserver_indexconfig_defaults(index_type):
 
 
 def includeme(config):
+    from devpi_pr.views import PRListCache
+    from pyramid.events import ContextFound
+
+    xom = config.registry['xom']
+    xom.devpi_pr_summary = PRSummary(xom)
+    xom.devpi_pr_metrics = PRMetrics()
+    xom.devpi_pr_events = PREvents(
+        xom.config.args.pr_events_size, xom.keyfs.get_current_serial(),
+        max_waiters=xom.config.args.pr_events_waiters)
+    config.registry['devpi_pr.pr_list_cache'] = PRListCache(
+        xom.config.args.pr_list_cache_size)
+    config.registry['devpi_pr.approval_jobs'] = {}
     config.add_route("index-pr-list", "/{user}/{index}/+pr-list")
     config.add_route("user-pr-list", "/{user}/+pr-list")
+    config.add_route("index-pr-batch", "/{user}/{index}/+pr-batch")
+    config.add_route("pr-status", "/{user}/{index}/+pr-status")
+    config.add_route("pr-approval", "/{user}/{index}/+pr-approval")
+    config.add_route("pr-check", "/{user}/{index}/+pr-check")
+    config.add_route("pr-events", "/{user}/{index}/+pr-events")
+    config.add_route("pr-metrics", "/+pr-metrics")
+    config.add_subscriber(on_context_found, ContextFound)
+    config.add_tween(
+        "devpi_pr.server.tween_pr_events",
+        over="devpi_server.views.tween_keyfs_transaction",
+        under="devpi_server.views.tween_request_logging")
     config.scan('devpi_pr.views')
 
 
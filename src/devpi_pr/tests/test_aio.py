@@ -0,0 +1,94 @@
+import asyncio
+import pytest
+
+
+pytestmark = [
+    pytest.mark.nomocking,
+    pytest.mark.notransaction,
+]
+
+
+try:
+    from devpi_server import __version__  # noqa
+except ImportError:
+    pytestmark.append(pytest.mark.skip("No devpi-server installed"))
+try:
+    from devpi import __version__  # noqa
+except ImportError:
+    pytestmark.append(pytest.mark.skip("No devpi-client installed"))
+
+
+@pytest.fixture
+def make_client(url_of_liveserver):
+    from devpi_pr.aio import PRClient
+
+    def make_client(**kwargs):
+        return PRClient(url_of_liveserver.url, **kwargs)
+
+    return make_client
+
+
+def test_aio_workflow(devpi, getjson, make_client, makepkg):
+    names = ["%s/aio%d" % (devpi.user, i) for i in range(5)]
+    for i in range(5):
+        pkg = makepkg(
+            "hello%d-1.0.tar.gz" % i, b"content%d" % i, "hello%d" % i, "1.0")
+        devpi("upload", "--index", "dev", pkg.strpath)
+    target = "%s/dev" % devpi.target
+
+    async def create_and_submit(client, i):
+        await client.new_pr(
+            names[i], target, [("hello%d" % i, "1.0")],
+            source="%s/dev" % devpi.user)
+        await client.submit_pr(names[i], "Please approve")
+
+    async def approve(client, name):
+        serial = await client.review_pr(name)
+        return await client.approve_pr(name, serial, "Approved")
+
+    async def run():
+        async with make_client(max_concurrency=3) as client:
+            await client.login(devpi.user, "123")
+            await asyncio.gather(*(
+                create_and_submit(client, i) for i in range(5)))
+        async with make_client(max_concurrency=3) as client:
+            await client.login(devpi.target, "123")
+            prs = await client.list_prs(target, state="pending", limit=2)
+            assert sorted(
+                "%s/%s" % (user, pr["name"])
+                for user, user_prs in prs["pending"].items()
+                for pr in user_prs) == names
+            await client.reject_pr(names[0], "Not this one")
+            return await asyncio.gather(*(
+                approve(client, name) for name in names[1:]))
+
+    assert asyncio.run(run()) == [[]] * 4
+    data = getjson(target)["result"]
+    assert data["projects"] == ["hello1", "hello2", "hello3", "hello4"]
+    data = getjson(names[0])["result"]
+    assert data["states"] == ["new", "pending", "rejected"]
+    with pytest.raises(ValueError):
+        getjson(names[1])
+
+
+def test_aio_errors(devpi, make_client):
+    from devpi_pr.aio import PRClientError
+    name = "%s/aio-errors" % devpi.user
+
+    async def run():
+        async with make_client() as client:
+            with pytest.raises(PRClientError) as e:
+                await client.pr_status("%s/missing" % devpi.user)
+            assert e.value.status_code == 404
+            await client.login(devpi.user, "123")
+            await client.new_pr(name, "%s/dev" % devpi.target)
+            with pytest.raises(PRClientError) as e:
+                await client.review_pr(name)
+            assert e.value.message == (
+                "The pull request '%s' is new, not pending." % name)
+            with pytest.raises(PRClientError) as e:
+                await client.submit_pr(name, "Please approve")
+            assert e.value.status_code == 400
+            await client.delete_pr(name)
+
+    asyncio.run(run())
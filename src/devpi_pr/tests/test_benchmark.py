@@ -0,0 +1,238 @@
+from devpi_common.metadata import parse_version
+import itertools
+import os
+import pytest
+import tracemalloc
+pytest.importorskip("pytest_benchmark")
+try:
+    from devpi_server import __version__ as _devpi_server_version
+    devpi_server_version = parse_version(_devpi_server_version)
+except ImportError:
+    pytestmark = pytest.mark.skip("No devpi-server installed")
+else:
+    if devpi_server_version < parse_version("6.9.3dev"):
+        from test_devpi_server.conftest import gentmp  # noqa
+        from test_devpi_server.conftest import httpget  # noqa
+        from test_devpi_server.conftest import makemapp  # noqa
+        from test_devpi_server.conftest import maketestapp  # noqa
+        from test_devpi_server.conftest import makexom
+        from test_devpi_server.conftest import mapp
+        from test_devpi_server.conftest import pypiurls  # noqa
+        from test_devpi_server.conftest import storage_info  # noqa
+        from test_devpi_server.conftest import testapp
+        (makexom, mapp, testapp)  # shut up pyflakes
+    else:
+        pytest_plugins = ["pytest_devpi_server", "test_devpi_server.plugin"]
+    pytestmark = pytest.mark.notransaction
+
+
+def get_peak_memory(func, *args, **kwargs):
+    """ Returns the peak of memory allocated by Python while calling func. """
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def store_releasefile(stage, project, version, filename, content):
+    kw = {}
+    try:
+        from devpi_server.filestore import get_hashes
+    except ImportError:
+        # devpi-server < 7 computes the hashes itself
+        pass
+    else:
+        kw = dict(hashes=get_hashes(content), size=len(content))
+    stage.store_releasefile(project, version, filename, content, **kw)
+
+
+@pytest.fixture
+def server_opts():
+    # measure the computation of the lists, not the response cache
+    return ["--pr-list-cache-size", "0"]
+
+
+@pytest.fixture
+def xom(request, makexom, server_opts):
+    import devpi_pr.server
+    xom = makexom(
+        opts=server_opts,
+        plugins=[(devpi_pr.server, None)])
+    return xom
+
+
+@pytest.fixture
+def targetindex(mapp):
+    mapp.create_and_login_user("targetuser")
+    return mapp.create_index(
+        "targetindex", indexconfig=dict(pull_requests_allowed=True))
+
+
+@pytest.fixture
+def make_pending_pr(mapp, targetindex, testapp):
+    mapp.create_user("pruser", "123")
+    counter = itertools.count()
+
+    def make_pending_pr(num_files, file_size):
+        mapp.login("pruser", "123")
+        name = "pr%d" % next(counter)
+        project = "pkg-%s" % name
+        api = mapp.create_index(
+            name,
+            indexconfig=dict(
+                type="pr",
+                states="new",
+                messages="New pull request",
+                bases=[targetindex.stagename]))
+        for i in range(num_files):
+            mapp.upload_file_pypi(
+                "%s-1.0-py%d-none-any.whl" % (project.replace('-', '_'), i),
+                os.urandom(file_size), project, "1.0",
+                set_whitelist=False)
+        r = testapp.patch_json(api.index, [
+            'states+=pending',
+            'messages+=Please approve'])
+        mapp.login("targetuser", "123")
+        return (api, r.headers['X-Devpi-Serial'])
+
+    return make_pending_pr
+
+
+@pytest.fixture
+def make_server(mapp, targetindex, xom):
+    """ Fills the server with ``num_users`` users and ``num_prs`` pending
+        pull requests for the target index with ``num_files`` files each.
+
+        The pull requests are distributed over the users, every user also
+        gets a regular index. The data is written with the model directly,
+        as creating it through the web API takes too long for large
+        numbers. """
+    from devpi_pr.server import write_transaction
+
+    def make_server(num_users, num_prs, num_files):
+        usernames = ["user%d" % i for i in range(num_users)]
+        with write_transaction(xom.keyfs):
+            for username in usernames:
+                user = xom.model.create_user(username, "123")
+                user.create_stage("dev")
+        for i in range(num_prs):
+            username = usernames[i % num_users]
+            name = "pr%d" % i
+            project = "pkg-%s" % name
+            with write_transaction(xom.keyfs):
+                user = xom.model.get_user(username)
+                stage = user.create_stage(
+                    name, type="pr", bases=(targetindex.stagename,),
+                    states=["new"], messages=["New pull request"],
+                    changers=[username])
+                stage.set_versiondata(dict(name=project, version="1.0"))
+                for j in range(num_files):
+                    store_releasefile(
+                        stage, project, "1.0",
+                        "%s-1.0-py%d-none-any.whl" % (
+                            project.replace('-', '_'), j),
+                        b"content%d" % j)
+                stage.modify(
+                    states=["new", "pending"],
+                    messages=["New pull request", "Please approve"],
+                    changers=[username, username])
+
+    return make_server
+
+
+server_sizes = pytest.mark.parametrize(
+    "num_users, num_prs, num_files", [
+        (10, 10, 1),
+        (100, 10, 1),
+        (10, 100, 1),
+        (10, 10, 25)],
+    ids=["10u-10pr-1f", "100u-10pr-1f", "10u-100pr-1f", "10u-10pr-25f"])
+
+
+@pytest.mark.parametrize(
+    "server_opts", [
+        ["--pr-approval-threads", "0"],
+        ["--pr-approval-threads", "4"],
+        ["--pr-hard-links"]],
+    ids=["serial", "threads", "hard_links"])
+@pytest.mark.parametrize("num_files", [1, 10, 25])
+@pytest.mark.parametrize(
+    "file_size", [1024, 1024 * 1024], ids=["1KB", "1MB"])
+def test_approval(benchmark, file_size, make_pending_pr, num_files, testapp):
+    def setup():
+        (api, serial) = make_pending_pr(num_files, file_size)
+        return ((api, serial), {})
+
+    def approve(api, serial):
+        testapp.patch_json(api.index, [
+            'states+=approved',
+            'messages+=Approve'], headers={'X-Devpi-PR-Serial': serial})
+
+    benchmark.extra_info["num_files"] = num_files
+    benchmark.extra_info["file_size"] = file_size
+    benchmark.extra_info["peak_memory"] = get_peak_memory(
+        approve, *make_pending_pr(num_files, file_size))
+    benchmark.pedantic(approve, setup=setup, rounds=3)
+
+
+@server_sizes
+@pytest.mark.parametrize("summary", ["cold", "warm"])
+def test_index_pr_list(benchmark, make_server, num_files, num_prs, num_users, summary, targetindex, testapp, xom):
+    make_server(num_users, num_prs, num_files)
+
+    def setup():
+        if summary == "cold":
+            xom.devpi_pr_summary.entries.clear()
+        return ((), {})
+
+    def get_pr_list():
+        r = testapp.get_json(targetindex.index + "/+pr-list")
+        assert len(r.json["result"]["pending"]) == min(num_users, num_prs)
+
+    setup()
+    benchmark.extra_info["peak_memory"] = get_peak_memory(get_pr_list)
+    benchmark.pedantic(get_pr_list, setup=setup, rounds=5)
+
+
+@server_sizes
+def test_user_pr_list(benchmark, make_server, num_files, num_prs, num_users, testapp):
+    make_server(num_users, num_prs, num_files)
+
+    def get_pr_list():
+        r = testapp.get_json("/user0/+pr-list")
+        assert r.json["result"]["pending"]
+
+    benchmark.extra_info["peak_memory"] = get_peak_memory(get_pr_list)
+    benchmark.pedantic(get_pr_list, rounds=5)
+
+
+@pytest.mark.parametrize("num_files", [1, 100])
+@pytest.mark.parametrize("num_projects", [1, 100])
+def test_is_stage_empty(benchmark, num_files, num_projects, xom):
+    from devpi_pr.server import get_file_count
+    from devpi_pr.server import is_stage_empty
+    from devpi_pr.server import write_transaction
+
+    with write_transaction(xom.keyfs):
+        user = xom.model.create_user("pruser", "123")
+        stage = user.create_stage("dev")
+        # only the last project has files, the other ones are empty
+        # like after removing their releases
+        for i in range(num_projects):
+            project = "pkg%d" % i
+            stage.set_versiondata(dict(name=project, version="1.0"))
+        for j in range(num_files):
+            store_releasefile(
+                stage, project, "1.0",
+                "%s-1.0-py%d-none-any.whl" % (project, j), b"content%d" % j)
+
+    def check():
+        with xom.keyfs.read_transaction():
+            stage = xom.model.getstage("pruser/dev")
+            assert not is_stage_empty(stage)
+            assert get_file_count(stage) == num_files
+
+    benchmark.extra_info["peak_memory"] = get_peak_memory(check)
+    benchmark.pedantic(check, rounds=5)
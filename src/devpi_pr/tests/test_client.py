@@ -39,46 +39,102 @@ def devpi_pr_data_dir(monkeypatch, tmpdir):
 
 def test_devpi_pr_review_data_initial(devpi_pr_data_dir, hub):
     from devpi_pr.client import devpi_pr_review_data
-    path = devpi_pr_data_dir.join("reviews.json")
+    path = devpi_pr_data_dir.join("reviews.sqlite")
     assert not path.exists()
     with devpi_pr_review_data(hub) as data:
-        assert data == {}
+        assert dict(data) == {}
     assert path.exists()
 
 
-def test_devpi_pr_review_data_lock(devpi_pr_data_dir, hub):
+def test_devpi_pr_review_data_lock(devpi_pr_data_dir, hub, monkeypatch):
     from devpi_pr.client import devpi_pr_review_data
-    lock_path = devpi_pr_data_dir.join("reviews.lock")
-    path = devpi_pr_data_dir.join("reviews.json")
-    assert not path.exists()
+    monkeypatch.setattr("devpi_pr.client.devpi_pr_review_timeout", 0.1)
     with devpi_pr_review_data(hub):
-        assert lock_path.exists()
-        assert not path.exists()
         with pytest.raises(SystemExit):
             with devpi_pr_review_data(hub):
                 pass
 
 
-def test_devpi_pr_review_data_no_change(devpi_pr_data_dir, hub):
+def test_devpi_pr_review_data_waits_for_lock(devpi_pr_data_dir, hub):
     from devpi_pr.client import devpi_pr_review_data
-    path = devpi_pr_data_dir.join("reviews.json")
-    assert not path.exists()
+    import threading
+    import time
+    locked = threading.Event()
+
+    def other_command():
+        with devpi_pr_review_data(hub) as data:
+            locked.set()
+            time.sleep(0.2)
+            data['foo'] = 1
+
+    thread = threading.Thread(target=other_command)
+    thread.start()
+    locked.wait()
     with devpi_pr_review_data(hub) as data:
-        assert data == {}
-    assert path.exists()
-    mtime = path.stat().mtime
+        assert dict(data) == {'foo': 1}
+        data['foo'] += 1
+    thread.join()
     with devpi_pr_review_data(hub) as data:
-        assert data == {}
-    assert mtime == path.stat().mtime
+        assert dict(data) == {'foo': 2}
 
 
-def test_devpi_pr_review_data_change_persistet(devpi_pr_data_dir, hub):
+def test_devpi_pr_review_data_change_persisted(devpi_pr_data_dir, hub):
+    from devpi_pr.client import devpi_pr_review_data
+    with devpi_pr_review_data(hub) as data:
+        assert dict(data) == {}
+        data['foo'] = 10
+        data['bar'] = 20
+    with devpi_pr_review_data(hub) as data:
+        assert dict(data) == {'bar': 20, 'foo': 10}
+        assert 'foo' in data
+        assert 'ham' not in data
+        del data['foo']
+        assert data.pop('ham', None) is None
+    with devpi_pr_review_data(hub) as data:
+        assert dict(data) == {'bar': 20}
+
+
+def test_devpi_pr_review_data_rollback(devpi_pr_data_dir, hub):
+    from devpi_pr.client import devpi_pr_review_data
+    with pytest.raises(SystemExit):
+        with devpi_pr_review_data(hub) as data:
+            data['foo'] = 10
+            hub.fatal("error")
+    with devpi_pr_review_data(hub) as data:
+        assert dict(data) == {}
+
+
+def test_devpi_pr_review_data_migration(devpi_pr_data_dir, hub):
     from devpi_pr.client import devpi_pr_review_data
     path = devpi_pr_data_dir.join("reviews.json")
+    path.write_text('{"user/foo": 10, "user/bar": 20}', "utf-8")
+    with devpi_pr_review_data(hub) as data:
+        assert dict(data) == {'user/bar': 20, 'user/foo': 10}
     assert not path.exists()
+    assert devpi_pr_data_dir.join("reviews.json.migrated").exists()
+
+
+def test_get_devpi_pr_review_data(devpi_pr_data_dir, hub):
+    from devpi_pr.client import devpi_pr_review_data
+    from devpi_pr.client import get_devpi_pr_review_data
+    assert get_devpi_pr_review_data(hub) == {}
     with devpi_pr_review_data(hub) as data:
-        assert data == {}
-        data['foo'] = 'bar'
-    assert path.exists()
+        data['foo'] = 10
+    assert get_devpi_pr_review_data(hub) == {'foo': 10}
+    # readers aren't blocked by a running transaction
     with devpi_pr_review_data(hub) as data:
-        assert data == {'foo': 'bar'}
+        data['foo'] = 20
+        assert get_devpi_pr_review_data(hub) == {'foo': 10}
+    assert get_devpi_pr_review_data(hub) == {'foo': 20}
+
+
+@pytest.mark.parametrize("hidden_states, include_messages, expected", [
+    (set(), False, "fields=name%2Cbase%2Clast_serial"),
+    (set(["approved"]), False,
+     "fields=name%2Cbase%2Clast_serial&state=new%2Cpending%2Crejected"),
+    (set(["approved", "new"]), True,
+     "fields=name%2Cbase%2Clast_serial%2Cstates%2Cby%2Cmessages"
+     "&state=pending%2Crejected")])
+def test_get_pr_list_query(expected, hidden_states, include_messages):
+    from devpi_pr.client import get_pr_list_query
+    assert get_pr_list_query(hidden_states, include_messages) == expected
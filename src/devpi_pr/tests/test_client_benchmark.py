@@ -0,0 +1,46 @@
+import pytest
+pytest.importorskip("pytest_benchmark")
+try:
+    import devpi.main  # noqa
+except ImportError:
+    pytestmark = pytest.mark.skip("No devpi-client installed")
+
+
+def make_pr_data(num_prs, num_users=50, states=("new", "pending", "rejected")):
+    result = {}
+    for i in range(num_prs):
+        state = states[i % len(states)]
+        user = "user%d" % (i % num_users)
+        result.setdefault(state, {}).setdefault(user, []).append(dict(
+            name="pr%d" % i,
+            base="target/index",
+            last_serial=i,
+            states=["new", "pending"],
+            by=[user, user],
+            messages=["New pull request", "Please approve"]))
+    return result
+
+
+@pytest.mark.parametrize("num_prs", [1000, 5000])
+def test_merge_pr_data(benchmark, num_prs):
+    from devpi_pr.client import merge_pr_data
+    index_data = make_pr_data(num_prs)
+    # the user list overlaps with the index list
+    user_data = dict(new=index_data["new"])
+    result = benchmark(merge_pr_data, index_data, user_data)
+    assert sum(
+        len(prs)
+        for users_prs in result.values()
+        for prs in users_prs.values()) == num_prs
+
+
+@pytest.mark.parametrize("include_messages", [False, True])
+@pytest.mark.parametrize("num_prs", [1000, 5000])
+def test_create_pr_list_output(benchmark, include_messages, num_prs):
+    from devpi_pr.client import create_pr_list_output
+    users_prs = make_pr_data(num_prs, states=("pending",))["pending"]
+    review_data = dict(
+        ("user%d/pr%d" % (i % 50, i), i) for i in range(0, num_prs, 10))
+    out = benchmark(
+        create_pr_list_output, users_prs, review_data, include_messages)
+    assert out.count("(reviewing)") == len(review_data)
@@ -26,14 +26,18 @@ def devpi_pr_data_dir(monkeypatch, tmpdir):
 
 
 @pytest.fixture
-def get_review_json(devpi_pr_data_dir):
-    import json
+def get_review_data(devpi_pr_data_dir):
+    import sqlite3
 
-    def get_review_json():
-        return json.loads(
-            devpi_pr_data_dir.join("reviews.json").read_text("utf-8"))
+    def get_review_data():
+        path = devpi_pr_data_dir.join("reviews.sqlite")
+        conn = sqlite3.connect(path.strpath)
+        try:
+            return dict(conn.execute("SELECT name, serial FROM reviews"))
+        finally:
+            conn.close()
 
-    return get_review_json
+    return get_review_data
 
 
 def test_manual_index_creation(capfd, devpi, getjson, makepkg):
@@ -104,7 +108,7 @@ def test_index_creation(capfd, devpi, getjson, makepkg):
 @pytest.mark.parametrize(
     "use_review_cmd", (True, False),
     ids=["using_review_pr", "using_serial_arg"])
-def test_approval(capfd, devpi, get_review_json, getjson, keep_index, makepkg, use_review_cmd):
+def test_approval(capfd, devpi, get_review_data, getjson, keep_index, makepkg, use_review_cmd):
     devpi(
         "new-pr",
         "20180717",
@@ -139,7 +143,7 @@ def test_approval(capfd, devpi, get_review_json, getjson, keep_index, makepkg, u
             code=200)
         (out, err) = capfd.readouterr()
         assert "Started review of '%s/20180717' at serial" % devpi.user in out
-        assert list(get_review_json()) == ['%s/20180717' % devpi.user]
+        assert list(get_review_data()) == ['%s/20180717' % devpi.user]
     else:
         serial = lines[-1].split()[-1]
     args = [
@@ -160,7 +164,7 @@ def test_approval(capfd, devpi, get_review_json, getjson, keep_index, makepkg, u
     else:
         devpi(*args, code=201)
     if use_review_cmd:
-        assert get_review_json() == {}
+        assert get_review_data() == {}
     data = getjson("%s/dev" % devpi.target)["result"]
     assert data['projects'] == ['hello']
     data = getjson("%s/dev/hello" % devpi.target)["result"]
@@ -186,7 +190,231 @@ def test_approval(capfd, devpi, get_review_json, getjson, keep_index, makepkg, u
         'who': '%s' % devpi.target}
 
 
-def test_abort_review(capfd, devpi, get_review_json, makepkg):
+def test_approval_wait(capfd, devpi, get_review_data, getjson, makepkg, monkeypatch):
+    import devpi_pr.client
+    monkeypatch.setattr(devpi_pr.client, "approval_poll_interval", 0.1)
+    devpi(
+        "new-pr",
+        "20180717",
+        "%s/dev" % devpi.target,
+        code=200)
+    for name in ("hello", "world", "spam"):
+        pkg = makepkg(
+            "%s-1.0.tar.gz" % name, b"content", name, "1.0")
+        devpi(
+            "upload",
+            "--index", "20180717",
+            pkg.strpath)
+    devpi(
+        "submit-pr",
+        "20180717",
+        "-m", "Please accept these updated packages",
+        code=200)
+    devpi("login", devpi.target, "--password", "123")
+    devpi("use", "dev")
+    devpi(
+        "review-pr",
+        "%s/20180717" % devpi.user,
+        code=200)
+    (out, err) = capfd.readouterr()
+    devpi(
+        "approve-pr",
+        "%s/20180717" % devpi.user,
+        "-m", "The pull request was accepted",
+        "--wait",
+        code=200)
+    (out, err) = capfd.readouterr()
+    assert "copied 3 of 3 files" in out
+    assert get_review_data() == {}
+    data = getjson("%s/dev" % devpi.target)["result"]
+    assert sorted(data['projects']) == ['hello', 'spam', 'world']
+    with pytest.raises(ValueError):
+        getjson("20180717")
+
+
+def test_approval_incremental(capfd, devpi, getjson, makepkg):
+    pkg = makepkg("hello-1.0.tar.gz", b"content1", "hello", "1.0")
+    for name in ("20180717", "20180718"):
+        devpi(
+            "new-pr",
+            name,
+            "%s/dev" % devpi.target,
+            code=200)
+        devpi(
+            "upload",
+            "--index", name,
+            pkg.strpath)
+        devpi(
+            "submit-pr",
+            name,
+            "-m", "Please accept these updated packages",
+            code=200)
+    devpi("login", devpi.target, "--password", "123")
+    devpi("use", "dev")
+    for name in ("20180717", "20180718"):
+        devpi(
+            "review-pr",
+            "%s/%s" % (devpi.user, name),
+            code=200)
+        (out, err) = capfd.readouterr()
+        devpi(
+            "approve-pr",
+            "%s/%s" % (devpi.user, name),
+            "-m", "The pull request was accepted",
+            "--incremental",
+            code=201)
+        (out, err) = capfd.readouterr()
+    assert (
+        "skipped 1 files already in the target index: "
+        "hello-1.0.tar.gz") in out
+    data = getjson("%s/dev/hello" % devpi.target)["result"]
+    (link,) = data['1.0']['+links']
+    assert [x['src'] for x in link['log'] if x['what'] == 'push'] == [
+        "%s/20180717" % devpi.user]
+
+
+def test_approval_dry_run(capfd, devpi, get_review_data, getjson, makepkg):
+    pkg = makepkg("hello-1.0.tar.gz", b"content1", "hello", "1.0")
+    for name in ("20180717", "20180718"):
+        devpi(
+            "new-pr",
+            name,
+            "%s/dev" % devpi.target,
+            code=200)
+        devpi(
+            "upload",
+            "--index", name,
+            pkg.strpath)
+        devpi(
+            "submit-pr",
+            name,
+            "-m", "Please accept these updated packages",
+            code=200)
+    devpi("login", devpi.target, "--password", "123")
+    devpi("use", "dev")
+    devpi("index", "dev", "volatile=False")
+    names = ["%s/%s" % (devpi.user, x) for x in ("20180717", "20180718")]
+    for name in names:
+        devpi("review-pr", name, code=200)
+    (out, err) = capfd.readouterr()
+    devpi("approve-pr", names[0], "--dry-run", code=200)
+    (out, err) = capfd.readouterr()
+    assert "%s: would copy 1 files" % names[0] in out
+    assert "to %s/dev" % devpi.target in out
+    data = getjson("%s/dev" % devpi.target)["result"]
+    assert data['projects'] == []
+    assert sorted(get_review_data()) == names
+    devpi(
+        "approve-pr",
+        names[0],
+        "-m", "The pull request was accepted",
+        code=201)
+    (out, err) = capfd.readouterr()
+    devpi("approve-pr", names[1], "--dry-run")
+    (out, err) = capfd.readouterr()
+    assert (
+        "%s: hello-1.0.tar.gz already exists in non-volatile index" % (
+            names[1])) in out
+    assert "1 of 1 pull requests can't be approved." in out
+    devpi("approve-pr", names[1], "--dry-run", "--incremental", code=200)
+    (out, err) = capfd.readouterr()
+    assert "%s: would copy 0 files" % names[1] in out
+    assert (
+        "skipped 1 files already in the target index: "
+        "hello-1.0.tar.gz") in out
+    assert list(get_review_data()) == [names[1]]
+
+
+def test_batch_approval(capfd, devpi, get_review_data, getjson, makepkg):
+    names = ["20200301", "20200302", "20200303"]
+    for i, name in enumerate(names):
+        devpi(
+            "new-pr",
+            name,
+            "%s/dev" % devpi.target,
+            code=200)
+        pkg = makepkg(
+            "pkg%d-1.0.tar.gz" % i, b"content", "pkg%d" % i, "1.0")
+        devpi(
+            "upload",
+            "--index", name,
+            pkg.strpath)
+        devpi(
+            "submit-pr",
+            name,
+            "-m", "Please accept",
+            code=200)
+    # login as target user
+    devpi("login", devpi.target, "--password", "123")
+    devpi("use", "dev")
+    for name in names[:2]:
+        devpi(
+            "review-pr",
+            "%s/%s" % (devpi.user, name),
+            code=200)
+    (out, err) = capfd.readouterr()
+    devpi(
+        "approve-pr",
+        "--all-reviewed",
+        "-m", "Release",
+        code=200)
+    (out, err) = capfd.readouterr()
+    assert "%s/20200301: approved" % devpi.user in out
+    assert "%s/20200302: approved" % devpi.user in out
+    assert get_review_data() == {}
+    data = getjson("%s/dev" % devpi.target)["result"]
+    assert data['projects'] == ['pkg0', 'pkg1']
+    # the not reviewed pull request isn't approved without serial
+    devpi(
+        "approve-pr",
+        "%s/20200303" % devpi.user,
+        "%s/20200304" % devpi.user,
+        "-m", "Release")
+    (out, err) = capfd.readouterr()
+    assert "No review data found for '%s/20200303', '%s/20200304'" % (
+        devpi.user, devpi.user) in out
+
+
+def test_batch_reject(capfd, devpi, getjson, makepkg):
+    names = ["20200401", "20200402"]
+    for i, name in enumerate(names):
+        devpi(
+            "new-pr",
+            name,
+            "%s/dev" % devpi.target,
+            code=200)
+        pkg = makepkg(
+            "pkg%d-1.0.tar.gz" % i, b"content", "pkg%d" % i, "1.0")
+        devpi(
+            "upload",
+            "--index", name,
+            pkg.strpath)
+        devpi(
+            "submit-pr",
+            name,
+            "-m", "Please accept",
+            code=200)
+    # login as target user
+    devpi("login", devpi.target, "--password", "123")
+    devpi("use", "dev")
+    (out, err) = capfd.readouterr()
+    devpi(
+        "reject-pr",
+        "%s/20200401" % devpi.user,
+        "%s/20200402" % devpi.user,
+        "%s/20200403" % devpi.user,
+        "-m", "Not now")
+    (out, err) = capfd.readouterr()
+    assert "%s/20200401: rejected" % devpi.user in out
+    assert "%s/20200402: rejected" % devpi.user in out
+    assert "%s/20200403: No pull request" % devpi.user in out
+    assert "Rejected 2 of 3 pull requests." in out
+    for name in names:
+        data = getjson(name)["result"]
+        assert data["states"] == ["new", "pending", "rejected"]
+
+
+def test_abort_review(capfd, devpi, get_review_data, makepkg):
     devpi(
         "new-pr",
         "20190528",
@@ -211,13 +439,13 @@ def test_abort_review(capfd, devpi, get_review_json, makepkg):
         code=200)
     (out, err) = capfd.readouterr()
     assert "Started review of '%s/20190528' at serial" % devpi.user in out
-    assert list(get_review_json()) == ['%s/20190528' % devpi.user]
+    assert list(get_review_data()) == ['%s/20190528' % devpi.user]
     devpi(
         "abort-pr-review",
         "%s/20190528" % devpi.user)
     (out, err) = capfd.readouterr()
     assert "Aborted review of '%s/20190528'" % devpi.user in out
-    assert get_review_json() == {}
+    assert get_review_data() == {}
     devpi(
         "abort-pr-review",
         "%s/20190528" % devpi.user)
@@ -225,7 +453,7 @@ def test_abort_review(capfd, devpi, get_review_json, makepkg):
     assert "No review of '%s/20190528' active" % devpi.user in out
 
 
-def test_double_review(capfd, devpi, get_review_json, makepkg):
+def test_double_review(capfd, devpi, get_review_data, makepkg):
     devpi(
         "new-pr",
         "20190527",
@@ -250,18 +478,18 @@ def test_double_review(capfd, devpi, get_review_json, makepkg):
         code=200)
     (out, err) = capfd.readouterr()
     assert "Started review of '%s/20190527' at serial" % devpi.user in out
-    first_serial = get_review_json()['%s/20190527' % devpi.user]
+    first_serial = get_review_data()['%s/20190527' % devpi.user]
     devpi(
         "review-pr",
         "%s/20190527" % devpi.user,
         code=200)
     (out, err) = capfd.readouterr()
     assert "Already reviewing '%s/20190527' at serial" % devpi.user in out
-    second_serial = get_review_json()['%s/20190527' % devpi.user]
+    second_serial = get_review_data()['%s/20190527' % devpi.user]
     assert first_serial == second_serial
 
 
-def test_review_update(capfd, devpi, get_review_json, getjson, makepkg):
+def test_review_update(capfd, devpi, get_review_data, getjson, makepkg):
     devpi(
         "new-pr",
         "20190529",
@@ -291,8 +519,8 @@ def test_review_update(capfd, devpi, get_review_json, getjson, makepkg):
         code=200)
     (out, err) = capfd.readouterr()
     assert "Started review of '%s/20190529' at serial" % devpi.user in out
-    assert list(get_review_json()) == ['%s/20190529' % devpi.user]
-    first_serial = get_review_json()['%s/20190529' % devpi.user]
+    assert list(get_review_data()) == ['%s/20190529' % devpi.user]
+    first_serial = get_review_data()['%s/20190529' % devpi.user]
     # login back in as source user
     devpi("login", devpi.user, "--password", "123")
     pkg2 = makepkg("pkg-1.0.tar.gz", b"content2", "pkg", "1.0")
@@ -322,8 +550,8 @@ def test_review_update(capfd, devpi, get_review_json, getjson, makepkg):
     (out, err) = capfd.readouterr()
     assert "Updated review of '%s/20190529' to serial %s" % (
         devpi.user, expected_serial) in out
-    assert list(get_review_json()) == ['%s/20190529' % devpi.user]
-    second_serial = get_review_json()['%s/20190529' % devpi.user]
+    assert list(get_review_data()) == ['%s/20190529' % devpi.user]
+    second_serial = get_review_data()['%s/20190529' % devpi.user]
     assert int(second_serial) > int(first_serial)
     devpi(
         "approve-pr",
@@ -365,6 +593,150 @@ def test_add_on_create(capfd, devpi, getjson, makepkg):
     assert "hello-1.0.tar.gz" in link["href"]
 
 
+@pytest.mark.parametrize("stdin", [False, True])
+def test_add_from_manifest(capfd, devpi, getjson, makepkg, monkeypatch, stdin, tmpdir):
+    import io
+    for i in range(5):
+        pkg = makepkg(
+            "hello%d-1.0.tar.gz" % i, b"content%d" % i, "hello%d" % i, "1.0")
+        devpi("upload", "--index", "dev", pkg.strpath)
+    manifest = "\n".join([
+        "# release train",
+        "hello1==1.0",
+        "",
+        "  hello2==1.0  ",
+        "hello3==1.0",
+        "hello4==1.0"])
+    if stdin:
+        monkeypatch.setattr("sys.stdin", io.StringIO(manifest))
+        path = "-"
+    else:
+        path = tmpdir.join("manifest.txt")
+        path.write(manifest)
+    (out, err) = capfd.readouterr()
+    devpi(
+        "new-pr",
+        "20190128",
+        "%s/dev" % devpi.target,
+        "hello0==1.0",
+        "--manifest", path,
+        "--push-threads", "3",
+        code=200)
+    (out, err) = capfd.readouterr()
+    assert "pushed 5 of 5 releases in" in out
+    for i in range(5):
+        assert re.search(r"\d+\.\d+s hello%d==1.0\n" % i, out)
+    data = getjson("/%s/20190128" % devpi.user)["result"]
+    assert data["projects"] == ["hello%d" % i for i in range(5)]
+    for i in range(5):
+        data = getjson("/%s/20190128/hello%d" % (devpi.user, i))["result"]
+        assert list(data.keys()) == ["1.0"]
+
+
+def test_add_from_manifest_missing_release(capfd, devpi, getjson, makepkg, tmpdir):
+    pkg = makepkg("hello-1.0.tar.gz", b"content1", "hello", "1.0")
+    devpi("upload", "--index", "dev", pkg.strpath)
+    path = tmpdir.join("manifest.txt")
+    path.write("hello==1.0\nhello==2.0\n")
+    (out, err) = capfd.readouterr()
+    devpi(
+        "new-pr",
+        "20190128",
+        "%s/dev" % devpi.target,
+        "--manifest", path)
+    (out, err) = capfd.readouterr()
+    assert "pushed 1 of 2 releases in" in out
+    assert "Failed to push hello==2.0 (400)" in out
+    data = getjson("/%s/20190128" % devpi.user)["result"]
+    assert data["projects"] == ["hello"]
+
+
+def test_add_by_reference(capfd, devpi, getjson, makepkg):
+    for version in ("1.0", "2.0"):
+        pkg = makepkg(
+            "hello-%s.tar.gz" % version, b"content" + version.encode(),
+            "hello", version)
+        devpi("upload", "--index", "dev", pkg.strpath)
+    (out, err) = capfd.readouterr()
+    devpi(
+        "new-pr",
+        "20190128",
+        "%s/dev" % devpi.target,
+        "hello==1.0",
+        "--reference",
+        code=200)
+    (out, err) = capfd.readouterr()
+    assert "added 1 releases of %s/dev as references" % devpi.user in out
+    data = getjson("/%s/20190128" % devpi.user)["result"]
+    assert data["projects"] == []
+    assert data["source_releases"] == ["%s/dev/hello/1.0" % devpi.user]
+    devpi(
+        "submit-pr",
+        "20190128",
+        "-m", "Please accept",
+        code=200)
+    devpi("login", devpi.target, "--password", "123")
+    devpi("use", "dev")
+    devpi("review-pr", "%s/20190128" % devpi.user, code=200)
+    (out, err) = capfd.readouterr()
+    devpi(
+        "approve-pr",
+        "%s/20190128" % devpi.user,
+        "-m", "The pull request was accepted",
+        code=201)
+    data = getjson("%s/dev" % devpi.target)["result"]
+    assert data["projects"] == ["hello"]
+    data = getjson("%s/dev/hello" % devpi.target)["result"]
+    assert list(data.keys()) == ["1.0"]
+    (link,) = data["1.0"]["+links"]
+    assert "hello-1.0.tar.gz" in link["href"]
+    push = link["log"][-1]
+    assert push["src"] == "%s/dev" % devpi.user
+    assert push["dst"] == "%s/dev" % devpi.target
+
+
+def test_add_by_reference_changed_source(capfd, devpi, getjson, makepkg):
+    pkg = makepkg("hello-1.0.tar.gz", b"content1", "hello", "1.0")
+    devpi("upload", "--index", "dev", pkg.strpath)
+    devpi(
+        "new-pr",
+        "20190128",
+        "%s/dev" % devpi.target,
+        "hello==2.0",
+        "--reference",
+        code=400)
+    devpi(
+        "new-pr",
+        "20190128",
+        "%s/dev" % devpi.target,
+        "hello==1.0",
+        "--reference",
+        code=200)
+    devpi(
+        "submit-pr",
+        "20190128",
+        "-m", "Please accept",
+        code=200)
+    devpi("login", devpi.target, "--password", "123")
+    devpi("use", "dev")
+    devpi("review-pr", "%s/20190128" % devpi.user, code=200)
+    # the referenced project changes after the review
+    devpi("login", devpi.user, "--password", "123")
+    pkg = makepkg("hello-1.0.zip", b"content2", "hello", "1.0")
+    devpi("upload", "--index", "%s/dev" % devpi.user, pkg.strpath)
+    devpi("login", devpi.target, "--password", "123")
+    (out, err) = capfd.readouterr()
+    devpi(
+        "approve-pr",
+        "%s/20190128" % devpi.user,
+        "-m", "The pull request was accepted",
+        code=400)
+    (out, err) = capfd.readouterr()
+    assert "got X-Devpi-PR-Serial" in out
+    data = getjson("%s/dev" % devpi.target)["result"]
+    assert data["projects"] == []
+
+
 def test_reject(capfd, devpi, getjson, makepkg):
     pkg = makepkg("hello-1.0.tar.gz", b"content1", "hello", "1.0")
     devpi(
@@ -582,6 +954,175 @@ def test_pr_listing(capfd, devpi, getjson, makepkg):
     assert "Please review" in out
 
 
+def test_pr_listing_timings(capfd, devpi, makepkg):
+    devpi(
+        "new-pr",
+        "20200101",
+        "%s/dev" % devpi.target,
+        code=200)
+    (out, err) = capfd.readouterr()
+    devpi(
+        "list-prs", "-a", "--timings",
+        code=200)
+    (out, err) = capfd.readouterr()
+    assert "new pull requests" in out
+    assert "%s/20200101" % devpi.user in out
+    (timings,) = re.findall(r"timings:\n((?:\s+.*\n)+)", out)
+    names = [x.split(None, 1)[1] for x in timings.splitlines()]
+    assert len([x for x in names if x.endswith("/dev")]) == 1
+    assert len([x for x in names if "+pr-list" in x]) == 2
+    assert names[-1] == "total"
+
+
+def test_pr_listing_missing_index(capfd, devpi):
+    hub = devpi(
+        "list-prs", "%s/missing" % devpi.user,
+        code=-2)
+    assert hub.sysex.code == 1
+    (out, err) = capfd.readouterr()
+    lines = [x for x in (out + err).splitlines() if "404" in x]
+    # reported once from the main thread
+    assert len(lines) == 1
+    assert "/%s/missing" % devpi.user in out + err
+
+
+def test_pr_listing_watch(capfd, devpi, monkeypatch):
+    import devpi_pr.client
+    devpi(
+        "new-pr",
+        "20200101",
+        "%s/dev" % devpi.user,
+        code=200)
+    (out, err) = capfd.readouterr()
+    wait_for_pr_events = devpi_pr.client.wait_for_pr_events
+    calls = []
+
+    def wait(hub, args, serial, timeout):
+        calls.append((serial, timeout))
+        if len(calls) == 2:
+            devpi(
+                "new-pr",
+                "20200102",
+                "%s/dev" % devpi.user,
+                code=200)
+        elif len(calls) == 4:
+            raise KeyboardInterrupt
+        return wait_for_pr_events(hub, args, serial, timeout)
+
+    monkeypatch.setattr(devpi_pr.client, "pr_watch_timeout", 1)
+    monkeypatch.setattr(devpi_pr.client, "wait_for_pr_events", wait)
+    devpi("list-prs", "-a", "--watch", "--timings")
+    (out, err) = capfd.readouterr()
+    # the list is output again after the new pull request was created,
+    # but not after the last timeout without changes
+    outputs = out.split("current devpi index")[1:]
+    assert len(outputs) == 2
+    assert "%s/20200101" % devpi.user in outputs[0]
+    assert "%s/20200102" % devpi.user not in outputs[0]
+    assert "%s/20200102" % devpi.user in outputs[1]
+    assert calls[0] == (None, 0)
+    assert calls[1][0] is not None
+    assert calls[2][0] > calls[1][0]
+    # the index config is only fetched once
+    (timings,) = re.findall(r"timings:\n((?:\s+.*\n)+)", outputs[1])
+    names = [x.split(None, 1)[1] for x in timings.splitlines()]
+    assert [x for x in names if x.endswith("/dev")] == []
+
+
+def test_pr_events_waiters_dont_block(devpi, getjson, url_of_liveserver):
+    from concurrent.futures import ThreadPoolExecutor
+    import requests
+    import time
+    url = url_of_liveserver.joinpath(
+        "%s/dev/+pr-events" % devpi.target).url
+    serial = getjson("%s/dev/+pr-events" % devpi.target)["result"]["serial"]
+
+    def wait():
+        r = requests.get(
+            url, params=dict(serial=serial, timeout=20),
+            headers={"Accept": "application/json"})
+        return r.json()["result"]
+
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        futures = [executor.submit(wait) for i in range(5)]
+        time.sleep(0.5)
+        # the waiting consumers don't hold up other requests
+        start = time.monotonic()
+        assert getjson("%s/dev" % devpi.target)["result"]["pull_requests_allowed"]
+        devpi(
+            "new-pr",
+            "20200601",
+            "%s/dev" % devpi.target,
+            code=200)
+        assert time.monotonic() - start < 10
+        results = [x.result(timeout=30) for x in futures]
+    for result in results:
+        assert [(x["event"], x["name"]) for x in result["events"]] == [
+            ("create", "%s/20200601" % devpi.user)]
+
+
+def test_review_not_pending(capfd, devpi):
+    devpi(
+        "new-pr",
+        "20200501",
+        "%s/dev" % devpi.target,
+        code=200)
+    devpi("login", devpi.target, "--password", "123")
+    devpi("use", "dev")
+    (out, err) = capfd.readouterr()
+    devpi("review-pr", "%s/20200501" % devpi.user)
+    (out, err) = capfd.readouterr()
+    last_line = out.splitlines()[-1].strip()
+    assert last_line == (
+        "The pull request '%s/20200501' is new, not pending." % devpi.user)
+
+
+def test_review_without_pr_status(capfd, devpi, getjson, makepkg, monkeypatch):
+    from devpi.main import Hub
+    http_api = Hub.http_api
+    status_urls = []
+
+    def old_server_http_api(self, method, url, *args, **kwargs):
+        if str(url).endswith("/+pr-status"):
+            # like a server without the endpoint
+            status_urls.append(url)
+            url = str(url) + "-missing"
+        return http_api(self, method, url, *args, **kwargs)
+
+    monkeypatch.setattr(Hub, "http_api", old_server_http_api)
+    for name in ("20200501", "20200502"):
+        devpi(
+            "new-pr",
+            name,
+            "%s/dev" % devpi.target,
+            code=200)
+    pkg = makepkg("hello-1.0.tar.gz", b"content1", "hello", "1.0")
+    devpi("upload", "--index", "20200501", pkg.strpath)
+    devpi(
+        "submit-pr",
+        "20200501",
+        "-m", "Please accept these updated packages",
+        code=200)
+    devpi("login", devpi.target, "--password", "123")
+    devpi("use", "dev")
+    (out, err) = capfd.readouterr()
+    devpi("review-pr", "%s/20200502" % devpi.user)
+    (out, err) = capfd.readouterr()
+    assert out.splitlines()[-1].strip() == (
+        "The pull request '%s/20200502' is new, not pending." % devpi.user)
+    devpi("review-pr", "%s/20200501" % devpi.user, code=200)
+    (out, err) = capfd.readouterr()
+    assert "Started review of '%s/20200501' at serial" % devpi.user in out
+    devpi(
+        "approve-pr",
+        "%s/20200501" % devpi.user,
+        "-m", "The pull request was accepted",
+        code=201)
+    assert len(status_urls) == 2
+    data = getjson("%s/dev" % devpi.target)["result"]
+    assert data['projects'] == ['hello']
+
+
 def test_index_not_found(capfd, devpi):
     devpi("approve-pr", "nonexisting", "--serial", "10", "-m", "msg", code=404)
     (out, err) = capfd.readouterr()
@@ -599,6 +1140,10 @@ def test_index_not_found(capfd, devpi):
     (out, err) = capfd.readouterr()
     last_line = out.splitlines()[-1].strip()
     assert last_line == "Couldn't access pr index 'nonexisting': Not Found"
+    devpi("review-pr", "nonexisting", code=404)
+    (out, err) = capfd.readouterr()
+    last_line = out.splitlines()[-1].strip()
+    assert last_line == "Couldn't access pr index 'nonexisting': Not Found"
     devpi("delete-pr", "nonexisting", code=404)
     (out, err) = capfd.readouterr()
     last_line = out.splitlines()[-1].strip()
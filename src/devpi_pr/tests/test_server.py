@@ -1,5 +1,7 @@
 from devpi_common.metadata import parse_version
+import json
 import pytest
+import time
 try:
     from devpi_server import __version__ as _devpi_server_version
     devpi_server_version = parse_version(_devpi_server_version)
@@ -78,6 +80,14 @@ def test_new_pr_index(new_prindex, targetindex, testapp):
     assert result['states'] == ['new']
 
 
+def test_new_pr_index_without_bases(mapp, testapp):
+    mapp.create_and_login_user("pruser")
+    r = testapp.put_json("/pruser/index", dict(
+        type="pr", states="new", messages="New pull request", bases=[]))
+    assert r.status_code == 200
+    assert r.json['result']['bases'] == []
+
+
 def test_submit_pr_index_not_allowed(mapp, new_prindex, targetindex, testapp):
     # first turn off pull_requests_allowed
     mapp.login(targetindex.stagename.split('/')[0], "123")
@@ -103,6 +113,14 @@ def test_submit_empty_pr_index(new_prindex, targetindex, testapp):
     assert r.json["message"] == "The pr index has no packages"
 
 
+def test_submit_pr_index_without_files(mapp, new_prindex, targetindex, testapp):
+    mapp.set_versiondata(dict(name="hello", version="1.0"), set_whitelist=False)
+    r = testapp.patch_json(new_prindex.index, [
+        'states+=pending',
+        'messages+=Please approve'], expect_errors=True)
+    assert r.json["message"] == "The pr index has no packages"
+
+
 def test_submit_pr_index(mapp, new_prindex, targetindex, testapp):
     content1 = mapp.makepkg("pkg-1.0.tar.gz", b"content1", "pkg", "1.0")
     mapp.upload_file_pypi(
@@ -120,6 +138,53 @@ def test_submit_pr_index(mapp, new_prindex, targetindex, testapp):
     assert result['states'] == ['new', 'pending']
 
 
+def test_source_releases(mapp, new_prindex, targetindex, testapp):
+    api = mapp.create_index("dev")
+    content1 = mapp.makepkg("pkg-1.0.tar.gz", b"content1", "pkg", "1.0")
+    mapp.upload_file_pypi(
+        "pkg-1.0.tar.gz", content1, "pkg", "1.0",
+        set_whitelist=False, indexname=api.stagename)
+    indexconfig = dict(
+        type="pr",
+        states=["new"],
+        messages=["New pull request"],
+        bases=[targetindex.stagename])
+    r = testapp.put_json("/pruser/refs", dict(
+        indexconfig,
+        source_releases=["pruser/dev/pkg", "pruser/dev/pkg/2.0"]),
+        expect_errors=True)
+    assert r.status_code == 400
+    assert r.json["message"] == (
+        "Invalid source release 'pruser/dev/pkg', it needs to be of this "
+        "form: USER/INDEX/NAME/VERSION, "
+        "The source release 'pruser/dev/pkg/2.0' doesn't exist")
+    testapp.put_json("/pruser/refs", dict(
+        indexconfig, source_releases=["pruser/dev/pkg/1.0"]))
+    r = testapp.get_json("/pruser/refs/+pr-status")
+    assert r.json["result"]["files"] == 1
+    testapp.patch_json("/pruser/refs", [
+        'states+=pending',
+        'messages+=Please approve'])
+    r = testapp.get_json("/pruser/refs/+pr-status")
+    serial = r.json["result"]["last_serial"]
+    r = testapp.patch_json(
+        "/pruser/refs", ['source_releases-=pruser/dev/pkg/1.0'],
+        expect_errors=True)
+    assert r.json["message"] == (
+        "The pr index has no packages, "
+        "The source releases can only be changed while the pull request "
+        "is new")
+    mapp.login(targetindex.stagename.split('/')[0], "123")
+    testapp.patch_json("/pruser/refs", [
+        'states+=approved',
+        'messages+=Approve'], headers={'X-Devpi-PR-Serial': str(serial)})
+    r = testapp.get_json(targetindex.index + "/pkg/1.0")
+    (link,) = r.json["result"]["+links"]
+    assert link["log"][-1]["src"] == "pruser/dev"
+    r = testapp.get_json(api.index + "/pkg/1.0")
+    assert len(r.json["result"]["+links"]) == 1
+
+
 @pytest.mark.parametrize("targetstate", ["approved", "rejected"])
 def test_invalid_state_changes_from_new(new_prindex, targetstate, testapp):
     r = testapp.patch_json(new_prindex.index, [
@@ -246,6 +311,45 @@ def test_approve_with_toxresult_and_docs(mapp, prindex, targetindex, testapp):
         'http://localhost/targetuser/targetindex/+f/d0b/425e00e15a0d3/pkg-1.0.tar.gz.toxresult')
 
 
+def test_approve_log_writes(mapp, monkeypatch, prindex, targetindex, testapp, xom):
+    from devpi_pr import server
+    (release_path,) = mapp.get_release_paths('pkg')
+    mapp.upload_toxresult(release_path, b"{}")
+    mapp.upload_doc("pkg.doc.zip", b"foo", "pkg", "")
+    copy_logs = server.copy_logs
+    writes = []
+
+    def counting_copy_logs(link, new_link, *args):
+        tx = xom.keyfs.tx
+        orig_set = tx.set
+
+        def counting_set(*args, **kwargs):
+            writes.append(args[0])
+            return orig_set(*args, **kwargs)
+
+        tx.set = counting_set
+        try:
+            copy_logs(link, new_link, *args)
+        finally:
+            del tx.set
+        writes.append(None)
+
+    monkeypatch.setattr(server, "copy_logs", counting_copy_logs)
+    mapp.login(targetindex.stagename.split('/')[0], "123")
+    headers = {'X-Devpi-PR-Serial': '10'}
+    testapp.patch_json(prindex.index, [
+        'states+=approved',
+        'messages+=Approve'], headers=headers)
+    # the logs of all three files were copied without writing anything
+    assert writes == [None, None, None]
+    r = testapp.get_json(targetindex.index + '/pkg')
+    links = r.json['result']['1.0']['+links']
+    assert len(links) == 3
+    for link in links:
+        assert [x['what'] for x in link['log']] == ['upload', 'push']
+        assert link['log'][1]['message'] == 'Approve'
+
+
 def test_reject_pending_not_possible_for_pruser(mapp, prindex, testapp):
     r = testapp.patch_json(prindex.index, [
         'states+=rejected',
@@ -265,6 +369,37 @@ def test_cancel_pending(mapp, prindex, targetindex, testapp):
     assert result['states'] == ['new', 'pending', 'new']
 
 
+def test_approve_all_versions(mapp, new_prindex, targetindex, testapp):
+    for version in ("1.3.4", "1.2.9"):
+        mapp.upload_file_pypi(
+            "pkg-%s.tar.gz" % version, b"content" + version.encode('ascii'),
+            "pkg", version, set_whitelist=False)
+    mapp.upload_file_pypi(
+        "other-2.0.tar.gz", b"other", "other", "2.0", set_whitelist=False)
+    mapp.set_versiondata(
+        dict(name="pkg", version="1.4.0"), set_whitelist=False)
+    r = testapp.patch_json(new_prindex.index, [
+        'states+=pending',
+        'messages+=Please approve'])
+    serial = r.headers['X-Devpi-Serial']
+    mapp.login("targetuser", "123")
+    testapp.patch_json(new_prindex.index, [
+        'states+=approved',
+        'messages+=Approve'], headers={'X-Devpi-PR-Serial': serial})
+    r = testapp.get_json(targetindex.index)
+    assert sorted(r.json['result']['projects']) == ['other', 'pkg']
+    r = testapp.get_json(targetindex.index + '/pkg')
+    result = r.json['result']
+    assert sorted(result) == ['1.2.9', '1.3.4', '1.4.0']
+    assert result['1.4.0'].get('+links', []) == []
+    for version in ('1.2.9', '1.3.4'):
+        (link,) = result[version]['+links']
+        assert link['href'].endswith('/pkg-%s.tar.gz' % version)
+        assert link['log'][-1]['what'] == 'push'
+    r = testapp.get_json(targetindex.index + '/other')
+    assert list(r.json['result']) == ['2.0']
+
+
 def test_approve_already_approved(mapp, prindex, targetindex, testapp):
     # the prindex has one project
     r = testapp.get_json(prindex.index)
@@ -361,6 +496,170 @@ def test_approve_nonvolatile_conflict(mapp, prindex, targetindex, testapp):
     assert r.json['message'] == "pkg-1.0.tar.gz already exists in non-volatile index"
 
 
+def test_pr_check(mapp, monkeypatch, prindex, targetindex, testapp):
+    from devpi_pr import server
+    mapp.login(targetindex.stagename.split('/')[0], "123")
+    testapp.patch_json(targetindex.index, ['volatile=False'])
+    r = testapp.get_json(prindex.index + '/+pr-check')
+    assert r.json['type'] == 'pr-check'
+    result = r.json['result']
+    assert result['bytes'] > 0
+    del result['bytes']
+    assert result == {
+        'state': 'pending',
+        'last_serial': 8,
+        'target': targetindex.stagename,
+        'files': 1,
+        'skipped': [],
+        'conflicts': [],
+        'errors': []}
+    r = testapp.get_json(prindex.index + '/+pr-check?serial=7')
+    assert r.json['result']['errors'] == [
+        "got X-Devpi-PR-Serial 7, expected 8"]
+    testapp.patch_json(prindex.index, [
+        'states+=approved',
+        'messages+=Approve'], headers={'X-Devpi-PR-Serial': '8'})
+    mapp.login(prindex.stagename.split('/')[0], "123")
+    otherprindex = mapp.create_index(
+        "other",
+        indexconfig=dict(
+            type="pr",
+            states="new",
+            messages="New pull request",
+            bases=[targetindex.stagename]))
+    for project in ("pkg", "other"):
+        content = mapp.makepkg(
+            "%s-1.0.tar.gz" % project, b"content2", project, "1.0")
+        mapp.upload_file_pypi(
+            "%s-1.0.tar.gz" % project, content, project, "1.0",
+            set_whitelist=False)
+    r = testapp.patch_json(otherprindex.index, [
+        'states+=pending',
+        'messages+=Please approve'])
+    serial = r.headers['X-Devpi-Serial']
+    r = testapp.get_json(otherprindex.index + '/+pr-check')
+    assert r.json['result']['errors'] == [
+        "user 'pruser' cannot upload to '%s'" % targetindex.stagename,
+        "pkg-1.0.tar.gz already exists in non-volatile index"]
+    mapp.login(targetindex.stagename.split('/')[0], "123")
+    for query in ('', '?incremental=yes'):
+        r = testapp.get_json(otherprindex.index + '/+pr-check' + query)
+        result = r.json['result']
+        assert result['files'] == 2
+        assert result['conflicts'] == ['pkg-1.0.tar.gz']
+        assert result['errors'] == [
+            "pkg-1.0.tar.gz already exists in non-volatile index"]
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("no file may be read")
+
+    # the approvals fail before any file is read or copied
+    monkeypatch.setattr(server, "FilePrefetcher", fail)
+    monkeypatch.setattr(server, "copy_link", fail)
+    r = testapp.patch_json(otherprindex.index, [
+        'states+=approved',
+        'messages+=Approve'], headers={'X-Devpi-PR-Serial': serial},
+        expect_errors=True)
+    assert r.status_code == 409
+    assert r.json['message'] == (
+        "pkg-1.0.tar.gz already exists in non-volatile index")
+    r = testapp.post_json(
+        otherprindex.index + '/+pr-approval',
+        dict(serial=int(serial), message="Approve"), expect_errors=True)
+    assert r.status_code == 409
+    assert r.json['message'] == (
+        "Approval jobs aren't possible for the non-volatile index %s, as "
+        "the files of a failed job would stay in it" % targetindex.stagename)
+    r = testapp.get_json(otherprindex.index)
+    assert r.json['result']['states'] == ['new', 'pending']
+    r = testapp.get_json(targetindex.index)
+    assert r.json['result']['projects'] == ['pkg']
+
+
+def test_pr_check_not_pr_index(targetindex, testapp):
+    r = testapp.get_json(
+        targetindex.index + '/+pr-check', expect_errors=True)
+    assert r.status_code == 400
+
+
+@pytest.mark.parametrize("endpoint", ["patch", "batch"])
+def test_approve_incremental(endpoint, mapp, new_prindex, targetindex, testapp):
+    mapp.login("targetuser", "123")
+    testapp.patch_json(targetindex.index, ['volatile=False'])
+    content = mapp.makepkg("pkg-1.0.tar.gz", b"content1", "pkg", "1.0")
+
+    def approve(api, headers=None, **kw):
+        r = testapp.get_json(api.index + "/+pr-status")
+        serial = r.json['result']['last_serial']
+        mapp.login("targetuser", "123")
+        if endpoint == "batch":
+            r = testapp.post_json(targetindex.index + "/+pr-batch", dict(
+                action="approve", message="Approve", keep_index=True,
+                prs=[dict(name=api.stagename, serial=serial)], **kw),
+                expect_errors=True)
+            (result,) = r.json['result']
+            return (r.status_code, result.get('skipped'))
+        headers = dict(headers or {}, **{'X-Devpi-PR-Serial': str(serial)})
+        r = testapp.patch_json(api.index, [
+            'states+=approved',
+            'messages+=Approve'], headers=headers, expect_errors=True)
+        skipped = r.headers.get('X-Devpi-PR-Skipped')
+        if skipped is not None:
+            skipped = skipped.split(",") if skipped else []
+        return (r.status_code, skipped)
+
+    def make_pr(name, files, toxresult):
+        mapp.login("pruser", "123")
+        api = mapp.create_index(name, indexconfig=dict(
+            type="pr", states="new", messages="New pull request",
+            bases=[targetindex.stagename]))
+        for (basename, data) in files:
+            mapp.upload_file_pypi(
+                basename, data, "pkg", "1.0", set_whitelist=False)
+        (path,) = [
+            x for x in mapp.get_release_paths("pkg")
+            if x.endswith("pkg-1.0.tar.gz")]
+        mapp.upload_toxresult(path, toxresult)
+        testapp.patch_json(api.index, [
+            'states+=pending',
+            'messages+=Please approve'])
+        return api
+
+    api = make_pr("first", [("pkg-1.0.tar.gz", content)], b"{}")
+    assert approve(api) == (200, None)
+    # the amended pull request has the same release file and tox result
+    wheel = ("pkg-1.0-py3-none-any.whl", b"wheel")
+    api = make_pr("second", [("pkg-1.0.tar.gz", content), wheel], b"{}")
+    assert approve(api)[0] == 409
+    (status, skipped) = approve(
+        api, headers={'X-Devpi-PR-Incremental': 'yes'}, incremental=True)
+    assert status == 200
+    assert len(skipped) == 2
+    assert skipped[0] == "pkg-1.0.tar.gz"
+    assert ".toxresult" in skipped[1]
+    r = testapp.get_json(targetindex.index + "/pkg/1.0")
+    links = r.json['result']['+links']
+    assert sorted(
+        x['href'].rsplit('/', 1)[-1]
+        for x in links if x['rel'] != 'toxresult') == [
+            "pkg-1.0-py3-none-any.whl", "pkg-1.0.tar.gz"]
+    (sdist,) = [x for x in links if x['href'].endswith("/pkg-1.0.tar.gz")]
+    assert [x['src'] for x in sdist['log'] if x['what'] == 'push'] == [
+        "pruser/first"]
+    assert len([x for x in links if x['rel'] == 'toxresult']) == 1
+    # a new tox result for an already approved release file is copied
+    api = make_pr("third", [("pkg-1.0.tar.gz", content)], b'{"new": 1}')
+    (status, skipped) = approve(
+        api, headers={'X-Devpi-PR-Incremental': 'yes'}, incremental=True)
+    assert status == 200
+    assert skipped == ["pkg-1.0.tar.gz"]
+    r = testapp.get_json(targetindex.index + "/pkg/1.0")
+    links = r.json['result']['+links']
+    toxresults = [x for x in links if x['rel'] == 'toxresult']
+    assert len(toxresults) == 2
+    assert {x['for_href'] for x in toxresults} == {sdist['href']}
+
+
 def test_pr_list(mapp, new_prindex, targetindex, testapp):
     r = testapp.get_json(targetindex.index + "/+pr-list")
     result = r.json['result']
@@ -368,6 +667,7 @@ def test_pr_list(mapp, new_prindex, targetindex, testapp):
         'name': 'index',
         'base': 'targetuser/targetindex',
         'last_serial': 5,
+        'files': 0,
         'by': ['pruser'],
         'states': ['new'],
         'messages': ['New pull request']}]}}
@@ -377,6 +677,7 @@ def test_pr_list(mapp, new_prindex, targetindex, testapp):
         'name': 'index',
         'base': 'targetuser/targetindex',
         'last_serial': 5,
+        'files': 0,
         'by': ['pruser'],
         'states': ['new'],
         'messages': ['New pull request']}]}}
@@ -386,6 +687,7 @@ def test_pr_list(mapp, new_prindex, targetindex, testapp):
         'name': 'index',
         'base': 'targetuser/targetindex',
         'last_serial': 5,
+        'files': 0,
         'by': ['pruser'],
         'states': ['new'],
         'messages': ['New pull request']}]}}
@@ -402,6 +704,7 @@ def test_pr_list(mapp, new_prindex, targetindex, testapp):
         'name': 'index',
         'base': 'targetuser/targetindex',
         'last_serial': 8,
+        'files': 1,
         'by': ['pruser', 'pruser'],
         'states': ['new', 'pending'],
         'messages': ['New pull request', 'Please approve']}]}}
@@ -411,6 +714,7 @@ def test_pr_list(mapp, new_prindex, targetindex, testapp):
         'name': 'index',
         'base': 'targetuser/targetindex',
         'last_serial': 8,
+        'files': 1,
         'by': ['pruser', 'pruser'],
         'states': ['new', 'pending'],
         'messages': ['New pull request', 'Please approve']}]}}
@@ -423,6 +727,7 @@ def test_pr_list_serial(mapp, new_prindex, targetindex, testapp):
         'name': 'index',
         'base': 'targetuser/targetindex',
         'last_serial': 5,
+        'files': 0,
         'by': ['pruser'],
         'states': ['new'],
         'messages': ['New pull request']}]}}
@@ -437,6 +742,7 @@ def test_pr_list_serial(mapp, new_prindex, targetindex, testapp):
         'name': 'index',
         'base': 'targetuser/targetindex',
         'last_serial': 7,
+        'files': 1,
         'by': ['pruser'],
         'states': ['new'],
         'messages': ['New pull request']}]}}
@@ -450,6 +756,7 @@ def test_pr_list_serial(mapp, new_prindex, targetindex, testapp):
         'name': 'index',
         'base': 'targetuser/targetindex',
         'last_serial': 8,
+        'files': 1,
         'by': ['pruser', 'pruser'],
         'states': ['new', 'pending'],
         'messages': ['New pull request', 'Please approve']}]}}
@@ -464,6 +771,7 @@ def test_pr_list_serial(mapp, new_prindex, targetindex, testapp):
         'name': 'index',
         'base': 'targetuser/targetindex',
         'last_serial': 9,
+        'files': 2,
         'by': ['pruser', 'pruser'],
         'states': ['new', 'pending'],
         'messages': ['New pull request', 'Please approve']}]}}
@@ -482,6 +790,7 @@ def test_pr_list_serial(mapp, new_prindex, targetindex, testapp):
             'name': 'index',
             'base': 'targetuser/targetindex',
             'last_serial': 9,
+            'files': 2,
             'by': ['pruser', 'pruser'],
             'states': ['new', 'pending'],
             'messages': ['New pull request', 'Please approve']}]},
@@ -489,6 +798,7 @@ def test_pr_list_serial(mapp, new_prindex, targetindex, testapp):
             'name': 'other',
             'base': 'targetuser/targetindex',
             'last_serial': 10,
+            'files': 0,
             'by': ['pruser'],
             'states': ['new'],
             'messages': ['Different pull request']}]}}
@@ -503,6 +813,7 @@ def test_pr_list_serial(mapp, new_prindex, targetindex, testapp):
             'name': 'index',
             'base': 'targetuser/targetindex',
             'last_serial': 11,
+            'files': 2,
             'by': ['pruser', 'pruser'],
             'states': ['new', 'pending'],
             'messages': ['New pull request', 'Please approve']}]},
@@ -510,6 +821,7 @@ def test_pr_list_serial(mapp, new_prindex, targetindex, testapp):
             'name': 'other',
             'base': 'targetuser/targetindex',
             'last_serial': 10,
+            'files': 0,
             'by': ['pruser'],
             'states': ['new'],
             'messages': ['Different pull request']}]}}
@@ -523,6 +835,7 @@ def test_pr_list_serial(mapp, new_prindex, targetindex, testapp):
             'name': 'index',
             'base': 'targetuser/targetindex',
             'last_serial': 12,
+            'files': 0,
             'by': ['pruser', 'pruser'],
             'states': ['new', 'pending'],
             'messages': ['New pull request', 'Please approve']}]},
@@ -530,6 +843,7 @@ def test_pr_list_serial(mapp, new_prindex, targetindex, testapp):
             'name': 'other',
             'base': 'targetuser/targetindex',
             'last_serial': 10,
+            'files': 0,
             'by': ['pruser'],
             'states': ['new'],
             'messages': ['Different pull request']}]}}
@@ -549,6 +863,7 @@ def test_pr_list_approved(mapp, new_prindex, targetindex, testapp):
         'name': 'index',
         'base': 'targetuser/targetindex',
         'last_serial': 8,
+        'files': 1,
         'by': ['pruser', 'pruser'],
         'states': ['new', 'pending'],
         'messages': ['New pull request', 'Please approve']}]}}
@@ -558,6 +873,7 @@ def test_pr_list_approved(mapp, new_prindex, targetindex, testapp):
         'name': 'index',
         'base': 'targetuser/targetindex',
         'last_serial': 8,
+        'files': 1,
         'by': ['pruser', 'pruser'],
         'states': ['new', 'pending'],
         'messages': ['New pull request', 'Please approve']}]}}
@@ -573,6 +889,7 @@ def test_pr_list_approved(mapp, new_prindex, targetindex, testapp):
         'name': 'index',
         'base': 'targetuser/targetindex',
         'last_serial': 9,
+        'files': 1,
         'by': ['pruser', 'pruser', 'targetuser'],
         'states': ['new', 'pending', 'approved'],
         'messages': ['New pull request', 'Please approve', 'Approve']}]}}
@@ -582,6 +899,1039 @@ def test_pr_list_approved(mapp, new_prindex, targetindex, testapp):
         'name': 'index',
         'base': 'targetuser/targetindex',
         'last_serial': 9,
+        'files': 1,
         'by': ['pruser', 'pruser', 'targetuser'],
         'states': ['new', 'pending', 'approved'],
         'messages': ['New pull request', 'Please approve', 'Approve']}]}}
+
+
+def test_new_pr_index_keeps_target(mapp, targetindex, testapp):
+    r = testapp.get_json(targetindex.index)
+    ixconfig = r.json['result']
+    mapp.create_and_login_user("pruser")
+    mapp.create_index(
+        "index",
+        indexconfig=dict(
+            type="pr",
+            states="new",
+            messages="New pull request",
+            bases=[targetindex.stagename]))
+    # the target index can belong to another user and isn't changed
+    r = testapp.get_json(targetindex.index)
+    assert r.json['result'] == ixconfig
+    r = testapp.get_json(targetindex.index + "/+pr-list")
+    assert [x['name'] for x in r.json['result']['new']['pruser']] == ['index']
+
+
+def test_pr_list_deleted_pr_index(mapp, new_prindex, targetindex, testapp):
+    mapp.delete_index("pruser/index")
+    r = testapp.get_json(targetindex.index + "/+pr-list")
+    assert r.json['result'] == {}
+    mapp.create_index(
+        "other",
+        indexconfig=dict(
+            type="pr",
+            states="new",
+            messages="Different pull request",
+            bases=[targetindex.stagename]))
+    r = testapp.get_json(targetindex.index + "/+pr-list")
+    assert list(r.json['result']['new']['pruser']) == [{
+        'name': 'other',
+        'base': 'targetuser/targetindex',
+        'last_serial': 7,
+        'files': 0,
+        'by': ['pruser'],
+        'states': ['new'],
+        'messages': ['Different pull request']}]
+
+
+def test_pr_list_ignores_unrelated_indexes(mapp, new_prindex, targetindex, testapp):
+    mapp.create_index("unrelated", indexconfig=dict(pull_requests_allowed=True))
+    mapp.create_index(
+        "other",
+        indexconfig=dict(
+            type="pr",
+            states="new",
+            messages="Different pull request",
+            bases=["pruser/unrelated"]))
+    r = testapp.get_json(targetindex.index + "/+pr-list")
+    assert list(r.json['result']['new']['pruser']) == [{
+        'name': 'index',
+        'base': 'targetuser/targetindex',
+        'last_serial': 5,
+        'files': 0,
+        'by': ['pruser'],
+        'states': ['new'],
+        'messages': ['New pull request']}]
+    r = testapp.get_json("/pruser/unrelated/+pr-list")
+    assert [x['name'] for x in r.json['result']['new']['pruser']] == ['other']
+
+
+def test_pr_list_etag(mapp, new_prindex, targetindex, testapp):
+    r = testapp.get_json(targetindex.index + "/+pr-list")
+    etag = r.headers['ETag']
+    assert list(r.json['result']) == ['new']
+    r = testapp.get(
+        targetindex.index + "/+pr-list",
+        headers={'Accept': 'application/json', 'If-None-Match': etag})
+    assert r.status_code == 304
+    assert r.headers['ETag'] == etag
+    assert r.body == b''
+    # a change in the pr index results in a new etag
+    content1 = mapp.makepkg("pkg-1.0.tar.gz", b"content1", "pkg", "1.0")
+    mapp.upload_file_pypi(
+        "pkg-1.0.tar.gz", content1, "pkg", "1.0",
+        set_whitelist=False)
+    r = testapp.get(
+        targetindex.index + "/+pr-list",
+        headers={'Accept': 'application/json', 'If-None-Match': etag})
+    assert r.status_code == 200
+    assert r.headers['ETag'] != etag
+    assert r.json['result']['new']['pruser'][0]['last_serial'] == 7
+
+
+def test_pr_list_etag_unchanged_content(mapp, new_prindex, targetindex, testapp):
+    r = testapp.get_json(targetindex.index + "/+pr-list")
+    etag = r.headers['ETag']
+    # a change unrelated to the pr list results in the same etag
+    mapp.create_and_login_user("otheruser")
+    r = testapp.get(
+        targetindex.index + "/+pr-list",
+        headers={'Accept': 'application/json', 'If-None-Match': etag})
+    assert r.status_code == 304
+
+
+@pytest.fixture
+def more_prindexes(mapp, new_prindex, targetindex):
+    for name in ("other", "third"):
+        mapp.create_index(
+            name,
+            indexconfig=dict(
+                type="pr",
+                states="new",
+                messages="Another pull request",
+                bases=[targetindex.stagename]))
+    mapp.create_and_login_user("otheruser")
+    mapp.create_index(
+        "index",
+        indexconfig=dict(
+            type="pr",
+            states="new",
+            messages="New pull request",
+            bases=[targetindex.stagename]))
+
+
+def test_pr_list_filter(mapp, more_prindexes, new_prindex, targetindex, testapp):
+    mapp.login("pruser", "123")
+    mapp.use("pruser/index")
+    content1 = mapp.makepkg("pkg-1.0.tar.gz", b"content1", "pkg", "1.0")
+    mapp.upload_file_pypi(
+        "pkg-1.0.tar.gz", content1, "pkg", "1.0",
+        set_whitelist=False)
+    r = testapp.patch_json(new_prindex.index, [
+        'states+=pending',
+        'messages+=Please approve'])
+    serial = int(r.headers['X-Devpi-Serial'])
+    url = targetindex.index + "/+pr-list"
+    r = testapp.get_json(url)
+    assert sorted(r.json['result']) == ['new', 'pending']
+    assert 'next_cursor' not in r.json
+    r = testapp.get_json(url + "?state=pending")
+    assert r.json['result'] == {'pending': {'pruser': [{
+        'name': 'index',
+        'base': 'targetuser/targetindex',
+        'last_serial': serial,
+        'files': 1,
+        'by': ['pruser', 'pruser'],
+        'states': ['new', 'pending'],
+        'messages': ['New pull request', 'Please approve']}]}}
+    r = testapp.get_json(url + "?state=new,pending&user=otheruser")
+    assert list(r.json['result']) == ['new']
+    assert list(r.json['result']['new']) == ['otheruser']
+    r = testapp.get_json(url + "?user=pruser&state=new&fields=base,by")
+    assert r.json['result'] == {'new': {'pruser': [
+        {'name': 'other', 'base': 'targetuser/targetindex', 'by': ['pruser']},
+        {'name': 'third', 'base': 'targetuser/targetindex', 'by': ['pruser']}]}}
+    r = testapp.get_json(url + "?since_serial=%d" % (serial - 1))
+    assert r.json['result'] == {'pending': {'pruser': [{
+        'name': 'index',
+        'base': 'targetuser/targetindex',
+        'last_serial': serial,
+        'files': 1,
+        'by': ['pruser', 'pruser'],
+        'states': ['new', 'pending'],
+        'messages': ['New pull request', 'Please approve']}]}}
+    r = testapp.get_json(url + "?since_serial=%d" % serial)
+    assert r.json['result'] == {}
+    r = testapp.get_json("/pruser/+pr-list?state=new&fields=name")
+    assert r.json['result'] == {'new': {'pruser': [
+        {'name': 'other'}, {'name': 'third'}]}}
+    r = testapp.get_json("/pruser/+pr-list?user=otheruser")
+    assert r.json['result'] == {}
+
+
+def test_pr_list_pagination(mapp, more_prindexes, targetindex, testapp):
+    url = targetindex.index + "/+pr-list?fields=name&limit=3"
+    r = testapp.get_json(url)
+    assert r.json['result'] == {'new': {
+        'otheruser': [{'name': 'index'}],
+        'pruser': [{'name': 'index'}, {'name': 'other'}]}}
+    assert r.json['next_cursor'] == 'pruser/other'
+    r = testapp.get_json(url + "&cursor=pruser/other")
+    assert r.json['result'] == {'new': {'pruser': [{'name': 'third'}]}}
+    assert 'next_cursor' not in r.json
+    r = testapp.get_json(url + "&cursor=pruser/third")
+    assert r.json['result'] == {}
+    assert 'next_cursor' not in r.json
+    r = testapp.get_json("/pruser/+pr-list?fields=name&limit=2")
+    assert r.json['result'] == {'new': {'pruser': [
+        {'name': 'index'}, {'name': 'other'}]}}
+    assert r.json['next_cursor'] == 'pruser/other'
+
+
+@pytest.mark.parametrize("query, message", [
+    ("fields=name,foo", "Unknown fields: foo"),
+    ("limit=0", "The limit must be at least 1"),
+    ("limit=foo", "The limit must be an integer"),
+    ("since_serial=foo", "The since_serial must be an integer")])
+def test_pr_list_invalid_query(message, query, targetindex, testapp):
+    r = testapp.get_json(
+        targetindex.index + "/+pr-list?" + query, expect_errors=True)
+    assert r.status_code == 400
+    assert r.json['message'] == message
+
+
+def test_pr_list_cache():
+    from devpi_pr.views import PRListCache
+    cache = PRListCache(2)
+    cache.put(("index-pr-list", "user/index", 1), "foo")
+    cache.put(("index-pr-list", "user/index", 2), "bar")
+    assert cache.get(("index-pr-list", "user/index", 1)) == "foo"
+    cache.put(("index-pr-list", "user/index", 3), "ham")
+    assert len(cache) == 2
+    # the least recently used entry was evicted
+    assert cache.get(("index-pr-list", "user/index", 2)) is None
+    assert cache.get(("index-pr-list", "user/index", 1)) == "foo"
+    assert cache.get(("index-pr-list", "user/index", 3)) == "ham"
+    cache = PRListCache(0)
+    cache.put(("index-pr-list", "user/index", 1), "foo")
+    assert len(cache) == 0
+
+
+class FakeEntry:
+    def __init__(self, path, content):
+        self.path = path
+        self.content = content
+        self.size = len(content)
+        self.opened = 0
+
+    def file_os_path(self):
+        return self.path
+
+    def file_open_read(self):
+        from io import BytesIO
+        self.opened += 1
+        return BytesIO(self.content)
+
+
+class FakeLink:
+    def __init__(self, relpath, entry):
+        self.relpath = relpath
+        self.entry = entry
+
+
+@pytest.fixture
+def fake_links(tmpdir):
+    links = []
+    for i in range(10):
+        content = ("content%d" % i).encode('ascii')
+        path = tmpdir.join("file%d" % i)
+        path.write_binary(content)
+        links.append(FakeLink("file%d" % i, FakeEntry(path.strpath, content)))
+    return links
+
+
+@pytest.mark.parametrize("max_workers", [0, 1, 4])
+def test_file_prefetcher(fake_links, max_workers):
+    from devpi_pr.server import FilePrefetcher
+    prefetcher = FilePrefetcher(fake_links, max_workers)
+    try:
+        for link in fake_links:
+            with prefetcher.open(link) as f:
+                assert f.read() == link.entry.content
+    finally:
+        prefetcher.close()
+    opened = [x.entry.opened for x in fake_links]
+    if max_workers:
+        assert opened == [0] * len(fake_links)
+        assert prefetcher.futures == {}
+    else:
+        assert opened == [1] * len(fake_links)
+
+
+def test_file_prefetcher_fallback(fake_links):
+    from devpi_pr.server import FilePrefetcher
+    # no filesystem path
+    fake_links[1].entry.path = None
+    # file vanished
+    fake_links[2].entry.path = fake_links[2].entry.path + "-missing"
+    # a link which wasn't passed in
+    other = FakeLink("other", FakeEntry(None, b"other"))
+    prefetcher = FilePrefetcher(fake_links, 2)
+    try:
+        for link in fake_links[:3] + [other] + fake_links[3:]:
+            with prefetcher.open(link) as f:
+                assert f.read() == link.entry.content
+    finally:
+        prefetcher.close()
+    assert [x.entry.opened for x in fake_links[:4]] == [0, 1, 1, 0]
+    assert other.entry.opened == 1
+
+
+def test_file_prefetcher_max_bytes(fake_links):
+    from devpi_pr.server import FilePrefetcher
+    fake_links[3].entry.content = b"x" * 20
+    fake_links[3].entry.size = 20
+    with open(fake_links[3].entry.path, "wb") as f:
+        f.write(fake_links[3].entry.content)
+    # room for two of the other files
+    prefetcher = FilePrefetcher(fake_links, 4, max_bytes=16)
+    try:
+        assert sorted(prefetcher.sizes) == [0, 1]
+        for link in fake_links:
+            with prefetcher.open(link) as f:
+                assert f.read() == link.entry.content
+            assert sum(prefetcher.sizes.values()) <= 16
+    finally:
+        prefetcher.close()
+    # the file larger than the limit isn't read ahead
+    assert [x.entry.opened for x in fake_links] == [0, 0, 0, 1] + [0] * 6
+
+
+def test_file_prefetcher_close_unused(fake_links):
+    from devpi_pr.server import FilePrefetcher
+    prefetcher = FilePrefetcher(fake_links, 4)
+    with prefetcher.open(fake_links[0]) as f:
+        assert f.read() == b"content0"
+    prefetcher.close()
+    assert prefetcher.futures == {}
+
+
+def test_approve_many_files(mapp, new_prindex, targetindex, testapp):
+    for i in range(12):
+        basename = "pkg-1.0-py%d-none-any.whl" % i
+        mapp.upload_file_pypi(
+            basename, b"content%d" % i, "pkg", "1.0",
+            set_whitelist=False)
+    r = testapp.patch_json(new_prindex.index, [
+        'states+=pending',
+        'messages+=Please approve'])
+    serial = r.headers['X-Devpi-Serial']
+    mapp.login(targetindex.stagename.split('/')[0], "123")
+    r = testapp.patch_json(new_prindex.index, [
+        'states+=approved',
+        'messages+=Approve'], headers={'X-Devpi-PR-Serial': serial})
+    releases = mapp.getreleaseslist('pkg', indexname=targetindex.stagename)
+    assert sorted(x.rsplit('/', 1)[1] for x in releases) == sorted(
+        "pkg-1.0-py%d-none-any.whl" % i for i in range(12))
+    for release in releases:
+        r = testapp.get(release.replace('http://localhost', ''))
+        basename = release.rsplit('/', 1)[1]
+        assert r.body == b"content%s" % basename.split('-')[2][2:].encode('ascii')
+
+
+def test_approve_many_toxresults(mapp, monkeypatch, prindex, targetindex, testapp, xom):
+    (release_path,) = mapp.get_release_paths('pkg')
+    for i in range(20):
+        mapp.upload_toxresult(release_path, b'{"n": %d}' % i)
+    with xom.keyfs.read_transaction():
+        stage = xom.model.getstage(prindex.stagename)
+        linkstore = stage.get_linkstore_perstage('pkg', '1.0')
+    (linkstore_cls,) = [
+        x for x in type(linkstore).__mro__ if 'get_links' in x.__dict__]
+    get_links = linkstore_cls.get_links
+    calls = []
+
+    def counting_get_links(self, *args, **kwargs):
+        calls.append(self.stage.name)
+        return get_links(self, *args, **kwargs)
+
+    monkeypatch.setattr(linkstore_cls, "get_links", counting_get_links)
+    mapp.login(targetindex.stagename.split('/')[0], "123")
+    testapp.patch_json(prindex.index, [
+        'states+=approved',
+        'messages+=Approve'], headers={'X-Devpi-PR-Serial': '28'})
+    # devpi-server only checks the release file once for each tox result,
+    # the other tox results aren't looked up to generate the file names
+    assert calls.count(targetindex.stagename) <= 20 + 2
+    r = testapp.get_json(targetindex.index + '/pkg')
+    links = r.json['result']['1.0']['+links']
+    (release_link,) = [x for x in links if x['rel'] == 'releasefile']
+    toxresult_links = [x for x in links if x['rel'] == 'toxresult']
+    assert len(toxresult_links) == 20
+    assert {x['for_href'] for x in toxresult_links} == {release_link['href']}
+    assert sorted(
+        int(x['href'].rsplit('-', 1)[1]) for x in toxresult_links) == list(
+        range(20))
+    results = sorted(
+        json.loads(testapp.get(x['href'].replace('http://localhost', '')).body)['n']
+        for x in toxresult_links)
+    assert results == list(range(20))
+
+
+def test_approve_toxresults_without_filename(mapp, monkeypatch, prindex, targetindex, testapp, xom):
+    (release_path,) = mapp.get_release_paths('pkg')
+    for i in range(3):
+        mapp.upload_toxresult(release_path, b'{"n": %d}' % i)
+    with xom.keyfs.read_transaction():
+        target = xom.model.getstage(targetindex.stagename)
+    (stage_cls,) = [
+        x for x in type(target).__mro__ if 'store_toxresult' in x.__dict__]
+    store_toxresult = stage_cls.store_toxresult
+    calls = []
+
+    # like older devpi-server releases, which generate the name themselves
+    def store_toxresult_without_filename(self, link, content_or_file, **kwargs):
+        calls.append(kwargs)
+        assert 'filename' not in kwargs
+        return store_toxresult(self, link, content_or_file, **kwargs)
+
+    monkeypatch.setattr(
+        stage_cls, "store_toxresult", store_toxresult_without_filename)
+    mapp.login(targetindex.stagename.split('/')[0], "123")
+    testapp.patch_json(prindex.index, [
+        'states+=approved',
+        'messages+=Approve'], headers={'X-Devpi-PR-Serial': '11'})
+    assert len(calls) == 3
+    r = testapp.get_json(targetindex.index + '/pkg')
+    links = r.json['result']['1.0']['+links']
+    toxresult_links = [x for x in links if x['rel'] == 'toxresult']
+    assert len(toxresult_links) == 3
+    results = sorted(
+        json.loads(testapp.get(x['href'].replace('http://localhost', '')).body)['n']
+        for x in toxresult_links)
+    assert results == list(range(3))
+
+
+@pytest.mark.storage_with_filesystem
+@pytest.mark.parametrize("hard_links", [False, True])
+def test_approve_hard_links(hard_links, mapp, monkeypatch, prindex, targetindex, testapp, xom):
+    import os
+    monkeypatch.setattr(xom.config.args, "pr_hard_links", hard_links)
+    serverdir = str(getattr(xom.config, 'server_path', None) or xom.config.serverdir)
+    (path,) = mapp.get_release_paths('pkg')
+    src = os.path.join(serverdir, '+files', *path.strip('/').split('/'))
+    assert os.path.exists(src)
+    mapp.login(targetindex.stagename.split('/')[0], "123")
+    headers = {'X-Devpi-PR-Serial': '8'}
+    testapp.patch_json(prindex.index, [
+        'states+=approved',
+        'messages+=Approve'], headers=headers)
+    (release,) = mapp.getreleaseslist('pkg', indexname=targetindex.stagename)
+    dst = os.path.join(
+        serverdir, '+files', *release.replace('http://localhost/', '').split('/'))
+    assert os.path.exists(dst)
+    assert os.path.samefile(src, dst) is hard_links
+    r = testapp.get(release.replace('http://localhost', ''))
+    assert r.body == mapp.makepkg("pkg-1.0.tar.gz", b"content1", "pkg", "1.0")
+
+
+@pytest.fixture
+def make_pending_pr(mapp, targetindex, testapp):
+    mapp.create_user("pruser", "123")
+
+    def make_pending_pr(name, project):
+        mapp.login("pruser", "123")
+        api = mapp.create_index(
+            name,
+            indexconfig=dict(
+                type="pr",
+                states="new",
+                messages="New pull request",
+                bases=[targetindex.stagename]))
+        filename = "%s-1.0.tar.gz" % project
+        content = mapp.makepkg(filename, project.encode('ascii'), project, "1.0")
+        mapp.upload_file_pypi(
+            filename, content, project, "1.0", set_whitelist=False)
+        r = testapp.patch_json(api.index, [
+            'states+=pending',
+            'messages+=Please approve'])
+        return (api, int(r.headers['X-Devpi-Serial']))
+
+    return make_pending_pr
+
+
+def test_batch_approve(make_pending_pr, mapp, targetindex, testapp):
+    (api1, serial1) = make_pending_pr("pr1", "pkg1")
+    (api2, serial2) = make_pending_pr("pr2", "pkg2")
+    (api3, serial3) = make_pending_pr("pr3", "pkg3")
+    mapp.login("targetuser", "123")
+    r = testapp.post_json(targetindex.index + "/+pr-batch", dict(
+        action="approve",
+        message="Release",
+        prs=[
+            dict(name="pruser/pr1", serial=serial1),
+            dict(name="pruser/pr2", serial=serial2),
+            dict(name="pruser/pr3", serial=serial3 - 1),
+            dict(name="pruser/missing", serial=serial3)]))
+    assert r.json['type'] == 'pr-batch'
+    assert r.json['result'] == [
+        {'name': 'pruser/pr1', 'status': 200, 'message': 'approved',
+         'deleted': True},
+        {'name': 'pruser/pr2', 'status': 200, 'message': 'approved',
+         'deleted': True},
+        {'name': 'pruser/pr3', 'status': 400,
+         'message': 'got serial %s, expected %s' % (serial3 - 1, serial3)},
+        {'name': 'pruser/missing', 'status': 404,
+         'message': "No pull request 'pruser/missing'"}]
+    r = testapp.get_json(targetindex.index)
+    assert r.json['result']['projects'] == ['pkg1', 'pkg2']
+    r = testapp.get_json(targetindex.index + '/pkg1/1.0')
+    (link,) = r.json['result']['+links']
+    assert link['log'][-1]['message'] == 'Release'
+    testapp.get_json(api1.index, status=404)
+    testapp.get_json(api2.index, status=404)
+    r = testapp.get_json(api3.index)
+    assert r.json['result']['states'] == ['new', 'pending']
+
+
+def test_batch_approve_keep_index(make_pending_pr, mapp, targetindex, testapp):
+    (api1, serial1) = make_pending_pr("pr1", "pkg1")
+    mapp.login("targetuser", "123")
+    r = testapp.post_json(targetindex.index + "/+pr-batch", dict(
+        action="approve",
+        message="Release",
+        keep_index=True,
+        prs=[dict(name="pruser/pr1", serial=serial1)]))
+    assert r.json['result'] == [
+        {'name': 'pruser/pr1', 'status': 200, 'message': 'approved'}]
+    r = testapp.get_json(api1.index)
+    assert r.json['result']['states'] == ['new', 'pending', 'approved']
+    assert r.json['result']['changers'] == ['pruser', 'pruser', 'targetuser']
+
+
+def test_batch_reject(make_pending_pr, mapp, targetindex, testapp):
+    (api1, serial1) = make_pending_pr("pr1", "pkg1")
+    (api2, serial2) = make_pending_pr("pr2", "pkg2")
+    mapp.login("targetuser", "123")
+    r = testapp.post_json(targetindex.index + "/+pr-batch", dict(
+        action="reject",
+        message="Not now",
+        prs=["pruser/pr1", "pruser/pr2"]))
+    assert [x['status'] for x in r.json['result']] == [200, 200]
+    for api in (api1, api2):
+        r = testapp.get_json(api.index)
+        assert r.json['result']['states'] == ['new', 'pending', 'rejected']
+        assert r.json['result']['messages'][-1] == 'Not now'
+    r = testapp.get_json(targetindex.index)
+    assert r.json['result']['projects'] == []
+
+
+def test_batch_approve_rollback(make_pending_pr, mapp, targetindex, testapp):
+    (api1, serial1) = make_pending_pr("pr1", "pkg1")
+    (api2, serial2) = make_pending_pr("pr2", "pkg2")
+    mapp.login("targetuser", "123")
+    r = testapp.get_json(targetindex.index)
+    testapp.patch_json(targetindex.index, dict(
+        r.json['result'], volatile=False))
+    content = mapp.makepkg("pkg2-1.0.tar.gz", b"pkg2", "pkg2", "1.0")
+    mapp.use(targetindex.stagename)
+    mapp.upload_file_pypi(
+        "pkg2-1.0.tar.gz", content, "pkg2", "1.0", set_whitelist=False)
+    r = testapp.post_json(targetindex.index + "/+pr-batch", dict(
+        action="approve",
+        message="Release",
+        prs=[
+            dict(name="pruser/pr1", serial=serial1),
+            dict(name="pruser/pr2", serial=serial2)]), expect_errors=True)
+    assert r.status_code == 409
+    assert r.json['result'] == [
+        {'name': 'pruser/pr1', 'status': 409,
+         'message': "Rolled back because of an error in 'pruser/pr2'"},
+        {'name': 'pruser/pr2', 'status': 409,
+         'message': "pkg2-1.0.tar.gz already exists in non-volatile index"}]
+    r = testapp.get_json(targetindex.index)
+    assert r.json['result']['projects'] == ['pkg2']
+    r = testapp.get_json(api1.index)
+    assert r.json['result']['states'] == ['new', 'pending']
+    # the events of the rolled back changes are dropped
+    r = testapp.get_json(targetindex.index + '/+pr-events?serial=0')
+    assert [x['event'] for x in r.json['result']['events']] == [
+        'create', 'submit', 'create', 'submit']
+
+
+def test_batch_not_allowed(make_pending_pr, targetindex, testapp):
+    (api1, serial1) = make_pending_pr("pr1", "pkg1")
+    r = testapp.post_json(targetindex.index + "/+pr-batch", dict(
+        action="approve",
+        message="Release",
+        prs=[dict(name="pruser/pr1", serial=serial1)]), expect_errors=True)
+    assert r.status_code == 401
+    r = testapp.get_json(api1.index)
+    assert r.json['result']['states'] == ['new', 'pending']
+
+
+@pytest.mark.parametrize("data, message", [
+    (dict(action="merge", message="msg", prs=["pruser/pr1"]),
+     "The action must be one of: approve, reject"),
+    (dict(action="approve", prs=["pruser/pr1"]), "A message is required"),
+    (dict(action="approve", message="msg", prs=[]), "No pull requests given")])
+def test_batch_invalid(data, message, mapp, targetindex, testapp):
+    r = testapp.post_json(
+        targetindex.index + "/+pr-batch", data, expect_errors=True)
+    assert r.status_code == 400
+    assert r.json['message'] == message
+
+
+def test_pr_status(mapp, prindex, targetindex, testapp):
+    r = testapp.get_json(prindex.index + "/+pr-status")
+    assert r.json['type'] == 'pr-status'
+    assert r.json['result'] == {
+        'name': 'index',
+        'base': 'targetuser/targetindex',
+        'state': 'pending',
+        'last_serial': 8,
+        'files': 1,
+        'by': ['pruser', 'pruser'],
+        'states': ['new', 'pending'],
+        'messages': ['New pull request', 'Please approve']}
+    r = testapp.get_json(targetindex.index + "/+pr-status", expect_errors=True)
+    assert r.status_code == 400
+    assert r.json['message'] == (
+        "The index 'targetuser/targetindex' is not a pr index")
+    r = testapp.get_json("/pruser/missing/+pr-status", expect_errors=True)
+    assert r.status_code == 404
+
+
+def test_pr_summary(mapp, monkeypatch, new_prindex, testapp, xom):
+    import devpi_pr.server
+    from devpi_pr.server import devpiserver_on_upload
+    get_file_count = devpi_pr.server.get_file_count
+    calls = []
+
+    def counting_get_file_count(stage):
+        calls.append(stage.name)
+        return get_file_count(stage)
+
+    monkeypatch.setattr(
+        devpi_pr.server, "get_file_count", counting_get_file_count)
+    event_serial = -1
+    monkeypatch.setattr(
+        xom.keyfs.notifier, "read_event_serial", lambda: event_serial)
+    mapp.upload_file_pypi(
+        "pkg-1.0.tar.gz", b"content1", "pkg", "1.0", set_whitelist=False)
+    r = testapp.get_json(new_prindex.index + "/+pr-status")
+    assert r.json['result']['files'] == 1
+    assert calls == ['pruser/index']
+    # the entry is used at the same serial
+    r = testapp.get_json(new_prindex.index + "/+pr-status")
+    assert r.json['result']['files'] == 1
+    assert calls == ['pruser/index']
+    # without the notifier having caught up, the entry is computed again
+    mapp.create_user("otheruser", password="123")
+    r = testapp.get_json(new_prindex.index + "/+pr-status")
+    assert len(calls) == 2
+    event_serial = xom.keyfs.get_current_serial()
+    mapp.create_user("anotheruser", password="123")
+    r = testapp.get_json(new_prindex.index + "/+pr-status")
+    assert len(calls) == 3
+    # the notifier caught up without changes to the pr index
+    event_serial = xom.keyfs.get_current_serial()
+    r = testapp.get_json(new_prindex.index + "/+pr-status")
+    assert len(calls) == 3
+    last_serial = r.json['result']['last_serial']
+    # an upload is reported by the notifier
+    mapp.login("pruser", "123")
+    mapp.use("pruser/index")
+    mapp.upload_file_pypi(
+        "pkg-1.0.zip", b"content2", "pkg", "1.0", set_whitelist=False)
+    with xom.keyfs.read_transaction():
+        stage = xom.model.getstage("pruser/index")
+        (link,) = stage.get_releaselinks_perstage("pkg")[-1:]
+        devpiserver_on_upload(
+            stage=stage, project="pkg", version="1.0", link=link)
+    event_serial = xom.keyfs.get_current_serial()
+    r = testapp.get_json(new_prindex.index + "/+pr-status")
+    assert len(calls) == 4
+    assert r.json['result']['files'] == 2
+    assert r.json['result']['last_serial'] > last_serial
+    # changes to the index config are detected without events
+    r = testapp.patch_json(new_prindex.index, [
+        'states+=pending',
+        'messages+=Please approve'])
+    event_serial = xom.keyfs.get_current_serial()
+    r = testapp.get_json(new_prindex.index + "/+pr-status")
+    assert len(calls) == 5
+    assert r.json['result']['last_serial'] == event_serial
+
+
+def test_pr_summary_source_releases(mapp, monkeypatch, new_prindex, targetindex, testapp, xom):
+    import devpi_pr.server
+    from devpi_pr.server import devpiserver_on_upload
+    get_source_releases = devpi_pr.server.get_source_releases
+    calls = []
+
+    def counting_get_source_releases(stage, ixconfig=None):
+        calls.append(stage.name)
+        return get_source_releases(stage, ixconfig=ixconfig)
+
+    event_serial = -1
+    monkeypatch.setattr(
+        xom.keyfs.notifier, "read_event_serial", lambda: event_serial)
+    api = mapp.create_index("dev")
+    mapp.upload_file_pypi(
+        "pkg-1.0.tar.gz", b"content1", "pkg", "1.0",
+        set_whitelist=False, indexname=api.stagename)
+    testapp.put_json("/pruser/refs", dict(
+        type="pr", states=["new"], messages=["New pull request"],
+        bases=[targetindex.stagename],
+        source_releases=["pruser/dev/pkg/1.0"]))
+    monkeypatch.setattr(
+        devpi_pr.server, "get_source_releases", counting_get_source_releases)
+    event_serial = xom.keyfs.get_current_serial()
+    r = testapp.get_json("/pruser/refs/+pr-status")
+    assert r.json['result']['files'] == 1
+    assert calls == ['pruser/refs']
+    # the source releases are part of the entry
+    r = testapp.get_json("/pruser/refs/+pr-status")
+    assert calls == ['pruser/refs']
+    # an upload to the source index is reported by the notifier
+    mapp.upload_file_pypi(
+        "pkg-1.0.zip", b"content2", "pkg", "1.0",
+        set_whitelist=False, indexname=api.stagename)
+    with xom.keyfs.read_transaction():
+        stage = xom.model.getstage(api.stagename)
+        (link,) = stage.get_releaselinks_perstage("pkg")[-1:]
+        devpiserver_on_upload(
+            stage=stage, project="pkg", version="1.0", link=link)
+    event_serial = xom.keyfs.get_current_serial()
+    r = testapp.get_json("/pruser/refs/+pr-status")
+    assert r.json['result']['files'] == 2
+    assert r.json['result']['last_serial'] == event_serial
+    assert len(calls) == 2
+
+
+def test_pr_events(mapp, new_prindex, targetindex, testapp, xom):
+    r = testapp.get_json(targetindex.index + '/+pr-events?serial=0')
+    assert r.json['type'] == 'pr-events'
+    result = r.json['result']
+    assert result['complete'] is True
+    (create,) = result['events']
+    serial = create.pop('serial')
+    assert create == {
+        'event': 'create',
+        'name': new_prindex.stagename,
+        'target': targetindex.stagename,
+        'state': 'new',
+        'message': 'New pull request',
+        'by': 'pruser'}
+    assert result['serial'] == serial
+    content = mapp.makepkg("pkg-1.0.tar.gz", b"content1", "pkg", "1.0")
+    mapp.upload_file_pypi(
+        "pkg-1.0.tar.gz", content, "pkg", "1.0", set_whitelist=False)
+    r = testapp.patch_json(new_prindex.index, [
+        'states+=pending',
+        'messages+=Please approve'])
+    pr_serial = r.headers['X-Devpi-Serial']
+    mapp.login("targetuser", "123")
+    # a failed approval has no event
+    r = testapp.patch_json(new_prindex.index, [
+        'states+=approved',
+        'messages+=Approve'], headers={'X-Devpi-PR-Serial': '1'},
+        expect_errors=True)
+    assert r.status_code == 400
+    testapp.patch_json(new_prindex.index, [
+        'states+=approved',
+        'messages+=Approve'], headers={'X-Devpi-PR-Serial': pr_serial})
+    testapp.delete(new_prindex.index)
+    r = testapp.get_json(
+        targetindex.index + '/+pr-events?serial=%s' % serial)
+    result = r.json['result']
+    events = result['events']
+    assert [(x['event'], x['state'], x['by']) for x in events] == [
+        ('submit', 'pending', 'pruser'),
+        ('approve', 'approved', 'targetuser'),
+        ('delete', 'approved', 'targetuser')]
+    assert [x['serial'] for x in events] == sorted(
+        x['serial'] for x in events)
+    assert events[0]['serial'] == int(pr_serial)
+    assert result['serial'] == events[-1]['serial']
+    # nothing new
+    r = testapp.get_json(
+        targetindex.index + '/+pr-events?serial=%s&timeout=0.1' % (
+            result['serial']))
+    assert r.json['result']['events'] == []
+    assert r.json['result']['serial'] == result['serial']
+    # events are only available for indexes
+    r = testapp.get_json('/pruser/+pr-events', expect_errors=True)
+    assert r.status_code == 404
+    r = testapp.get_json(
+        targetindex.index + '/+pr-events?serial=foo', expect_errors=True)
+    assert r.status_code == 400
+
+
+def test_pr_events_outside_transaction(monkeypatch, targetindex, testapp, xom):
+    import time
+    events = xom.devpi_pr_events
+    get = events.get
+    in_transaction = []
+
+    def recording_get(*args, **kwargs):
+        in_transaction.append(hasattr(xom.keyfs, "tx"))
+        return get(*args, **kwargs)
+
+    monkeypatch.setattr(events, "get", recording_get)
+    # also when devpi-server is mounted below an url prefix
+    r = testapp.get_json(
+        targetindex.index + '/+pr-events?timeout=0.1',
+        extra_environ={'SCRIPT_NAME': '/prefix'})
+    assert r.json['type'] == 'pr-events'
+    assert in_transaction == [False]
+    # doesn't wait for an index which doesn't exist
+    start = time.monotonic()
+    r = testapp.get_json(
+        '/targetuser/missing/+pr-events?timeout=10', expect_errors=True)
+    assert r.status_code == 404
+    assert time.monotonic() - start < 5
+    assert in_transaction == [False]
+
+
+def test_pr_events_wait():
+    from devpi_pr.server import PREvents
+    import threading
+    events = PREvents(3, 10)
+    assert events.get("user/target") == dict(
+        events=[], serial=10, complete=True)
+
+    def add(serial, name="user/pr"):
+        events.add(dict(serial=serial, name=name, target="user/target"))
+
+    timer = threading.Timer(0.1, add, (11,))
+    timer.start()
+    result = events.get("user/target", since=10, timeout=10)
+    timer.join()
+    assert result == dict(
+        events=[dict(serial=11, name="user/pr", target="user/target")],
+        serial=11, complete=True)
+    assert events.get("user/pr", since=11, timeout=0.01)["events"] == []
+    add(12, name="user/other")
+    assert [x["serial"] for x in events.get("user/pr", since=10)["events"]] == [
+        11]
+    assert events.get("user/other", since=10)["serial"] == 12
+    add(13)
+    add(14)
+    # the event at serial 11 was dropped
+    result = events.get("user/target", since=10)
+    assert [x["serial"] for x in result["events"]] == [12, 13, 14]
+    assert result["complete"] is False
+    assert events.get("user/target", since=11)["complete"] is True
+
+
+def test_pr_events_max_waiters():
+    from devpi_pr.server import PREvents
+    import threading
+    import time
+    events = PREvents(3, 10, max_waiters=1)
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(
+        events.get("user/target", since=10, timeout=10)))
+    waiter.start()
+    while events.waiters < 1:
+        time.sleep(0.01)
+    # no more waiters allowed, returns right away
+    start = time.monotonic()
+    assert events.get("user/target", since=10, timeout=10)["events"] == []
+    assert time.monotonic() - start < 5
+    events.add(dict(serial=11, name="user/pr", target="user/target"))
+    waiter.join()
+    assert [x["serial"] for x in results[0]["events"]] == [11]
+    assert events.waiters == 0
+
+
+def test_pr_metrics_histogram():
+    from devpi_pr.server import PRMetrics
+    metrics = PRMetrics()
+    metrics.add("op", 0.001)
+    metrics.add("op", 0.2)
+    metrics.add("op", 100)
+    metrics.count("op.files", 3)
+    data = metrics.as_dict()
+    assert data["counters"] == {"op.files": 3}
+    timing = data["timings"]["op"]
+    assert timing["count"] == 3
+    assert timing["max"] == 100
+    assert timing["histogram"]["0.005"] == 1
+    assert timing["histogram"]["0.1"] == 1
+    assert timing["histogram"]["0.5"] == 2
+    assert timing["histogram"]["60"] == 2
+    assert timing["histogram"]["+Inf"] == 3
+
+
+def test_pr_metrics(mapp, prindex, targetindex, testapp):
+    (release_path,) = mapp.get_release_paths('pkg')
+    mapp.upload_toxresult(release_path, b"{}")
+    mapp.upload_doc("pkg.doc.zip", b"foo", "pkg", "")
+    testapp.get_json(prindex.index + "/+pr-status")
+    testapp.get_json(targetindex.index + "/+pr-list")
+    testapp.get_json(targetindex.index + "/+pr-list")
+    mapp.login("targetuser", "123")
+    testapp.patch_json(prindex.index, [
+        'states+=approved',
+        'messages+=Approve'], headers={'X-Devpi-PR-Serial': '10'})
+    r = testapp.get_json("/+pr-metrics")
+    assert r.json['type'] == 'pr-metrics'
+    result = r.json['result']
+    assert result['counters'] == {
+        'approval.files': 3,
+        'index_pr_list.cache_hits': 1,
+        'index_pr_list.cache_misses': 1}
+    timings = result['timings']
+    assert sorted(timings) == [
+        'approval',
+        'approval.doczip',
+        'approval.logs',
+        'approval.releasefile',
+        'approval.toxresult',
+        'approval.versiondata',
+        'index_pr_list',
+        'index_pr_list.list',
+        'index_pr_list.serialize',
+        'pr_status']
+    for timing in timings.values():
+        assert timing['count'] == 1
+        assert timing['histogram']['+Inf'] == 1
+        assert timing['total'] <= timing['max'] + 1e-9
+    r = testapp.get_json("/+status")
+    metrics = {x[0]: x[2] for x in r.json['result']['metrics']}
+    assert metrics['devpi_pr_approval_files'] == 3
+    assert metrics['devpi_pr_approval_count'] == 1
+    assert metrics['devpi_pr_approval_releasefile_seconds'] > 0
+
+
+def wait_for_approval(testapp, url):
+    for i in range(300):
+        r = testapp.get_json(url + "/+pr-approval")
+        if r.json['result']['state'] != 'running':
+            return r.json['result']
+        time.sleep(0.1)
+    raise RuntimeError("Approval of %s didn't finish" % url)
+
+
+@pytest.mark.parametrize("keep_index", [False, True])
+def test_approval_job(keep_index, mapp, monkeypatch, new_prindex, targetindex, testapp, xom):
+    monkeypatch.setattr(xom.config.args, "pr_approval_chunk_size", 2)
+    for i in range(5):
+        filename = "pkg-1.0-py%d-none-any.whl" % i
+        mapp.upload_file_pypi(
+            filename, b"content%d" % i, "pkg", "1.0", set_whitelist=False)
+    r = testapp.patch_json(new_prindex.index, [
+        'states+=pending',
+        'messages+=Please approve'])
+    serial = int(r.headers['X-Devpi-Serial'])
+    mapp.login("targetuser", "123")
+    r = testapp.post_json(new_prindex.index + "/+pr-approval", dict(
+        serial=serial, message="Approve", keep_index=keep_index))
+    assert r.status_code == 202
+    assert r.json['type'] == 'pr-approval'
+    assert r.json['result']['state'] == 'running'
+    result = wait_for_approval(testapp, new_prindex.index)
+    assert result == {
+        'name': 'pruser/index',
+        'serial': serial,
+        'state': 'approved',
+        'files_total': 5,
+        'files_done': 5,
+        'files_skipped': 0,
+        'bytes_total': 40,
+        'bytes_done': 40}
+    r = testapp.get_json(targetindex.index + "/pkg/1.0")
+    links = r.json['result']['+links']
+    assert len(links) == 5
+    for link in links:
+        assert link['log'][-1]['what'] == 'push'
+        assert link['log'][-1]['message'] == 'Approve'
+    if keep_index:
+        r = testapp.get_json(new_prindex.index)
+        assert r.json['result']['states'] == ['new', 'pending', 'approved']
+        assert r.json['result']['changers'] == ['pruser', 'pruser', 'targetuser']
+    else:
+        testapp.get_json(new_prindex.index, status=404)
+    # the final status stays available
+    r = testapp.get_json(new_prindex.index + "/+pr-approval")
+    assert r.json['result'] == result
+    mapp.logout()
+    r = testapp.get_json(new_prindex.index + "/+pr-approval", expect_errors=True)
+    assert r.status_code == 401
+
+
+def test_approval_job_resume(mapp, monkeypatch, new_prindex, targetindex, testapp, xom):
+    import devpi_pr.server
+    monkeypatch.setattr(xom.config.args, "pr_approval_chunk_size", 2)
+    for i in range(5):
+        filename = "pkg-1.0-py%d-none-any.whl" % i
+        mapp.upload_file_pypi(
+            filename, b"content%d" % i, "pkg", "1.0", set_whitelist=False)
+    r = testapp.patch_json(new_prindex.index, [
+        'states+=pending',
+        'messages+=Please approve'])
+    serial = int(r.headers['X-Devpi-Serial'])
+    mapp.login("targetuser", "123")
+    # interrupt the job after the first chunk
+    copy_releases = devpi_pr.server.copy_releases
+    calls = []
+
+    def interrupted_copy_releases(*args, **kwargs):
+        calls.append(args)
+        if len(calls) > 1:
+            raise RuntimeError("interrupted")
+        return copy_releases(*args, **kwargs)
+
+    monkeypatch.setattr(
+        devpi_pr.server, "copy_releases", interrupted_copy_releases)
+    testapp.post_json(new_prindex.index + "/+pr-approval", dict(
+        serial=serial, message="Approve"))
+    result = wait_for_approval(testapp, new_prindex.index)
+    assert result['state'] == 'failed'
+    assert result['error'] == 'RuntimeError: interrupted'
+    assert result['files_done'] == 2
+    r = testapp.get_json(new_prindex.index)
+    assert r.json['result']['states'] == ['new', 'pending']
+    # resume
+    monkeypatch.setattr(devpi_pr.server, "copy_releases", copy_releases)
+    testapp.post_json(new_prindex.index + "/+pr-approval", dict(
+        serial=serial, message="Approve"))
+    result = wait_for_approval(testapp, new_prindex.index)
+    assert result['state'] == 'approved'
+    assert result['files_skipped'] == 2
+    assert result['files_done'] == 5
+    r = testapp.get_json(targetindex.index + "/pkg/1.0")
+    assert len(r.json['result']['+links']) == 5
+
+
+def test_approval_job_errors(mapp, prindex, targetindex, testapp):
+    r = testapp.post_json(prindex.index + "/+pr-approval", dict(
+        serial=8, message="Approve"), expect_errors=True)
+    assert r.status_code == 401
+    mapp.login("targetuser", "123")
+    r = testapp.post_json(prindex.index + "/+pr-approval", dict(
+        serial=7, message="Approve"), expect_errors=True)
+    assert r.status_code == 400
+    assert r.json['message'] == "got X-Devpi-PR-Serial 7, expected 8"
+    r = testapp.post_json(prindex.index + "/+pr-approval", dict(
+        message="Approve"), expect_errors=True)
+    assert r.json['message'] == "missing serial"
+    r = testapp.get_json(prindex.index + "/+pr-approval", expect_errors=True)
+    assert r.status_code == 404
+
+
+def test_approval_job_pruned():
+    from devpi_pr.server import ApprovalJob
+    from devpi_pr.views import approval_job_ttl
+    from devpi_pr.views import prune_approval_jobs
+    jobs = {}
+    for name in ("running", "old", "new"):
+        jobs[name] = ApprovalJob(None, name, 1, "Approve", "user")
+    jobs["old"].finished = 100
+    jobs["new"].finished = 100 + approval_job_ttl
+    prune_approval_jobs(jobs, now=101 + approval_job_ttl)
+    assert sorted(jobs) == ["new", "running"]
@@ -1,60 +1,534 @@
+from collections import OrderedDict
+from devpi_pr.server import ApprovalError
+from devpi_pr.server import ApprovalJob
+from devpi_pr.server import add_pr_event
+from devpi_pr.server import count_metric
+from devpi_pr.server import format_conflicts
+from devpi_pr.server import get_conflicts
+from devpi_pr.server import get_copy_links
+from devpi_pr.server import get_existing_links
+from devpi_pr.server import get_link_size
+from devpi_pr.server import get_pr_events_params
+from devpi_pr.server import get_pr_releases
+from devpi_pr.server import get_pr_serial
+from devpi_pr.server import get_source_releases
+from devpi_pr.server import get_pr_summary
+from devpi_pr.server import is_true
+from devpi_pr.server import iter_pr_stages
+from devpi_pr.server import timed_operation
+from devpi_server.log import threadlog
+from devpi_server.views import HTTPResponse
+from devpi_server.views import abort
 from devpi_server.views import apireturn
+from devpi_server.views import getjson
+from hashlib import sha256
+from operator import attrgetter
+from pyramid.httpexceptions import HTTPException
+from pyramid.httpexceptions import HTTPNotModified
 from pyramid.view import view_config
+import json
+import threading
+import time
 
 
-@view_config(route_name="index-pr-list", request_method="GET")
-def index_pr_list(context, request):
-    if context.stage.ixconfig["type"] == "pr":
-        ixconfig = context.stage.ixconfig
-        last_serial = context.stage.get_last_change_serial_perstage()
-        apireturn(200, type="pr-list", result={
-            ixconfig["states"][-1]: {
-                context.username: [dict(
-                    name=context.index,
-                    base=ixconfig["bases"][0],
-                    last_serial=last_serial,
-                    states=ixconfig["states"],
-                    messages=ixconfig["messages"],
-                    by=ixconfig["changers"])]}})
+class PRListCache(object):
+    """ Bounded cache of serialized pr list responses with LRU eviction.
+
+        The keys contain the database serial the response was created at,
+        so entries never have to be invalidated. """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return None
+            return self._data[key]
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+def pr_list_response(request, name, get_result):
+    """ Returns the pr list created by ``get_result`` as response.
+
+        The serialized response is cached by route, name, query string and
+        database serial. The ETag is a hash of the response body and if it
+        matches the If-None-Match request header, a 304 is returned instead. """
+    xom = request.registry["xom"]
+    cache = request.registry["devpi_pr.pr_list_cache"]
+    serial = xom.keyfs.tx.at_serial
+    operation = request.matched_route.name.replace("-", "_")
+    key = (request.matched_route.name, name, request.query_string, serial)
+    cached = cache.get(key)
+    if cached is None:
+        count_metric(xom, "%s.cache_misses" % operation)
+        with timed_operation(
+                xom, operation, name, log=threadlog.debug) as spans:
+            with spans.span("list"):
+                (result, next_cursor) = get_result(PRListQuery(request))
+            with spans.span("serialize"):
+                response = dict(result=result, type="pr-list")
+                if next_cursor is not None:
+                    response["next_cursor"] = next_cursor
+                data = json.dumps(response, indent=2) + "\n"
+                etag = sha256(data.encode("utf-8")).hexdigest()
+        cached = (data, etag)
+        cache.put(key, cached)
+    else:
+        count_metric(xom, "%s.cache_hits" % operation)
+    (data, etag) = cached
+    headers = {"content-type": "application/json", "ETag": '"%s"' % etag}
+    if etag in request.if_none_match:
+        raise HTTPNotModified(headers={"ETag": headers["ETag"]})
+    raise HTTPResponse(body=data, status=200, headers=headers)
+
+
+pr_info_fields = (
+    "name", "base", "last_serial", "files", "states", "messages", "by")
+
+
+class PRListQuery(object):
+    """ The filters and pagination parameters of a pr list request.
+
+        ``state``, ``user`` and ``fields`` can be repeated or contain comma
+        separated values. The ``cursor`` is the ``next_cursor`` of the
+        previous response. """
+
+    def __init__(self, request):
+        self.states = self._getlist(request, "state")
+        self.users = self._getlist(request, "user")
+        self.fields = self._getlist(request, "fields")
+        if self.fields is not None:
+            unknown = self.fields.difference(pr_info_fields)
+            if unknown:
+                abort(request, 400, "Unknown fields: %s" % ", ".join(
+                    sorted(unknown)))
+            self.fields.add("name")
+        self.since_serial = self._getint(request, "since_serial")
+        self.limit = self._getint(request, "limit")
+        if self.limit is not None and self.limit < 1:
+            abort(request, 400, "The limit must be at least 1")
+        self.cursor = request.GET.get("cursor")
+
+    def _getlist(self, request, name):
+        values = request.GET.getall(name)
+        if not values:
+            return None
+        return set(x for v in values for x in v.split(",") if x)
+
+    def _getint(self, request, name):
+        value = request.GET.get(name)
+        if value is None:
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            abort(request, 400, "The %s must be an integer" % name)
+
+    def matches(self, username, ixconfig):
+        if self.users is not None and username not in self.users:
+            return False
+        if self.states is not None and ixconfig["states"][-1] not in self.states:
+            return False
+        return True
+
+    def wants(self, field):
+        return self.fields is None or field in self.fields
+
+
+def get_pr_info(stage, query=None):
+    ixconfig = stage.ixconfig
+    getters = dict(
+        name=lambda: stage.index,
+        base=lambda: ixconfig["bases"][0],
+        last_serial=lambda: get_pr_summary(stage)["last_serial"],
+        files=lambda: get_pr_summary(stage)["files"],
+        states=lambda: ixconfig["states"],
+        messages=lambda: ixconfig["messages"],
+        by=lambda: ixconfig["changers"])
+    return dict(
+        (field, getters[field]())
+        for field in pr_info_fields
+        if query is None or query.wants(field))
+
+
+def make_pr_list(stages, query):
+    """ Returns the pr list of ``stages`` filtered by ``query`` together with
+        the cursor for the next page, which is ``None`` on the last page.
+
+        The stages are ordered by their name, which is also the cursor. """
     result = {}
-    if not context.stage.ixconfig.get("pull_requests_allowed", False):
-        apireturn(200, type="pr-list", result=result)
-    targetindex_name = context.stage.name
-    for user in context.model.get_userlist():
-        for name, ixconfig in user.get()["indexes"].items():
-            if ixconfig["type"] != "pr":
+    stages = sorted(
+        (stage for stage in stages
+         if query.matches(stage.username, stage.ixconfig)),
+        key=attrgetter("name"))
+    if query.cursor is not None:
+        stages = [x for x in stages if x.name > query.cursor]
+    names = []
+    for stage in stages:
+        if query.since_serial is not None:
+            if get_pr_summary(stage)["last_serial"] <= query.since_serial:
                 continue
-            if targetindex_name not in ixconfig['bases']:
-                continue
-            stage = user.getstage(name)
-            last_serial = stage.get_last_change_serial_perstage()
-            state_info = result.setdefault(ixconfig["states"][-1], {})
-            state_info.setdefault(user.name, []).append(dict(
-                name=name,
-                base=targetindex_name,
-                last_serial=last_serial,
-                states=ixconfig["states"],
-                messages=ixconfig["messages"],
-                by=ixconfig["changers"]))
-    apireturn(200, type="pr-list", result=result)
+        if query.limit is not None and len(names) >= query.limit:
+            return (result, names[-1])
+        info = get_pr_info(stage, query)
+        state_info = result.setdefault(stage.ixconfig["states"][-1], {})
+        state_info.setdefault(stage.username, []).append(info)
+        names.append(stage.name)
+    return (result, None)
+
+
+def get_index_pr_list(context, query):
+    if context.stage.ixconfig["type"] == "pr":
+        return make_pr_list([context.stage], query)
+    if not context.stage.ixconfig.get("pull_requests_allowed", False):
+        return ({}, None)
+    return make_pr_list(iter_pr_stages(context.stage), query)
+
+
+def get_user_pr_list(context, query):
+    user = context.user
+    if query.users is not None and user.name not in query.users:
+        return ({}, None)
+    names = [
+        name
+        for name, ixconfig in user.get()["indexes"].items()
+        if ixconfig["type"] == "pr"]
+    return make_pr_list((user.getstage(name) for name in names), query)
+
+
+@view_config(route_name="index-pr-list", request_method="GET")
+def index_pr_list(context, request):
+    pr_list_response(
+        request, context.stage.name,
+        lambda query: get_index_pr_list(context, query))
 
 
 @view_config(route_name="user-pr-list", request_method="GET")
 def user_pr_list(context, request):
-    result = {}
-    user = context.user
-    for name, ixconfig in user.get()["indexes"].items():
-        if ixconfig["type"] != "pr":
+    pr_list_response(
+        request, context.username,
+        lambda query: get_user_pr_list(context, query))
+
+
+@view_config(route_name="pr-status", request_method="GET")
+def pr_status(context, request):
+    stage = context.stage
+    if stage.ixconfig["type"] != "pr":
+        apireturn(
+            400, message="The index '%s' is not a pr index" % stage.name)
+    xom = request.registry["xom"]
+    with timed_operation(xom, "pr_status", stage.name, log=threadlog.debug):
+        result = get_pr_info(stage)
+    result["state"] = result["states"][-1]
+    apireturn(200, type="pr-status", result=result)
+
+
+def get_pr_check(request, stage, serial=None, incremental=False):
+    """ Returns what approving the pull request would do and the reasons
+        why it would fail, without writing or opening any file. """
+    target = stage.customizer._get_target_stage()
+    info = get_pr_info(stage)
+    errors = []
+    state = info["states"][-1]
+    if state != "pending":
+        errors.append(
+            "State transition from '%s' to 'approved' not allowed" % state)
+    if serial is not None and serial != info["last_serial"]:
+        errors.append("got X-Devpi-PR-Serial %s, expected %s" % (
+            serial, info["last_serial"]))
+    if not request.has_permission("pypi_submit", context=target):
+        errors.append("user %r cannot upload to %r" % (
+            request.authenticated_userid, target.name))
+    errors.extend(get_source_releases(stage)[1])
+    releases = get_pr_releases(stage)
+    existing = {}
+    if incremental:
+        existing = get_existing_links(target, releases)
+    conflicts = get_conflicts(target, releases, existing)
+    if conflicts:
+        errors.append(format_conflicts(conflicts))
+    copy_links = get_copy_links(releases, existing)
+    return dict(
+        state=state,
+        last_serial=info["last_serial"],
+        target=target.name,
+        files=len(copy_links),
+        bytes=sum(get_link_size(x) for x in copy_links),
+        skipped=sorted(
+            x.basename for x in get_copy_links(releases)
+            if x.relpath in existing),
+        conflicts=conflicts,
+        errors=errors)
+
+
+@view_config(route_name="pr-check", request_method="GET")
+def pr_check(context, request):
+    """ Checks whether the pull request can be approved. Supports the
+        ``serial`` the pull request was reviewed at and ``incremental``
+        query parameters. """
+    stage = context.stage
+    if stage.ixconfig["type"] != "pr":
+        apireturn(
+            400, message="The index '%s' is not a pr index" % stage.name)
+    serial = request.GET.get("serial")
+    if serial is not None:
+        try:
+            serial = int(serial)
+        except ValueError:
+            apireturn(400, message="The serial must be an integer")
+    incremental = is_true(request.GET.get("incremental", ""))
+    xom = request.registry["xom"]
+    with timed_operation(xom, "pr_check", stage.name, log=threadlog.debug):
+        result = get_pr_check(
+            request, stage, serial=serial, incremental=incremental)
+    apireturn(200, type="pr-check", result=result)
+
+
+@view_config(route_name="pr-events", request_method="GET")
+def pr_events(context, request):
+    """ Returns the state changes of the pull requests of a target index or
+        of a pr index after the ``serial`` query parameter.
+
+        If there are none yet, waits up to ``timeout`` seconds for them.
+        The returned ``serial`` is used for the next request.
+
+        The waiting is done by ``tween_pr_events`` before the transaction
+        of the request is started. """
+    stage = context.stage
+    try:
+        params = get_pr_events_params(request)
+    except ValueError as e:
+        apireturn(400, message=str(e))
+    result = request.environ.get("devpi_pr.events")
+    if result is None:
+        events = request.registry["xom"].devpi_pr_events
+        result = events.get(
+            stage.name, since=params.get("serial"),
+            timeout=params["timeout"])
+    apireturn(200, type="pr-events", result=result)
+
+
+@view_config(route_name="pr-metrics", request_method="GET")
+def pr_metrics(request):
+    metrics = request.registry["xom"].devpi_pr_metrics
+    apireturn(200, type="pr-metrics", result=metrics.as_dict())
+
+
+pr_batch_actions = {"approve": "approved", "reject": "rejected"}
+
+
+def check_pr_batch_item(model, target, item, newstate):
+    """ Returns the pr stage for ``item`` and ``None``, or ``None`` and the
+        status code and message of the error. """
+    name = item.get("name")
+    if not isinstance(name, str) or name.count("/") != 1:
+        return (None, (400, "Invalid pull request name %r" % (name,)))
+    stage = model.getstage(name)
+    if stage is None or stage.ixconfig["type"] != "pr":
+        return (None, (404, "No pull request '%s'" % name))
+    if stage.ixconfig["bases"][0] != target.name:
+        return (None, (400, "The pull request '%s' isn't for '%s'" % (
+            name, target.name)))
+    state = stage.ixconfig["states"][-1]
+    if state != "pending":
+        return (None, (400, "State transition from '%s' to '%s' not allowed" % (
+            state, newstate)))
+    if newstate == "approved":
+        serial = item.get("serial")
+        if not isinstance(serial, int):
+            return (None, (400, "missing serial for '%s'" % name))
+        last_serial = get_pr_serial(stage)
+        if serial != last_serial:
+            return (None, (400, "got serial %s, expected %s" % (
+                serial, last_serial)))
+    return (stage, None)
+
+
+def get_error_message(e):
+    try:
+        return e.json_body["message"]
+    except (KeyError, TypeError, ValueError):
+        return str(e)
+
+
+@view_config(route_name="index-pr-batch", request_method="POST")
+def index_pr_batch(context, request):
+    """ Approves or rejects multiple pull requests of the target index in
+        one transaction and reports the result for each of them.
+
+        Pull requests which fail the checks are skipped. If applying one
+        of them fails, the whole transaction is rolled back. """
+    target = context.stage
+    data = getjson(request)
+    newstate = pr_batch_actions.get(data.get("action"))
+    if newstate is None:
+        apireturn(400, message="The action must be one of: %s" % ", ".join(
+            sorted(pr_batch_actions)))
+    message = data.get("message")
+    if not isinstance(message, str) or not message.strip():
+        apireturn(400, message="A message is required")
+    prs = data.get("prs")
+    if not isinstance(prs, list) or not prs:
+        apireturn(400, message="No pull requests given")
+    if not request.has_permission("pypi_submit", context=target):
+        apireturn(401, message="user %r cannot upload to %r" % (
+            request.authenticated_userid, target.name))
+    keep_index = data.get("keep_index", False)
+    incremental = data.get("incremental", False)
+    model = request.registry["xom"].model
+    results = []
+    checked = []
+    for item in prs:
+        if not isinstance(item, dict):
+            item = dict(name=item)
+        (stage, error) = check_pr_batch_item(model, target, item, newstate)
+        result = dict(name=item.get("name"))
+        results.append(result)
+        if error is None:
+            checked.append((stage, item, result))
+        else:
+            (result["status"], result["message"]) = error
+    for (stage, item, result) in checked:
+        oldconfig = dict(stage.ixconfig)
+        try:
+            stage.modify(**dict(
+                oldconfig,
+                states=oldconfig["states"] + [newstate],
+                messages=oldconfig["messages"] + [message]))
+        except stage.InvalidIndexconfig as e:
+            (result["status"], result["message"]) = (
+                400, ", ".join(e.messages))
             continue
-        stage = user.getstage(name)
-        last_serial = stage.get_last_change_serial_perstage()
-        (targetindex_name,) = ixconfig["bases"]
-        state_info = result.setdefault(ixconfig["states"][-1], {})
-        state_info.setdefault(user.name, []).append(dict(
-            name=name,
-            base=targetindex_name,
-            last_serial=last_serial,
-            states=ixconfig["states"],
-            messages=ixconfig["messages"],
-            by=ixconfig["changers"]))
-    apireturn(200, type="pr-list", result=result)
+        error = None
+        try:
+            skipped = stage.customizer.on_state_modified(
+                request, oldconfig, item.get("serial"),
+                incremental=incremental)
+        except stage.InvalidIndexconfig as e:
+            error = (400, ", ".join(e.messages))
+        except HTTPException as e:
+            error = (e.status_code, get_error_message(e))
+        if error is not None:
+            request.registry["xom"].keyfs.tx.doom()
+            for (_, _, other) in checked:
+                if other.get("status", 200) == 200:
+                    other.pop("deleted", None)
+                    (other["status"], other["message"]) = (
+                        409, "Rolled back because of an error in '%s'" % (
+                            result["name"]))
+            (result["status"], result["message"]) = error
+            apireturn(
+                error[0], message="Rolled back because of an error in '%s'" % (
+                    result["name"]),
+                result=results, type="pr-batch")
+        (result["status"], result["message"]) = (200, newstate)
+        if skipped is not None:
+            result["skipped"] = skipped
+        if newstate == "approved" and not keep_index:
+            if stage.ixconfig["volatile"]:
+                add_pr_event(stage, "delete", request.authenticated_userid)
+                stage.delete()
+                result["deleted"] = True
+    apireturn(200, result=results, type="pr-batch")
+
+
+# how long the status of finished approval jobs is kept if nobody reads it
+approval_job_ttl = 3600
+
+
+def prune_approval_jobs(jobs, now=None):
+    if now is None:
+        now = time.monotonic()
+    for name, job in list(jobs.items()):
+        if job.finished is not None and now - job.finished > approval_job_ttl:
+            jobs.pop(name, None)
+
+
+@view_config(route_name="pr-approval", request_method="POST")
+def pr_approval_start(context, request):
+    """ Starts a background job approving the pull request.
+
+        If a job with the same serial is already running, its status is
+        returned instead. """
+    stage = context.stage
+    if stage.ixconfig["type"] != "pr":
+        apireturn(
+            400, message="The index '%s' is not a pr index" % stage.name)
+    data = getjson(request)
+    message = data.get("message")
+    if not isinstance(message, str) or not message.strip():
+        apireturn(400, message="A message is required")
+    target = stage.customizer._get_target_stage()
+    if not request.has_permission("pypi_submit", context=target):
+        apireturn(401, message="user %r cannot upload to %r" % (
+            request.authenticated_userid, target.name))
+    serial = data.get("serial")
+    if not isinstance(serial, int):
+        apireturn(400, message="missing serial")
+    jobs = request.registry["devpi_pr.approval_jobs"]
+    prune_approval_jobs(jobs)
+    job = jobs.get(stage.name)
+    if job is not None and job.running:
+        if job.serial != serial:
+            apireturn(409, message="An approval of %s at serial %s is running" % (
+                stage.name, job.serial))
+        apireturn(200, type="pr-approval", result=job.as_dict())
+    xom = request.registry["xom"]
+    job = ApprovalJob(
+        xom, stage.name, serial, message, request.authenticated_userid,
+        keep_index=bool(data.get("keep_index", False)),
+        chunk_size=xom.config.args.pr_approval_chunk_size,
+        target=target.name)
+    try:
+        job.check_target(target)
+    except ApprovalError as e:
+        apireturn(409, message=str(e))
+    try:
+        job.check_stage(stage)
+    except ApprovalError as e:
+        apireturn(400, message=str(e))
+    # the job skips files already in the target index
+    releases = get_pr_releases(stage)
+    conflicts = get_conflicts(
+        target, releases, get_existing_links(target, releases))
+    if conflicts:
+        apireturn(409, message=format_conflicts(conflicts))
+    jobs[stage.name] = job
+    job.start()
+    apireturn(202, type="pr-approval", result=job.as_dict())
+
+
+@view_config(route_name="pr-approval", request_method="GET")
+def pr_approval_status(context, request):
+    # the pr index might already be deleted by the job,
+    # so the name is taken from the url
+    name = "%s/%s" % (request.matchdict["user"], request.matchdict["index"])
+    jobs = request.registry["devpi_pr.approval_jobs"]
+    prune_approval_jobs(jobs)
+    job = jobs.get(name)
+    if job is None:
+        apireturn(404, message="No approval of %s found" % name)
+    target = None
+    if job.target is not None:
+        target = request.registry["xom"].model.getstage(job.target)
+    if target is None or not request.has_permission(
+            "pypi_submit", context=target):
+        apireturn(401, message="user %r cannot upload to %r" % (
+            request.authenticated_userid, job.target))
+    apireturn(200, type="pr-approval", result=job.as_dict())